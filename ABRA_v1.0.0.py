@@ -1,129 +1,60 @@
+# Sets the BLAS/OpenMP thread limits, so it is imported before numpy and the model libraries
+from abra_runtime import RUNTIME, analysis_slots, runtime_report
 import streamlit as st
-import fdasrsf as fs
 import plotly.figure_factory as ff
 import pandas as pd
 import numpy as np
-from scipy.signal import find_peaks
 import os
-import tempfile
-from scipy.interpolate import CubicSpline
+from dataclasses import replace
 import plotly.graph_objects as go
-import struct
-import datetime
-from skfda import FDataGrid
-from skfda.preprocessing.dim_reduction import FPCA
-from sklearn.cluster import DBSCAN
-from kneed import KneeLocator
-from sklearn.neighbors import NearestNeighbors
-from sklearn.preprocessing import StandardScaler, MinMaxScaler
-from scipy.ndimage import gaussian_filter1d
-import torch
-import torch.nn as nn
-import torch.optim as optim
-import keras
-from tensorflow.keras.models import load_model
+import plotly.io as pio
+from abra import (ALIGNMENT_MODES, REVIEW_THRESHOLD_CI_DB, REVIEW_ONSET_SD_MS, THRESHOLD_COLUMNS, AnalysisJob,
+                  ArfCatalog, FigureCache, FolderWatcher, ResultsStore, Settings, align_waves_with_summary,
+                  analyze_recording, archive_members, calculate_hearing_threshold, calibration_table,
+                  cascade_agreement_report, catalog_series, cohort_wave_i_amplitudes, display_points,
+                  dtype_accuracy_report, figure_key, is_archive, load_archive, load_recording, load_series,
+                  lttb_indices, mean_and_sem, metrics_columns, metrics_rows, metrics_table, model_version, peak_finding,
+                  prepare_wave, quantization_accuracy_report, read_calibration_csv, resolve_calibration, stacked_waves,
+                  threshold_rows, uncertainty_report, wave_i_io_curve)
+from abra.export import write_recordings, write_results, read_recordings, zip_directory
+from abra.metrics import METRICS, start_exporters
+from abra_inference import THRESHOLD_MODEL_PATH, PEAK_MODEL_PATH, InProcessInference, connect_inference
 import matplotlib.pyplot as plt
 from matplotlib import cm
 import colorcet as cc
 import io
+from functools import partial
 from numpy import AxisError
 import warnings
 warnings.filterwarnings('ignore')
 
 # Co-authored by: Abhijeeth Erra and Jeffrey Chen
 
-# Define the CNN model
-class CNN(nn.Module):
-    def __init__(self, dropout_prob=0.1):
-        super(CNN, self).__init__()
-        self.conv1 = nn.Conv1d(in_channels=1, out_channels=16, kernel_size=3, stride=1, padding=1)
-        self.pool = nn.MaxPool1d(kernel_size=2, stride=2, padding=0)
-        self.conv2 = nn.Conv1d(in_channels=16, out_channels=32, kernel_size=3, stride=1, padding=1)
-        self.fc1 = nn.Linear(32 * 61, 128)
-        self.fc2 = nn.Linear(128, 1)
-        self.dropout = nn.Dropout(dropout_prob)
-        self.batch_norm1 = nn.BatchNorm1d(16)
-        self.batch_norm2 = nn.BatchNorm1d(32)
-
-    def forward(self, x):
-        x = self.pool(nn.functional.relu(self.batch_norm1(self.conv1(x))))
-        x = self.dropout(x)
-        x = self.pool(nn.functional.relu(self.batch_norm2(self.conv2(x))))
-        x = self.dropout(x)
-        x = x.view(-1, 32 * 61)
-        x = nn.functional.relu(self.fc1(x))
-        x = self.dropout(x)
-        x = self.fc2(x)
-        return x
-
-def interpolate_and_smooth(final, target_length=244):
-    if len(final) > target_length:
-        new_points = np.linspace(0, len(final), target_length + 2)
-        interpolated_values = np.interp(new_points, np.arange(len(final)), final)
-        final = np.array(interpolated_values[:target_length], dtype=float)
-        final = pd.Series(final)
-    elif len(final) < target_length:
-        original_indices = np.arange(len(final))
-        target_indices = np.linspace(0, len(final) - 1, target_length)
-        cs = CubicSpline(original_indices, final)
-        final = cs(target_indices)
-    return final
+start_exporters()
 
 def plot_wave(fig, x_values, y_values, color, name, marker_color=None):
     fig.add_trace(go.Scatter(x=x_values, y=y_values, mode='lines', name=name, line=dict(color=color)))
     if marker_color:
         fig.add_trace(go.Scatter(x=x_values, y=y_values, mode='markers', marker=dict(color=marker_color), name=name, showlegend=False))
 
-def calculate_and_plot_wave(df, freq, db, color, threshold=None):
-    db_column = 'Level(dB)' if level else 'PostAtten(dB)'
-    khz = df[(df['Freq(Hz)'] == freq) & (df[db_column] == db)]
-    if not khz.empty:
-        index = khz.index.values[0]
-        final = df.loc[index, '0':].dropna()
-        final = pd.to_numeric(final, errors='coerce').dropna()
-
-        target = int(244 * (time_scale / 10))
-        
-        y_values = interpolate_and_smooth(final, target)  # Original y-values for plotting
-        sampling_rate = len(y_values) / time_scale
-
-        x_values = np.linspace(0, len(y_values) / sampling_rate, len(y_values))
-
-        #y_values = interpolate_and_smooth(final[:244])
-        if units == 'Nanovolts':
-            y_values /= 1000
-
-        y_values *= multiply_y_factor
-
-        y_values_fpf = interpolate_and_smooth(y_values[:244])
-
-        # Flatten the data to scale all values across the group
-        flattened_data = y_values_fpf.values.flatten().reshape(-1, 1)
-
-        # Step 1: Standardize the data
-        scaler = StandardScaler()
-        standardized_data = scaler.fit_transform(flattened_data)
-
-        # Step 2: Apply min-max scaling
-        min_max_scaler = MinMaxScaler(feature_range=(0, 1))
-        scaled_data = min_max_scaler.fit_transform(standardized_data).reshape(y_values_fpf.shape)
-
-        y_values_fpf = interpolate_and_smooth(scaled_data[:244])
-
-        highest_peaks, relevant_troughs = peak_finding(y_values_fpf)
+def calculate_and_plot_wave(recording, freq, db, color, threshold=None):
+    x_values, y_values, y_values_fpf = prepare_wave(recording, freq, db, settings)
+    if y_values is not None:
+        highest_peaks, relevant_troughs = peak_finding(y_values_fpf, inference)
 
         return x_values, y_values, highest_peaks, relevant_troughs
     return None, None, None, None
 
-def plot_waves_single_frequency(df, freq, y_min, y_max, plot_time_warped=False):
+def plot_waves_single_frequency(freq, y_min, y_max, plot_time_warped=False):
     db_column = 'Level(dB)' if level else 'PostAtten(dB)'
 
-    if len(selected_dfs) == 0:
-        st.write("No files selected.")
-        return
+    if len(selected_recordings) == 0:
+        return [], ["No files selected."]
     
     fig_list = []
-    for idx, file_df in enumerate(selected_dfs):
+    messages = []
+    for recording in selected_recordings:
+        file_df = recording.data
         fig = go.Figure()
 
         df_filtered = file_df[file_df['Freq(Hz)'] == freq]
@@ -133,34 +64,36 @@ def plot_waves_single_frequency(df, freq, y_min, y_max, plot_time_warped=False):
         original_waves = []
 
         try:
-            threshold = np.abs(calculate_hearing_threshold(file_df, freq))
+            threshold = np.abs(calculate_hearing_threshold(recording, freq, settings, inference))
         except Exception as e:
             threshold = None
-            st.write("Threshold can't be calculated.", e)
+            messages.append(f"Threshold can't be calculated for {recording.name}: {e}")
         
         if threshold is not None:
             if db_column == 'Level(dB)':
-                x_values, y_values, _, _ = calculate_and_plot_wave(file_df, freq, threshold, 'black')
+                x_values, y_values, _, _ = calculate_and_plot_wave(recording, freq, threshold, 'black')
             elif db_column == 'PostAtten(dB)':
-                x_values, y_values, _, _ = calculate_and_plot_wave(file_df, freq, calibration_levels[(file_df.name, freq)] - threshold, 'black')
+                x_values, y_values, _, _ = calculate_and_plot_wave(recording, freq, settings.calibration_level(recording.name, freq) - threshold, 'black')
             if y_values is not None:
-                if return_units == 'Nanovolts':
+                if settings.return_units == 'Nanovolts':
                     y_values *= 1000
-                fig.add_trace(go.Scatter(x=x_values, y=y_values, mode='lines', name=f'Threshold: {int(threshold)} dB', line=dict(color='black', width=5)))
+                x_display, y_display = display_points(x_values, y_values, display_budget)
+                fig.add_trace(go.Scatter(x=x_display, y=y_display, mode='lines', name=f'Threshold: {int(threshold)} dB', line=dict(color='black', width=5)))
 
         for i, db in enumerate(sorted(db_levels)):
             if db_column == 'Level(dB)':
-                x_values, y_values, highest_peaks, relevant_troughs = calculate_and_plot_wave(file_df, freq, db, glasbey_colors[i])
+                x_values, y_values, highest_peaks, relevant_troughs = calculate_and_plot_wave(recording, freq, db, glasbey_colors[i])
             else:
-                x_values, y_values, highest_peaks, relevant_troughs = calculate_and_plot_wave(file_df, freq, db, glasbey_colors[i])
+                x_values, y_values, highest_peaks, relevant_troughs = calculate_and_plot_wave(recording, freq, db, glasbey_colors[i])
             
             if y_values is not None:
-                if return_units == 'Nanovolts':
+                if settings.return_units == 'Nanovolts':
                     y_values *= 1000
+                x_display, y_display = display_points(x_values, y_values, display_budget, keep=np.concatenate([highest_peaks, relevant_troughs]))
                 if db_column == 'Level(dB)':
-                    fig.add_trace(go.Scatter(x=x_values, y=y_values, mode='lines', name=f'{int(db)} dB', line=dict(color=glasbey_colors[i])))
+                    fig.add_trace(go.Scatter(x=x_display, y=y_display, mode='lines', name=f'{int(db)} dB', line=dict(color=glasbey_colors[i])))
                 else:
-                    fig.add_trace(go.Scatter(x=x_values, y=y_values, mode='lines', name=f'{calibration_levels[(file_df.name, freq)] - int(db)} dB', line=dict(color=glasbey_colors[i])))
+                    fig.add_trace(go.Scatter(x=x_display, y=y_display, mode='lines', name=f'{settings.calibration_level(recording.name, freq) - int(db)} dB', line=dict(color=glasbey_colors[i])))
 
                 if show_peaks:
                     # Mark the highest peaks with red markers
@@ -172,56 +105,60 @@ def plot_waves_single_frequency(df, freq, y_min, y_max, plot_time_warped=False):
                 if plot_time_warped:
                     original_waves.append(y_values.tolist())
 
+        alignment_summary = None
         if plot_time_warped:
             original_waves_array = np.array([wave[:-1] for wave in original_waves])
             try:
-                time = np.linspace(0, time_scale, original_waves_array.shape[1])
-                obj = fs.fdawarp(original_waves_array.T, time)
-                obj.srsf_align(parallel=True)
-                warped_waves_array = obj.fn.T
+                time = np.linspace(0, settings.time_scale, original_waves_array.shape[1])
+                warped_waves_array, alignment_summary = align_waves_with_summary(original_waves_array, time, alignment_mode, RUNTIME['warp_workers'])
                 for i, db in enumerate(db_levels):
-                    fig.add_trace(go.Scatter(x=np.linspace(0, 10, len(warped_waves_array[i])), y=warped_waves_array[i], mode='lines', name=f'{int(db)} dB', line=dict(color=glasbey_colors[i])))
+                    x_display, y_display = display_points(np.linspace(0, 10, len(warped_waves_array[i])), warped_waves_array[i], display_budget)
+                    fig.add_trace(go.Scatter(x=x_display, y=y_display, mode='lines', name=f'{int(db)} dB', line=dict(color=glasbey_colors[i])))
             except IndexError:
                 pass
 
         if threshold is not None:
             if db_column == 'Level(dB)':
-                x_values, y_values, _, _ = calculate_and_plot_wave(file_df, freq, threshold, 'black')
+                x_values, y_values, _, _ = calculate_and_plot_wave(recording, freq, threshold, 'black')
             elif db_column == 'PostAtten(dB)':
-                x_values, y_values, _, _ = calculate_and_plot_wave(file_df, freq, calibration_levels[(file_df.name, freq)] - threshold, 'black')
+                x_values, y_values, _, _ = calculate_and_plot_wave(recording, freq, settings.calibration_level(recording.name, freq) - threshold, 'black')
             if y_values is not None:
-                if return_units == 'Nanovolts':
+                if settings.return_units == 'Nanovolts':
                     y_values *= 1000
-                fig.add_trace(go.Scatter(x=x_values, y=y_values, mode='lines', name=f'Threshold: {int(threshold)} dB', line=dict(color='black', width=5)))
+                x_display, y_display = display_points(x_values, y_values, display_budget)
+                fig.add_trace(go.Scatter(x=x_display, y=y_display, mode='lines', name=f'Threshold: {int(threshold)} dB', line=dict(color='black', width=5)))
         
-        if return_units == 'Nanovolts':
+        if settings.return_units == 'Nanovolts':
             y_units = 'Voltage (nV)'
         else:
             y_units = 'Voltage (μV)'
 
-        fig.update_layout(title=f'{selected_files[idx].split("/")[-1]} - Frequency: {freq} Hz', xaxis_title='Time (ms)', yaxis_title=y_units)
-        fig.update_layout(annotations=annotations)
-        fig.update_layout(yaxis_range=[y_min, y_max])
-        fig.update_layout(width=700, height=450)
-        fig.update_layout(font_family="Times New Roman",
-                      font_color="black",
-                      title_font_family="Times New Roman",
-                      font=dict(size=18))
+        title = f'{recording.name} - Frequency: {freq} Hz'
+        if alignment_summary:
+            title += f'<br><sup>{alignment_summary}</sup>'
+        fig.update_layout(title=title, xaxis_title='Time (ms)', yaxis_title=y_units, annotations=annotations,
+                          yaxis_range=[y_min, y_max], width=700, height=450,
+                          font_family="Times New Roman",
+                          font_color="black",
+                          title_font_family="Times New Roman",
+                          font=dict(size=18))
 
         fig_list.append(fig)
-    return fig_list
+    return fig_list, messages
 
 def plot_waves_single_tuple(freq, db, y_min, y_max):
     fig = go.Figure()
     db_column = 'Level(dB)' if level else 'PostAtten(dB)'
 
-    for idx, file_df in enumerate(selected_dfs):
-        x_values, y_values, highest_peaks, relevant_troughs = calculate_and_plot_wave(file_df, freq, db, 'blue')
+    for recording in selected_recordings:
+        file_df = recording.data
+        x_values, y_values, highest_peaks, relevant_troughs = calculate_and_plot_wave(recording, freq, db, 'blue')
 
         if y_values is not None:
-            if return_units == 'Nanovolts':
+            if settings.return_units == 'Nanovolts':
                 y_values *= 1000
-            fig.add_trace(go.Scatter(x=x_values, y=y_values, mode='lines', name=f'{selected_files[idx].split("/")[-1]}'))#, showlegend=False))
+            x_display, y_display = display_points(x_values, y_values, display_budget, keep=np.concatenate([highest_peaks, relevant_troughs]))
+            fig.add_trace(go.Scatter(x=x_display, y=y_display, mode='lines', name=f'{recording.name}'))#, showlegend=False))
             if show_peaks:
                 # Mark the highest peaks with red markers
                 fig.add_trace(go.Scatter(x=x_values[highest_peaks], y=y_values[highest_peaks], mode='markers', marker=dict(color='red'), name='Peaks'))#, showlegend=False))
@@ -229,16 +166,16 @@ def plot_waves_single_tuple(freq, db, y_min, y_max):
                 # Mark the relevant troughs with blue markers
                 fig.add_trace(go.Scatter(x=x_values[relevant_troughs], y=y_values[relevant_troughs], mode='markers', marker=dict(color='blue'), name='Troughs'))#, showlegend=False))
 
-    if return_units == 'Nanovolts':
+    if settings.return_units == 'Nanovolts':
         y_units = 'Voltage (nV)'
     else:
         y_units = 'Voltage (μV)'
 
     fig.update_layout(width=700, height=450)
     if level:
-        fig.update_layout(xaxis_title='Time (ms)', yaxis_title=y_units, title=f'{selected_files[idx].split("/")[-1]}, Freq = {freq}, db = {db}')
+        fig.update_layout(xaxis_title='Time (ms)', yaxis_title=y_units, title=f'{recording.name}, Freq = {freq}, db = {db}')
     else:
-        fig.update_layout(xaxis_title='Time (ms)', yaxis_title=y_units, title=f'{selected_files[idx].split("/")[-1]}, Freq = {freq}, db = {calibration_levels[(file_df.name, freq)] - int(db)}')
+        fig.update_layout(xaxis_title='Time (ms)', yaxis_title=y_units, title=f'{recording.name}, Freq = {freq}, db = {settings.calibration_level(recording.name, freq) - int(db)}')
     fig.update_layout(annotations=annotations)
     fig.update_layout(yaxis_range=[y_min, y_max])
     fig.update_layout(font_family="Times New Roman",
@@ -249,47 +186,46 @@ def plot_waves_single_tuple(freq, db, y_min, y_max):
 
     return fig
 
-def plot_3d_surface(df, freq, y_min, y_max):
+def plot_3d_surface(freq, y_min, y_max):
     db_column = 'Level(dB)' if level else 'PostAtten(dB)'
 
-    if len(selected_dfs) == 0:
-        st.write("No files selected.")
-        return
+    if len(selected_recordings) == 0:
+        return [], ["No files selected."]
 
     fig_list = []
-    for idx, file_df in enumerate(selected_dfs):
+    for recording in selected_recordings:
+        file_df = recording.data
         fig = go.Figure()
         df_filtered = file_df[file_df['Freq(Hz)'] == freq]
         if db_column == 'Level(dB)':
             db_levels = sorted(df_filtered[db_column].unique(), reverse=True)
         else:
-            db_levels = sorted([calibration_levels[(file_df.name, freq)] - db for db in df_filtered[db_column].unique()], reverse=True)
+            db_levels = sorted([settings.calibration_level(recording.name, freq) - db for db in df_filtered[db_column].unique()], reverse=True)
         
         original_waves = []
 
         try:
-            threshold = calculate_hearing_threshold(file_df, freq)
+            threshold = calculate_hearing_threshold(recording, freq, settings, inference)
         except:
             threshold = None
 
         for db in db_levels:
             if db_column == 'Level(dB)':
-                x_values, y_values, _, _ = calculate_and_plot_wave(file_df, freq, db, 'blue')
+                x_values, y_values, _, _ = calculate_and_plot_wave(recording, freq, db, 'blue')
             else:
-                x_values, y_values, _, _ = calculate_and_plot_wave(file_df, freq, calibration_levels[(file_df.name, freq)] - db, 'blue')
+                x_values, y_values, _, _ = calculate_and_plot_wave(recording, freq, settings.calibration_level(recording.name, freq) - db, 'blue')
 
             if y_values is not None:
-                if return_units == 'Nanovolts':
+                if settings.return_units == 'Nanovolts':
                     y_values *= 1000
                 original_waves.append(y_values.tolist())
 
         original_waves_array = np.array([wave[:-1] for wave in original_waves])
 
+        alignment_summary = None
         try:
             time = np.linspace(0, 10, original_waves_array.shape[1])
-            obj = fs.fdawarp(original_waves_array.T, time)
-            obj.srsf_align(parallel=True)
-            warped_waves_array = obj.fn.T
+            warped_waves_array, alignment_summary = align_waves_with_summary(original_waves_array, time, alignment_mode, RUNTIME['warp_workers'])
         except IndexError:
             warped_waves_array = np.array([])
 
@@ -298,12 +234,20 @@ def plot_3d_surface(df, freq, y_min, y_max):
             if db == threshold:
                 fig.add_trace(go.Scatter3d(x=[db] * len(warped_waves), y=x_values, z=warped_waves, mode='lines', name=f'Thresh: {int(db)} dB', line=dict(color='black', width=5)))
                 
-        for i in range(len(time)):
+        # One cross-section per displayed time point rather than per sample
+        if warped_waves_array.size:
+            time_points = lttb_indices(warped_waves_array.mean(axis=0), display_budget or len(time))
+        else:
+            time_points = []
+        for i in time_points:
             z_values_at_time = [warped_waves_array[j, i] for j in range(len(db_levels))]
             fig.add_trace(go.Scatter3d(x=db_levels, y=[time[i]] * len(db_levels), z=z_values_at_time, mode='lines', name=f'Time: {time[i]:.2f} ms', line=dict(color='rgba(0, 255, 0, 0.3)'), showlegend=False))
 
         fig.update_layout(width=700, height=450)
-        fig.update_layout(title=f'{selected_files[idx].split("/")[-1]} - Frequency: {freq} Hz', scene=dict(xaxis_title='dB', yaxis_title='Time (ms)', zaxis_title='Voltage (μV)'), annotations=annotations)
+        title = f'{recording.name} - Frequency: {freq} Hz'
+        if alignment_summary:
+            title += f'<br><sup>{alignment_summary}</sup>'
+        fig.update_layout(title=title, scene=dict(xaxis_title='dB', yaxis_title='Time (ms)', zaxis_title='Voltage (μV)'), annotations=annotations)
         camera = dict(
             up=dict(x=0, y=0, z=0.5),
             center=dict(x=0, y=0, z=0),
@@ -318,7 +262,7 @@ def plot_3d_surface(df, freq, y_min, y_max):
                       font=dict(size=14))
 
         fig_list.append(fig)
-    return fig_list
+    return fig_list, []
 
 def display_metrics_table(df, freq, db, baseline_level):
     if level:
@@ -340,7 +284,7 @@ def display_metrics_table(df, freq, db, baseline_level):
         # Adjust the waveform by subtracting the baseline level
         y_values -= baseline_level
 
-        highest_peaks, relevant_troughs = peak_finding(y_values)
+        highest_peaks, relevant_troughs = peak_finding(y_values, inference)
 
         if highest_peaks.size > 0:  # Check if highest_peaks is not empty
             first_peak_amplitude = y_values[highest_peaks[0]] - y_values[relevant_troughs[0]]
@@ -362,168 +306,55 @@ def display_metrics_table(df, freq, db, baseline_level):
             ).set_properties(**{'width': '100px'})
         return styled_metrics_table
 
-def display_metrics_table_all_db(selected_dfs, freqs, db_levels, baseline_level):
-    if level:
-        db_column = 'Level(dB)'
+def display_metrics_table_all_db(recordings, freqs, db_levels, baseline_level):
+    # Kept in the figure cache too, so going back to a plot doesn't rerun the peak finding and thresholds under it
+    key = figure_key('metrics_table', recordings, settings, current_model_version(inference.quantization),
+                     freqs=list(freqs), db_levels=list(db_levels))
+    cached = figure_cache().get(key)
+    if cached is not None:
+        _, _, (metrics_table_all,) = cached
     else:
-        db_column = 'PostAtten(dB)'
-
-    ru = 'μV'
-    if return_units == 'Nanovolts':
-        ru = 'nV'
-        
-    metrics_data = {'File Name': [], 'Frequency (Hz)': [], 'dB Level': [], f'Wave I amplitude (P1-T1) ({ru})': [], 'Latency to First Peak (ms)': [], 'Amplitude Ratio (Peak1/Peak4)': [], 'Estimated Threshold': []}
-
-    for file_df, file_name in zip(selected_dfs, selected_files):
-        for freq in freqs:
-            try:
-                threshold = calculate_hearing_threshold(file_df, freq)
-            except:
-                threshold = np.nan
-                pass
-
-            for db in db_levels:
-                _, y_values, highest_peaks, relevant_troughs = calculate_and_plot_wave(file_df, freq, db, 'blue')
-                    
-                if return_units == 'Nanovolts':
-                    y_values *= 1000
-
-                if highest_peaks is not None:
-                    if highest_peaks.size > 0:  # Check if highest_peaks is not empty
-                        first_peak_amplitude = y_values[highest_peaks[0]] - y_values[relevant_troughs[0]]
-                        latency_to_first_peak = highest_peaks[0] * (10 / len(y_values))  # Assuming 10 ms duration for waveform
-
-                        if len(highest_peaks) >= 4 and len(relevant_troughs) >= 4:
-                            amplitude_ratio = (y_values[highest_peaks[0]] - y_values[relevant_troughs[0]]) / (
-                                        y_values[highest_peaks[3]] - y_values[relevant_troughs[3]])
-                        else:
-                            amplitude_ratio = np.nan
-
-                        metrics_data['File Name'].append(file_name.split("/")[-1])
-                        metrics_data['Frequency (Hz)'].append(freq)
-                        if db_column == 'Level(dB)':
-                            metrics_data['dB Level'].append(db)
-                        else:
-                            metrics_data['dB Level'].append(calibration_levels[(df.name, freq)] - db)
-                        metrics_data[f'Wave I amplitude (P1-T1) ({ru})'].append(first_peak_amplitude)
-                        metrics_data['Latency to First Peak (ms)'].append(latency_to_first_peak)
-                        metrics_data['Amplitude Ratio (Peak1/Peak4)'].append(amplitude_ratio)
-                        metrics_data['Estimated Threshold'].append(threshold)
-
-    metrics_table = pd.DataFrame(metrics_data)
-    st.dataframe(metrics_table, hide_index=True, use_container_width=True)
+        tables = [metrics_table(recording, freqs, db_levels, settings, inference) for recording in recordings]
+        metrics_table_all = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=metrics_columns(settings))
+        figure_cache().put(key, [], tables=[metrics_table_all])
+    st.dataframe(metrics_table_all, hide_index=True, use_container_width=True)
 
 def plot_waves_stacked(freq):
-    if len(selected_dfs) == 0:
-        st.write("No files selected.")
-        return
-
-    db_column = 'Level(dB)' if level else 'PostAtten(dB)'
+    if len(selected_recordings) == 0:
+        return [], ["No files selected."]
 
     fig_list = []
-    for idx, file_df in enumerate(selected_dfs):
+    for recording in selected_recordings:
+        x_values, stacked = stacked_waves(recording, freq, settings)
+        if not stacked:
+            continue
         fig = go.Figure()
 
-        # Get unique dB levels and color palette
-        unique_dbs = sorted(file_df[db_column].unique())
-        num_dbs = len(unique_dbs)
-        vertical_spacing = 25 / num_dbs
-        db_offsets = {db: y_min + i * vertical_spacing for i, db in enumerate(unique_dbs)}
-        glasbey_colors = cc.glasbey[:num_dbs]
+        # Lowest recorded dB at the bottom
+        recorded_dbs = sorted(db for db, _, _ in stacked)
+        vertical_spacing = 25 / len(recorded_dbs)
+        db_offsets = {db: y_min + i * vertical_spacing for i, db in enumerate(recorded_dbs)}
+        glasbey_colors = cc.glasbey[:len(stacked)]
 
-        # Calculate the hearing threshold
         try:
-            threshold = calculate_hearing_threshold(file_df, freq)
-        except:
+            threshold = calculate_hearing_threshold(recording, freq, settings, inference)
+        except Exception:
             threshold = None
 
-        db_levels = sorted(unique_dbs, reverse=True) if db_column == 'Level(dB)' else sorted(unique_dbs)
-        if db_column == 'PostAtten(dB)':
-            db_levels = np.array(db_levels)
-            calibration_level = np.full(len(db_levels), calibration_levels[(df.name, freq)])
-            db_levels = calibration_level - db_levels
-        max_db = db_levels[0]
+        for i, (recorded_db, db, wave) in enumerate(stacked):
+            y_values = wave + db_offsets[recorded_db]
+            color_scale = glasbey_colors[i]
+            x_display, y_display = display_points(x_values, y_values, display_budget)
+            fig.add_trace(go.Scatter(x=x_display, y=y_display, mode='lines', name=f'{int(db)} dB', line=dict(color=color_scale)))
+            if db == threshold:
+                fig.add_trace(go.Scatter(x=x_display, y=y_display, mode='lines', name=f'Thresh: {int(db)} dB',
+                                         line=dict(color='black', width=5), showlegend=True))
+            fig.add_annotation(x=10, y=y_values[-1] + 0.5, xref="x", yref="y", text=f"{int(db)} dB", showarrow=False,
+                               font=dict(size=18, color=color_scale), xanchor="right")
 
-        for i, db in enumerate(db_levels):
-            try:
-                if db_column == 'Level(dB)':
-                    khz = file_df[(file_df['Freq(Hz)'] == freq) & (file_df[db_column] == db)]
-                else:
-                    khz = file_df[(file_df['Freq(Hz)'] == freq) & (file_df[db_column] == (calibration_level[0] - db))]
-
-                if not khz.empty:
-                    index = khz.index.values[-1]
-                    final = file_df.loc[index, '0':].dropna()
-                    final = pd.to_numeric(final, errors='coerce')
-                    final = interpolate_and_smooth(final)
-                    final *= multiply_y_factor
-
-                    if units == 'Nanovolts':
-                        final /= 1000
-
-                    # Normalize the waveform
-                    if (db_column == 'Level(dB)' and db == max_db) or (db_column == 'PostAtten(dB)' and db == max_db):
-                        max_value = np.max(np.abs(final))
-                    final_normalized = final / max_value
-
-                    # Apply vertical offset
-                    if db_column == 'Level(dB)':
-                        y_values = final_normalized + db_offsets[db]
-                    else:
-                        y_values = final_normalized + db_offsets[calibration_level[0] - db]
-
-                    # Plot the waveform
-                    color_scale = glasbey_colors[i]
-                    fig.add_trace(go.Scatter(x=np.linspace(0, time_scale, len(y_values)),
-                                            y=y_values,
-                                            mode='lines',
-                                            name=f'{int(db)} dB',
-                                            line=dict(color=color_scale)))
-
-                    if (db_column == 'Level(dB)' and db == threshold) or (db_column == 'PostAtten(dB)' and db == threshold):
-                        fig.add_trace(go.Scatter(x=np.linspace(0, time_scale, len(y_values)),
-                                                y=y_values,
-                                                mode='lines',
-                                                name=f'Thresh: {int(db)} dB',
-                                                line=dict(color='black', width=5),
-                                                showlegend=True))
-                    
-
-                    fig.add_annotation(
-                        x=10,
-                        y=y_values[-1] + 0.5,
-                        xref="x",
-                        yref="y",
-                        text=f"{int(db)} dB",
-                        showarrow=False,
-                        font=dict(size=18, color=color_scale),
-                        xanchor="right"
-                    )
-            except Exception as e:
-                st.write(f"Error processing dB level {db}: {e}")
-
-        # Add vertical scale bar
-        # if max_value and y_min >= -5 and y_min <= 1:
-        #     scale_bar_length = 2 / max_value
-        #     fig.add_trace(go.Scatter(x=[10.2, 10.2],
-        #                              y=[0, scale_bar_length],
-        #                              mode='lines',
-        #                              line=dict(color='black', width=2),
-        #                              showlegend=False))
-
-        #     fig.add_annotation(
-        #         x=10.3,
-        #         y=scale_bar_length / 2,
-        #         text=f"{2.0:.1f} μV",
-        #         showarrow=False,
-        #         font=dict(size=10, color='black'),
-        #         xanchor="left",
-        #         yanchor="middle"
-        #     )
-
-        fig.update_layout(title=f'{selected_files[idx].split("/")[-1]} - Frequency: {freq} Hz',
+        fig.update_layout(title=f'{recording.name} - Frequency: {freq} Hz',
                           xaxis_title='Time (ms)',
-                          yaxis_title='Voltage (μV)',
+                          yaxis_title=f'Voltage ({settings.amplitude_unit})',
                           width=400,
                           height=700,
                           yaxis=dict(showticklabels=False, showgrid=False, zeroline=False),
@@ -532,428 +363,248 @@ def plot_waves_stacked(freq):
                       font_color="black",
                       title_font_family="Times New Roman",
                       font=dict(size=18))
-        #fig.update_layout(showlegend=False)
-
-        khz = file_df[(file_df['Freq(Hz)'] == freq)]
-        if not khz.empty:
-            fig_list.append(fig)
-    return fig_list
-
-def arfread(PATH, **kwargs):
-    # defaults
-    PLOT = kwargs.get('PLOT', False)
-    RP = kwargs.get('RP', False)
-    
-    isRZ = not RP
-    
-    data = {'RecHead': {}, 'groups': []}
-
-    # open file
-    with open(PATH, 'rb') as fid:
-        # open RecHead data
-        data['RecHead']['ftype'] = struct.unpack('h', fid.read(2))[0]
-        data['RecHead']['ngrps'] = struct.unpack('h', fid.read(2))[0]
-        data['RecHead']['nrecs'] = struct.unpack('h', fid.read(2))[0]
-        data['RecHead']['grpseek'] = struct.unpack('200i', fid.read(4*200))
-        data['RecHead']['recseek'] = struct.unpack('2000i', fid.read(4*2000))
-        data['RecHead']['file_ptr'] = struct.unpack('i', fid.read(4))[0]
-
-        data['groups'] = []
-        bFirstPass = True
-        for x in range(data['RecHead']['ngrps']):
-            # jump to the group location in the file
-            fid.seek(data['RecHead']['grpseek'][x], 0)
-
-            # open the group
-            data['groups'].append({
-                'grpn': struct.unpack('h', fid.read(2))[0],
-                'frecn': struct.unpack('h', fid.read(2))[0],
-                'nrecs': struct.unpack('h', fid.read(2))[0],
-                'ID': get_str(fid.read(16)),
-                'ref1': get_str(fid.read(16)),
-                'ref2': get_str(fid.read(16)),
-                'memo': get_str(fid.read(50)),
-            })
-
-            # read temporary timestamp
-            if bFirstPass:
-                if isRZ:
-                    ttt = struct.unpack('q', fid.read(8))[0]
-                    fid.seek(-8, 1)
-                    data['fileType'] = 'BioSigRZ'
-                else:
-                    ttt = struct.unpack('I', fid.read(4))[0]
-                    fid.seek(-4, 1)
-                    data['fileType'] = 'BioSigRP'
-                #data['fileTime'] = datetime.datetime.utcfromtimestamp(ttt/86400 + datetime.datetime(1970, 1, 1).timestamp()).strftime('%Y-%m-%d %H:%M:%S')
-                bFirstPass = False
-
-            if isRZ:
-                grp_t_format = 'q'
-                beg_t_format = 'q'
-                end_t_format = 'q'
-                read_size = 8
-            else:
-                grp_t_format = 'I'
-                beg_t_format = 'I'
-                end_t_format = 'I'
-                read_size = 4
-
-            data['groups'][x]['beg_t'] = struct.unpack(beg_t_format, fid.read(read_size))[0]
-            data['groups'][x]['end_t'] = struct.unpack(end_t_format, fid.read(read_size))[0]
-
-            data['groups'][x].update({
-                'sgfname1': get_str(fid.read(100)),
-                'sgfname2': get_str(fid.read(100)),
-                'VarName1': get_str(fid.read(15)),
-                'VarName2': get_str(fid.read(15)),
-                'VarName3': get_str(fid.read(15)),
-                'VarName4': get_str(fid.read(15)),
-                'VarName5': get_str(fid.read(15)),
-                'VarName6': get_str(fid.read(15)),
-                'VarName7': get_str(fid.read(15)),
-                'VarName8': get_str(fid.read(15)),
-                'VarName9': get_str(fid.read(15)),
-                'VarName10': get_str(fid.read(15)),
-                'VarUnit1': get_str(fid.read(5)),
-                'VarUnit2': get_str(fid.read(5)),
-                'VarUnit3': get_str(fid.read(5)),
-                'VarUnit4': get_str(fid.read(5)),
-                'VarUnit5': get_str(fid.read(5)),
-                'VarUnit6': get_str(fid.read(5)),
-                'VarUnit7': get_str(fid.read(5)),
-                'VarUnit8': get_str(fid.read(5)),
-                'VarUnit9': get_str(fid.read(5)),
-                'VarUnit10': get_str(fid.read(5)),
-                'SampPer_us': struct.unpack('f', fid.read(4))[0],
-                'cc_t': struct.unpack('i', fid.read(4))[0],
-                'version': struct.unpack('h', fid.read(2))[0],
-                'postproc': struct.unpack('i', fid.read(4))[0],
-                'dump': get_str(fid.read(92)),
-                'recs': [],
-            })
-
-            for i in range(data['groups'][x]['nrecs']):
-                record_data = {
-                        'recn': struct.unpack('h', fid.read(2))[0],
-                        'grpid': struct.unpack('h', fid.read(2))[0],
-                        'grp_t': struct.unpack(grp_t_format, fid.read(read_size))[0],
-                        #'grp_d': datetime.utcfromtimestamp(data['groups'][x]['recs'][i]['grp_t']/86400 + datetime(1970, 1, 1).timestamp()).strftime('%Y-%m-%d %H:%M:%S'),
-                        'newgrp': struct.unpack('h', fid.read(2))[0],
-                        'sgi': struct.unpack('h', fid.read(2))[0],
-                        'chan': struct.unpack('B', fid.read(1))[0],
-                        'rtype': get_str(fid.read(1)),
-                        'npts': struct.unpack('H' if isRZ else 'h', fid.read(2))[0],
-                        'osdel': struct.unpack('f', fid.read(4))[0],
-                        'dur_ms': struct.unpack('f', fid.read(4))[0],
-                        'SampPer_us': struct.unpack('f', fid.read(4))[0],
-                        'artthresh': struct.unpack('f', fid.read(4))[0],
-                        'gain': struct.unpack('f', fid.read(4))[0],
-                        'accouple': struct.unpack('h', fid.read(2))[0],
-                        'navgs': struct.unpack('h', fid.read(2))[0],
-                        'narts': struct.unpack('h', fid.read(2))[0],
-                        'beg_t': struct.unpack(beg_t_format, fid.read(read_size))[0],
-                        'end_t': struct.unpack(end_t_format, fid.read(read_size))[0],
-                        'Var1': struct.unpack('f', fid.read(4))[0],
-                        'Var2': struct.unpack('f', fid.read(4))[0],
-                        'Var3': struct.unpack('f', fid.read(4))[0],
-                        'Var4': struct.unpack('f', fid.read(4))[0],
-                        'Var5': struct.unpack('f', fid.read(4))[0],
-                        'Var6': struct.unpack('f', fid.read(4))[0],
-                        'Var7': struct.unpack('f', fid.read(4))[0],
-                        'Var8': struct.unpack('f', fid.read(4))[0],
-                        'Var9': struct.unpack('f', fid.read(4))[0],
-                        'Var10': struct.unpack('f', fid.read(4))[0],
-                        'data': [] #list(struct.unpack(f'{data["groups"][x]["recs"][i]["npts"]}f', fid.read(4*data['groups'][x]['recs'][i]['npts'])))
-                    }
-                
-                # skip all 10 cursors placeholders
-                fid.seek(36*10, 1)
-                record_data['data'] = list(struct.unpack(f'{record_data["npts"]}f', fid.read(4*record_data['npts'])))
-
-                #record_data['grp_d'] = datetime.datetime.utcfromtimestamp(record_data['grp_t'] / 86400 + datetime.datetime(1970, 1, 1).timestamp()).strftime('%Y-%m-%d %H:%M:%S')
-
-                data['groups'][x]['recs'].append(record_data)
-
-            if PLOT:
-                import matplotlib.pyplot as plt
-
-                # determine reasonable spacing between plots
-                d = [x['data'] for x in data['groups'][x]['recs']]
-                plot_offset = max(max(map(abs, [item for sublist in d for item in sublist]))) * 1.2
-
-                plt.figure()
 
-                for i in range(data['groups'][x]['nrecs']):
-                    plt.plot([item - plot_offset * i for item in data['groups'][x]['recs'][i]['data']])
-                    plt.hold(True)
-
-                plt.title(f'Group {data["groups"][x]["grpn"]}')
-                plt.axis('off')
-                plt.show()
-
-    return data
-
-def get_str(data):
-    # return string up until null character only
-    ind = data.find(b'\x00')
-    if ind > 0:
-        data = data[:ind]
-    return data.decode('utf-8')
-
-def calculate_hearing_threshold(df, freq, baseline_level=100, multiply_y_factor=1):
-    db_column = 'Level(dB)' if level else 'PostAtten(dB)'
-
-    thresholding_model = load_model('models/abr_cnn_aug_norm_std.keras')
-    thresholding_model.steps_per_execution = 1
-    
-    # Filter DataFrame to include only data for the specified frequency
-    df_filtered = df[df['Freq(Hz)'] == freq]
-
-    # Get unique dB levels for the filtered DataFrame
-    db_levels = sorted(df_filtered[db_column].unique(), reverse=True) if db_column == 'Level(dB)' else sorted(df_filtered[db_column].unique())
-    waves = []
-
-    for db in db_levels:
-        khz = df_filtered[df_filtered[db_column] == np.abs(db)]
-        if not khz.empty:
-            index = khz.index.values[-1]
-            final = df_filtered.loc[index, '0':].dropna()
-            final = pd.to_numeric(final, errors='coerce')
-            final = np.array(final, dtype=np.float64)
-            target = int(244 * (time_scale / 10))
-            y_values = interpolate_and_smooth(final, target)
-            final = interpolate_and_smooth(final[:244])
-            final *= multiply_y_factor
-
-            if units == 'Nanovolts':
-                final /= 1000
-
-            waves.append(final)
-    
-    waves = np.array(waves)
-    flattened_data = waves.flatten().reshape(-1, 1)
-    scaler = StandardScaler()
-    standardized_data = scaler.fit_transform(flattened_data)
-
-    # Step 2: Apply min-max scaling
-    min_max_scaler = MinMaxScaler(feature_range=(0, 1))  # Adjust range if needed
-    scaled_data = min_max_scaler.fit_transform(standardized_data).reshape(waves.shape)
-    waves = np.expand_dims(scaled_data, axis=2)
-    
-    # Perform prediction
-    prediction = thresholding_model.predict(waves)
-    y_pred = (prediction > 0.5).astype(int).flatten()
-
-    if db_column == 'PostAtten(dB)':
-        db_levels = np.array(db_levels)
-        calibration_level = np.full(len(db_levels), calibration_levels[(df.name, freq)])
-        db_levels = calibration_level - db_levels
-
-    lowest_db = db_levels[0]
-    previous_prediction = None
-
-
-    for p, d in zip(y_pred, db_levels):
-        if p == 0:
-            if previous_prediction == 0:
-                break
-            previous_prediction = p
-        else:
-            lowest_db = d
-            previous_prediction = p
-
-    return lowest_db
+        fig_list.append(fig)
+    return fig_list, []
 
 def all_thresholds():
-    df_dict = {'Filename': [],
-               'Frequency': [],
-               'Threshold': []}
-    for (file_df, file_name) in zip(selected_dfs, selected_files):
-        for hz in distinct_freqs:
-            thresh = np.nan
-            try:
-                thresh = calculate_hearing_threshold(file_df, hz)
-            except:
-                pass
-            df_dict['Filename'].append(file_name.split("/")[-1])
-            df_dict['Frequency'].append(hz)
-            df_dict['Threshold'].append(thresh)
-    threshold_table = pd.DataFrame(df_dict)
+    rows = []
+    for recording in selected_recordings:
+        rows.extend(threshold_rows(recording, distinct_freqs, settings, inference))
+    threshold_table = pd.DataFrame(rows, columns=THRESHOLD_COLUMNS)
     st.dataframe(threshold_table, hide_index=True, use_container_width=True)
     return threshold_table
 
-def peak_finding(wave):
-    # Prepare waveform
-    waveform = interpolate_and_smooth(wave)
-    
-    waveform_torch = torch.tensor(waveform, dtype=torch.float32).unsqueeze(0).unsqueeze(0)
-    
-    # Get prediction from model
-    outputs = peak_finding_model(waveform_torch)
-    prediction = int(round(outputs.detach().numpy()[0][0], 0))
-
-    # Apply Gaussian smoothing
-    smoothed_waveform = gaussian_filter1d(wave, sigma=1.0)
-
-    # Find peaks and troughs
-    n = 18
-    t = 14
-    start_point = prediction - 6
-    smoothed_peaks, _ = find_peaks(smoothed_waveform[start_point:], distance=n)
-    smoothed_troughs, _ = find_peaks(-smoothed_waveform, distance=t)
-    sorted_indices = np.argsort(smoothed_waveform[smoothed_peaks+start_point])
-    highest_smoothed_peaks = np.sort(smoothed_peaks[sorted_indices[-5:]] + start_point)
-    relevant_troughs = np.array([])
-    for p in range(len(highest_smoothed_peaks)):
-        c = 0
-        for t in smoothed_troughs:
-            if t > highest_smoothed_peaks[p]:
-                if p != 4:
-                    try:
-                        if t < highest_smoothed_peaks[p+1]:
-                            relevant_troughs = np.append(relevant_troughs, int(t))
-                            break
-                    except IndexError:
-                        pass
-                else:
-                    relevant_troughs = np.append(relevant_troughs, int(t))
-                    break
-    relevant_troughs = relevant_troughs.astype('i')
-    return highest_smoothed_peaks, relevant_troughs
-
-def calculate_unsupervised_threshold(df, freq):
-    if level:
-        db_column = 'Level(dB)'
-    else:
-        db_column = 'PostAtten(dB)'
-
-    if len(selected_dfs) == 0:
-        st.write("No files selected.")
-        return
-
-    waves_array = []  # Array to store all waves
-
-    khz = df[(df['Freq(Hz)'] == freq)]
-    db_values = sorted(khz[db_column].unique())
-    for db in db_values:
-        khz = df[(df['Freq(Hz)'] == freq) & (df[db_column] == db)]
-
-        if not khz.empty:
-            index = khz.index.values[-1]
-            final = df.loc[index, '0':].dropna()
-            final = pd.to_numeric(final, errors='coerce')
-
-            if len(final) > 244:
-                new_points = np.linspace(0, len(final), 245)
-                interpolated_values = np.interp(new_points, np.arange(len(final)), final)
-                interpolated_values = pd.Series(interpolated_values)
-                final = np.array(interpolated_values[:244], dtype=float)
-            if len(final) < 244:
-                original_indices = np.arange(len(final))
-                target_indices = np.linspace(0, len(final) - 1, 244)
-                cs = CubicSpline(original_indices, final)
-                smooth_amplitude = cs(target_indices)
-                final = smooth_amplitude
-
-            if multiply_y_factor != 1:
-                y_values = final * multiply_y_factor
-            else:
-                y_values = final
-            
-            if units == 'Nanovolts':
-                y_values /= 1000
-
-            waves_array.append(y_values.tolist())
-    # Filter waves and dB values for the specified frequency
-    waves_fd = FDataGrid(waves_array)
-    fpca_discretized = FPCA(n_components=2)
-    fpca_discretized.fit(waves_fd)
-    projection = fpca_discretized.transform(waves_fd)
-
-    nearest_neighbors = NearestNeighbors(n_neighbors=2)
-    neighbors = nearest_neighbors.fit(projection[:, :2])
-    distances, indices = neighbors.kneighbors(projection[:, :2])
-    distances = np.sort(distances, axis=0)
-    distances = distances[:,1]
-
-    knee_locator = KneeLocator(range(len(distances)), distances, curve='convex', direction='increasing')
-    eps = distances[knee_locator.knee]
-
-    # Apply DBSCAN clustering
-    dbscan = DBSCAN(eps=eps)
-    clusters = dbscan.fit_predict(projection[:, :2])
-
-    # Create DataFrame with projection results and cluster labels
-    dfn = pd.DataFrame(projection[:, :2], columns=['1st_PC', '2nd_PC'])
-    dfn['Cluster'] = clusters
-    dfn['DB_Value'] = db_values
-
-    # Find the minimum hearing threshold value among the outliers
-    min_threshold = np.min(dfn[dfn['Cluster']==-1]['DB_Value'])
-
-    return min_threshold
-
-def plot_io_curve(df, freqs, db_levels, multiply_y_factor=1.0, units='Microvolts'):
-    db_column = 'Level(dB)' if level else 'PostAtten(dB)'
-    
-    amplitudes = {}
-
-    ru = 'μV'
-    if return_units == 'Nanovolts':
-        ru = 'nV'
-
+def plot_io_curve(freqs):
     fig_list = []
-    for file_df, file_name in zip(selected_dfs, selected_files):
+    for recording in selected_recordings:
         for freq in freqs:
-            try:
-                threshold = calculate_hearing_threshold(file_df, freq)
-            except:
-                threshold = np.nan
-                pass
-
-            for db in db_levels:
-                _, y_values, highest_peaks, relevant_troughs = calculate_and_plot_wave(file_df, freq, db, 'blue')
-                    
-                if return_units == 'Nanovolts':
-                    y_values *= 1000
-
-                if highest_peaks is not None:
-                    if highest_peaks.size > 0:  # Check if highest_peaks is not empty
-                        first_peak_amplitude = y_values[highest_peaks[0]] - y_values[relevant_troughs[0]]
-                        if level:
-                            amplitudes[db] = first_peak_amplitude
-                        else:
-                            amplitudes[calibration_levels[(file_df.name, freq)] - int(db)] = first_peak_amplitude
+            db_levels, amplitudes = wave_i_io_curve(recording, freq, settings, inference)
 
             # Plotting
             fig = go.Figure()
-            if level:
-                fig.add_trace(go.Scatter(x=sorted(list(amplitudes.keys())), y=list(amplitudes.values()), mode='lines+markers', name=f'Freq: {freq} Hz'))
-            else:
-                fig.add_trace(go.Scatter(x=np.full(len(db_levels), calibration_levels[(file_df.name, freq)]) - db_levels, y=amplitudes, mode='lines+markers', name=f'Freq: {freq} Hz'))
+            fig.add_trace(go.Scatter(x=db_levels, y=amplitudes, mode='lines+markers', name=f'Freq: {freq} Hz'))
             
-            file_name = file_name.split('/')[-1]
             fig.update_layout(
-                title=f'{file_name} I/O Curve for Frequency {freq} Hz',
+                title=f'{recording.name} I/O Curve for Frequency {freq} Hz',
                 xaxis_title='dB Level',
-                yaxis_title=f'Wave 1 Amplitude ({ru})',
+                yaxis_title=f'Wave 1 Amplitude ({settings.amplitude_unit})',
                 xaxis=dict(tickmode='linear', dtick=5),
-                yaxis=dict(range=[0, max(amplitudes.values()) + 0.1 * abs(max(amplitudes.values()))]),
                 template='plotly_white'
             )
+            if amplitudes.size:
+                fig.update_layout(yaxis=dict(range=[0, amplitudes.max() + 0.1 * abs(amplitudes.max())]))
             fig.update_layout(font_family="Times New Roman",
                             font_color="black",
                             title_font_family="Times New Roman",
                             font=dict(size=24))
 
             fig_list.append(fig)
-    return fig_list
+    return fig_list, []
+
+def plot_cohort_io_curve(recordings, freqs, groups):
+    """Mean ± SEM Wave I I/O curves for every frequency and group in one figure.
+
+    ``groups`` maps a file name to its group label.
+    """
+    ru = 'μV'
+    if settings.return_units == 'Nanovolts':
+        ru = 'nV'
+
+    labels = np.array([groups.get(recording.name, 'All') for recording in recordings])
+    matrices = cohort_wave_i_amplitudes(recordings, freqs, settings, inference)
+    colors = cc.glasbey[:len(freqs) * len(np.unique(labels))]
+
+    fig = go.Figure()
+    c = 0
+    for freq in freqs:
+        db_levels, amplitudes = matrices[freq]
+        for group in np.unique(labels):
+            mean, sem, counts = mean_and_sem(amplitudes[labels == group])
+            shown = ~np.ma.getmaskarray(mean)
+            if not shown.any():
+                continue
+            fig.add_trace(go.Scatter(x=db_levels[shown],
+                                     y=mean.filled(np.nan)[shown],
+                                     error_y=dict(type='data', array=sem.filled(0)[shown], visible=True),
+                                     customdata=np.column_stack([counts[shown], sem.filled(np.nan)[shown]]),
+                                     hovertemplate='%{x} dB: %{y:.3f} ± %{customdata[1]:.3f} (n=%{customdata[0]})',
+                                     mode='lines+markers',
+                                     name=f'{group} - {freq} Hz',
+                                     line=dict(color=colors[c % len(colors)])))
+            c += 1
+
+    fig.update_layout(
+        title=f'Cohort I/O Curve (mean ± SEM, {len(recordings)} files)',
+        xaxis_title='dB Level',
+        yaxis_title=f'Wave 1 Amplitude ({ru})',
+        xaxis=dict(tickmode='linear', dtick=5),
+        template='plotly_white',
+        width=900,
+        height=600,
+        showlegend=show_legend
+    )
+    fig.update_layout(font_family="Times New Roman",
+                      font_color="black",
+                      title_font_family="Times New Roman",
+                      font=dict(size=18))
+    return fig
+
+def analysis_jobs():
+    # Jobs live in session state so they survive reruns and keep running when the browser disconnects
+    return st.session_state.setdefault('analysis_jobs', {})
+
+def start_analysis_job(key, title, task, columns):
+    jobs = analysis_jobs()
+    if key in jobs and jobs[key].running:
+        jobs[key].cancel()
+    jobs[key] = AnalysisJob(title, task, selected_recordings, columns, analysis_slots).start()
+
+def render_analysis_job(key):
+    job = analysis_jobs().get(key)
+    if job is None:
+        return
+
+    st.subheader(job.title)
+    if job.running:
+        text = f'{job.files_done}/{len(job.files)} files'
+        if job.waiting:
+            text += ' (waiting for a free analysis worker)'
+        elif job.current_file:
+            text += f' (analyzing {job.current_file})'
+        st.progress(job.progress, text=text)
+        if st.button("Cancel", key=f'cancel_{key}'):
+            job.cancel()
+    elif job.status == 'cancelled':
+        st.write(f"Cancelled after {job.files_done}/{len(job.files)} files.")
+    elif job.status == 'failed':
+        st.write("Analysis failed.", job.error)
+
+    st.dataframe(job.results(), hide_index=True, use_container_width=True)
+
+    if not job.running:
+        if st.button("Dismiss", key=f'dismiss_{key}'):
+            del analysis_jobs()[key]
+            st.rerun()
+
+def show_analysis_job(key):
+    job = analysis_jobs().get(key)
+    if job is None:
+        return
+    if not job.running:
+        render_analysis_job(key)
+        return
+
+    def poll():
+        render_analysis_job(key)
+        if not analysis_jobs()[key].running:
+            st.rerun()
+
+    st.fragment(poll, run_every=1.0)()
+
+def export_dataset(root):
+    # Waves of the selected files plus whatever the last threshold and peak analyses returned
+    write_recordings(root, selected_recordings)
+    jobs = analysis_jobs()
+    if 'thresholds' in jobs:
+        write_results(root, 'thresholds', jobs['thresholds'].results(), 'Filename')
+    if 'peaks' in jobs:
+        write_results(root, 'metrics', jobs['peaks'].results(), 'File Name')
+
+def uploaded_archive(file):
+    # Parsed once per upload and parsing setting, not on every rerun
+    cache = st.session_state.setdefault('uploaded_archives', {})
+    key = (file.file_id, is_rz_file, click, is_level)
+    METRICS.cache_lookup('uploaded_archives', key in cache)
+    if key not in cache:
+        for stale in [k for k in cache if k[0] == file.file_id]:
+            del cache[stale]
+        cache[key] = load_archive(file.name, file.getvalue(), settings, RUNTIME['threads'])
+    return cache[key]
+
+def load_archive_member(file, member, wave_dtype):
+    # One recording of an uploaded archive, decompressed and parsed again
+    data = next(data for name, data in archive_members(file.name, file.getvalue()) if name == member)
+    return load_recording(os.path.basename(member), data, settings, wave_dtype)
+
+def load_watched(path, wave_dtype):
+    with open(path, 'rb') as f:
+        return load_recording(os.path.basename(path), f.read(), settings, wave_dtype)
+
+def frequency_label(hz):
+    return f'{hz:g} Hz' if isinstance(hz, (int, float, np.number)) else str(hz)
+
+def calibration_editor(file_names, freqs):
+    """Calibration levels of every file and frequency, edited as one table.
+
+    Starts from an imported CSV (per-file rows, else per-frequency defaults,
+    else 0) and keeps earlier edits when the selected files change, so only
+    cells that differ from the import need typing in.
+    """
+    st.sidebar.subheader("Calibration Levels")
+    upload = st.sidebar.file_uploader("Import Calibration Table (CSV)", type=['csv'], key='calibration_csv')
+    table = None
+    if upload is not None:
+        try:
+            table = read_calibration_csv(upload.getvalue())
+        except ValueError as e:
+            st.sidebar.write(e)
+
+    file_names = list(dict.fromkeys(file_names))
+    labels = {frequency_label(hz): hz for hz in freqs}
+    layout = (tuple(file_names), tuple(labels), upload.file_id if upload is not None else None)
+    if st.session_state.get('calibration_layout') != layout:
+        # The editor's starting table only changes with the layout, so edits are not reset on every rerun
+        start = resolve_calibration(table, file_names, freqs)
+        if st.session_state.get('calibration_layout', layout)[2] == layout[2]:
+            start.update((key, value) for key, value in st.session_state.get('calibration_levels', {}).items() if key in start)
+        st.session_state['calibration_layout'] = layout
+        st.session_state['calibration_start'] = pd.DataFrame([[start[(name, hz)] for hz in labels.values()] for name in file_names],
+                                                             index=pd.Index(file_names, name='File'), columns=list(labels))
+        # A new key per layout; the editor would otherwise carry its edits over by row position
+        st.session_state['calibration_editor'] = st.session_state.get('calibration_editor', 0) + 1
+
+    edited = st.sidebar.data_editor(st.session_state['calibration_start'], use_container_width=True,
+                                    key=f"calibration_levels_{st.session_state['calibration_editor']}")
+    levels = {(name, labels[label]): float(value) for (name, label), value in edited.fillna(0.0).stack().items()}
+    st.session_state['calibration_levels'] = levels
+    st.sidebar.download_button("Download Calibration Table", calibration_table(levels).to_csv(index=False),
+                               file_name="calibration_levels.csv", mime="text/csv")
+    return levels
+
+def render_folder_watcher(watcher):
+    st.subheader(f"Watching {watcher.directory}")
+    status = f"{len(watcher.recordings)} recordings, {len(watcher.pending)} waiting for analysis"
+    if watcher.last_poll is not None:
+        status += f" (last checked {watcher.last_poll:%H:%M:%S})"
+    st.write(status)
+    if watcher.pending:
+        st.write("Queue: " + ", ".join(os.path.basename(path) for path in watcher.pending))
+    for name, error in list(watcher.errors.items()):
+        st.write(f"Error with {name}:", error)
+
+    thresholds, metrics = watcher.results(THRESHOLD_COLUMNS, metrics_columns(settings))
+    st.dataframe(thresholds, hide_index=True, use_container_width=True)
+    st.dataframe(metrics, hide_index=True, use_container_width=True)
+
+def show_folder_watcher(watcher):
+    if not watcher.running:
+        render_folder_watcher(watcher)
+        return
+
+    def poll():
+        render_folder_watcher(watcher)
+        if len(watcher.recordings) != known_recordings:
+            # New files also need to appear in the sidebar file list
+            st.rerun()
+
+    known_recordings = len(watcher.recordings)
+    st.fragment(poll, run_every=watcher.interval)()
 
 # Streamlit UI
 st.title("Wave Plotting App")
 st.sidebar.header("Upload File")
-uploaded_files = st.sidebar.file_uploader("Choose a file", type=["csv", "arf"], accept_multiple_files=True)
+uploaded_files = st.sidebar.file_uploader("Choose a file", type=["csv", "arf", "zip", "tar", "gz", "tgz"], accept_multiple_files=True)
 #is_rz_file = st.sidebar.radio("Select ARF File Type:", ("RZ", "RP"))
 is_rz_file = "RZ"
 is_click = st.sidebar.radio("Click or Tone? (for .arf files)", ("Click", "Tone"))
@@ -963,88 +614,220 @@ if is_click == "Click":
 else:
     click = False
 is_level = st.sidebar.radio("Select dB You Are Studying:", ("Level", "Attenuation"))
+# What parsing needs; the analysis settings are filled in once files are loaded
+settings = Settings(level=is_level == 'Level', click=click, rp=is_rz_file == 'RP')
 
 annotations = []
 
-peak_finding_model = CNN()
-model_loader = torch.load('./models/waveI_cnn_model1.pth')
-peak_finding_model.load_state_dict(model_loader)
-peak_finding_model.eval()
+@st.cache_resource
+def inference_engine(address):
+    # One set of models per server process, or a client of the shared worker
+    return connect_inference(address)
+
+@st.cache_resource
+def quantization_engines():
+    # Float and int8 peak finding models side by side, only loaded when someone checks the int8 accuracy
+    return InProcessInference(quantization='float'), InProcessInference(quantization='int8')
+
+@st.cache_data
+def current_model_version(quantization):
+    # Stored results are only reused while both model files, the quantization and the wave dtype are unchanged
+    return model_version((THRESHOLD_MODEL_PATH, PEAK_MODEL_PATH), quantization)
+
+@st.cache_resource
+def figure_cache():
+    # Rendered figures shared by every session; sized by ABRA_FIGURE_CACHE_MB
+    return FigureCache()
+
+def cached_figures(kind, plot, *args, **kwargs):
+    """plot(*args, **kwargs) for the selected files, rebuilt only when their analysis or the plot's options changed.
+
+    Besides the arguments, the key covers the sidebar options the plot
+    functions read directly. plot returns its figures and the messages to
+    show with them; both are cached, so a hit shows the same messages.
+    """
+    style = dict(kwargs, args=args, y_min=y_min, y_max=y_max, show_legend=show_legend, show_peaks=show_peaks,
+                 display_budget=display_budget, alignment_mode=alignment_mode)
+    key = figure_key(kind, selected_recordings, settings, current_model_version(inference.quantization), **style)
+    cached = figure_cache().get(key)
+    if cached is not None:
+        figures, messages, _ = cached
+        fig_list = [pio.from_json(figure) for figure in figures]
+    else:
+        fig_list, messages = plot(*args, **kwargs)
+        figure_cache().put(key, [fig.to_json() for fig in fig_list], messages)
+    for message in messages:
+        st.write(message)
+    return fig_list
+
+inference = inference_engine(os.environ.get('ABRA_INFERENCE_WORKER'))
+st.sidebar.caption(f"Models: {inference.description}")
+
+with st.sidebar.expander("Performance"):
+    st.caption("Thread limits for this server process, shared by all sessions.")
+    st.dataframe(pd.DataFrame(runtime_report(), columns=['Setting', 'Configured', 'Effective']).astype(str),
+                 hide_index=True, use_container_width=True)
+    st.caption("Time spent per stage since the server started.")
+    st.dataframe(pd.DataFrame(METRICS.stage_summary(), columns=['Stage', 'Calls', 'Mean (ms)', 'Total (s)']),
+                 hide_index=True, use_container_width=True)
+    st.dataframe(pd.DataFrame(METRICS.cache_summary(), columns=['Cache', 'Hits', 'Misses', 'Hit Rate']),
+                 hide_index=True, use_container_width=True)
+    st.download_button("Download Metrics", METRICS.prometheus_text(), file_name="abra_metrics.prom", mime='text/plain')
+
+def stop_watchers(watchers):
+    for watcher in watchers:
+        watcher.stop()
+
+@st.cache_resource(scope="session", on_release=stop_watchers)
+def session_watchers():
+    # Every folder watcher this session started; Streamlit releases the list, stopping them, when the session ends
+    return []
+
+with st.sidebar.expander("Watch Folder"):
+    watch_directory = st.text_input("Rig Output Directory")
+    watch_interval = st.number_input("Check Every (s)", value=5.0, min_value=1.0)
+    watcher = st.session_state.get('folder_watcher')
+    if watcher is not None and watcher.running:
+        if st.button("Stop Watching"):
+            watcher.stop()
+    elif st.button("Start Watching"):
+        if os.path.isdir(watch_directory):
+            watcher = st.session_state['folder_watcher'] = FolderWatcher(watch_directory, watch_interval, analysis_slots).start()
+            session_watchers().append(watcher)
+        else:
+            st.write("Directory not found.")
+    if watcher is not None:
+        watcher.configure(load=partial(load_recording, settings=settings), load_key=(settings.click, settings.db_column, settings.rp))
+
+watched_recordings = dict(watcher.recordings) if watcher is not None else {}
 
-if uploaded_files:
-    dfs = []
-    selected_files = []
-    selected_dfs = []
+with st.sidebar.expander("Parquet Dataset"):
+    dataset_directory = st.text_input("Dataset Directory", "abra_dataset")
+    if st.button("Load Dataset"):
+        try:
+            st.session_state['dataset_recordings'] = read_recordings(dataset_directory)
+        except (OSError, ValueError):
+            st.write("No exported waves found in that directory.")
+
+# Exports keep the dB column under the name it had then; the values are the same under either setting
+dataset_recordings = {name: recording.with_db_column(settings.db_column)
+                      for name, recording in st.session_state.get('dataset_recordings', {}).items()}
+
+@st.cache_resource
+def arf_catalog():
+    # Header index of scanned .arf archives, kept in ABRA_CATALOG_DB between sessions
+    return ArfCatalog()
+
+with st.sidebar.expander("ARF Catalog"):
+    catalog_directory = st.text_input("Archive Directory")
+    if st.button("Scan Archive"):
+        if os.path.isdir(catalog_directory):
+            st.session_state['arf_catalog'] = arf_catalog().scan(catalog_directory, settings.rp, RUNTIME['threads'])
+        else:
+            st.write("Directory not found.")
+    catalog = st.session_state.get('arf_catalog')
+    if catalog is not None:
+        # Only headers have been read so far; samples are loaded for the filtered series alone
+        series = catalog_series(catalog, click)
+        subjects = st.multiselect("Subjects", sorted(series['Subject'].unique()))
+        catalog_freqs = st.multiselect("Frequencies (Hz)", sorted(series['Freq(Hz)'].unique()))
+        catalog_dbs = st.multiselect("dB", sorted(series['dB'].unique()))
+        if subjects:
+            series = series[series['Subject'].isin(subjects)]
+        if catalog_freqs:
+            series = series[series['Freq(Hz)'].isin(catalog_freqs)]
+        if catalog_dbs:
+            series = series[series['dB'].isin(catalog_dbs)]
+        st.dataframe(series.groupby(['File', 'Subject'], sort=False)
+                           .agg(Frequencies=('Freq(Hz)', lambda freqs: ', '.join(str(freq) for freq in sorted(freqs.unique()))),
+                                Waves=('dB', 'size'))
+                           .reset_index(),
+                     hide_index=True, use_container_width=True)
+        if st.button("Load Selected Series"):
+            st.session_state['catalog_selection'] = dict(list(series.groupby('Path', sort=False)))
+            st.session_state.pop('catalog_recordings', None)
+
+def catalog_recordings_loaded():
+    # Samples of the selected series are read once per selection and parsing setting, as for uploaded archives
+    key = (settings.click, settings.db_column)
+    loaded = st.session_state.get('catalog_recordings')
+    METRICS.cache_lookup('catalog_series', loaded is not None and loaded[0] == key)
+    if loaded is None or loaded[0] != key:
+        selection = st.session_state.get('catalog_selection', {})
+        loaded = st.session_state['catalog_recordings'] = (key, {path: load_series(path, records, settings)
+                                                                 for path, records in selection.items()})
+    return loaded[1]
+
+catalog_recordings = catalog_recordings_loaded() if 'catalog_selection' in st.session_state else {}
+
+if uploaded_files or watched_recordings or dataset_recordings or catalog_recordings:
+    recordings = []
+    selected_recordings = []
     calibration_levels = {}
+    # Parses each recording's source again in another wave dtype, by id(recording); exported datasets have none
+    reparse = {}
 
     
     st.sidebar.write("Select files to analyze:")
+    uploaded_ids = {file.file_id for file in uploaded_files}
+    st.session_state['uploaded_archives'] = {key: recordings for key, recordings in st.session_state.get('uploaded_archives', {}).items()
+                                             if key[0] in uploaded_ids}
     for idx, file in enumerate(uploaded_files):
-        # Use tempfile
-        temp_file_path = os.path.join(tempfile.gettempdir(), file.name)
-        with open(temp_file_path, 'wb') as temp_file:
-            temp_file.write(file.read())
+        if is_archive(file.name):
+            try:
+                members = uploaded_archive(file)
+            except ValueError as e:
+                # A corrupt archive, or one holding a CSV read_abr_csv rejects, is skipped like a bad upload
+                st.error(f"Could not read {file.name}: {e}")
+                continue
+            # Every recording in the archive gets its own checkbox
+            for member, recording in members.items():
+                if st.sidebar.checkbox(f"{member} ({file.name})", key=f"file_{idx}_{member}"):
+                    selected_recordings.append(recording)
+                recordings.append(recording)
+                reparse[id(recording)] = partial(load_archive_member, file, member)
+            continue
+
+        try:
+            recording = load_recording(file.name, file.getvalue(), settings)
+        except ValueError as e:
+            # A bad upload (a plain .gz, an unrecognised CSV export) is skipped, not the whole page
+            st.error(f"Could not read {file.name}: {e}")
+            continue
+
         #st.sidebar.markdown(f"**File Name:** {file.name}")
         selected = st.sidebar.checkbox(f"{file.name}", key=f"file_{idx}")
-        
+        reparse[id(recording)] = partial(load_recording, file.name, file.getvalue(), settings)
+            
+        # Append recording to list
+        recordings.append(recording)
         if selected:
-            selected_files.append(temp_file_path)
+            selected_recordings.append(recording)
 
-        if file.name.endswith(".arf"):
-        # Read ARF file
-            if is_rz_file == 'RP':
-                data = arfread(temp_file.name, RP=True) 
-            else:
-                data = arfread(temp_file.name) 
-            
-            # Process ARF data
-            rows = []
-            freqs = []
-            dbs = []
-
-            for group in data['groups']:
-                for rec in group['recs']:
-                    # Extract data
-                    if not click:
-                        freq = rec['Var1']
-                        db = rec['Var2']
-                    else:
-                        freq = 'Click'
-                        db = rec['Var1']
-                    
-                    # Construct row  
-                    wave_cols = list(enumerate(rec['data']))
-                    wave_data = {f'{i}':v*1e6 for i, v in wave_cols} 
-                    
-                    if is_level == 'Level':
-                        row = {'Freq(Hz)': freq, 'Level(dB)': db, **wave_data}
-                        rows.append(row)
-                    if is_level == 'Attenuation':
-                        row = {'Freq(Hz)': freq, 'PostAtten(dB)': db, **wave_data}
-                        rows.append(row)
-
-            df = pd.DataFrame(rows)
-
-        elif file.name.endswith(".csv"):
-            # Process CSV
-            if pd.read_csv(temp_file_path).shape[1] > 1:
-                df = pd.read_csv(temp_file_path)
-            else:
-                df = pd.read_csv(temp_file_path, skiprows=2)
-            
-        # Append df to list
-        df.name = file.name
-        dfs.append(df)
-        if temp_file_path in selected_files:
-            selected_dfs.append(df)
+    for path, recording in watched_recordings.items():
+        if st.sidebar.checkbox(f"{recording.name} (watched)", key=f"watched_{path}"):
+            selected_recordings.append(recording)
+        recordings.append(recording)
+        reparse[id(recording)] = partial(load_watched, path)
+
+    for name, recording in dataset_recordings.items():
+        if st.sidebar.checkbox(f"{name} (dataset)", key=f"dataset_{name}"):
+            selected_recordings.append(recording)
+        recordings.append(recording)
+
+    for path, recording in catalog_recordings.items():
+        if st.sidebar.checkbox(f"{recording.name} (catalog)", key=f"catalog_{path}"):
+            selected_recordings.append(recording)
+        recordings.append(recording)
+        reparse[id(recording)] = partial(load_series, path, st.session_state['catalog_selection'][path], settings)
 
     level = (is_level == 'Level')
 
     db_column = 'Level(dB)' if level else 'PostAtten(dB)'
 
     # Get distinct frequency and dB level values across all files
-    distinct_freqs = sorted(pd.concat([df['Freq(Hz)'] for df in dfs]).unique())
-    distinct_dbs = sorted(pd.concat([df['Level(dB)'] if level else df['PostAtten(dB)'] for df in dfs]).unique())
+    distinct_freqs = sorted(pd.concat([recording.data['Freq(Hz)'] for recording in recordings]).unique())
+    distinct_dbs = sorted(pd.concat([recording.data[db_column] for recording in recordings]).unique())
 
     time_scale = st.sidebar.number_input("Time Scale for Recording (ms)", value=10.0)
     
@@ -1076,24 +859,25 @@ if uploaded_files:
     baseline_level = float(baseline_level_str)
 
     plot_time_warped = st.sidebar.checkbox("Plot Time Warped Curves", False)
+    alignment_mode = st.sidebar.selectbox("Time Warp Alignment", ALIGNMENT_MODES, index=0)
     show_legend = st.sidebar.checkbox("Show Legend", True)
     show_peaks = st.sidebar.checkbox("Show Peaks (For Plotting At Single Frequency or Plotting Single Wave)", True)
+    display_budget = int(st.sidebar.number_input("Max Plotted Points per Wave (0 = all)", value=1000, min_value=0, step=100))
+    use_results_store = st.sidebar.checkbox("Reuse Stored Results for Unchanged Files", True)
+    threshold_cascade = st.sidebar.checkbox("Pre-screen Levels Before Threshold CNN", False)
 
     if not level:
-        st.sidebar.subheader("Calibration Levels")
-        for file in selected_files:
-            for hz in distinct_freqs:
-                key = (os.path.basename(file), hz)
-                calibration_levels[key] = st.sidebar.number_input(f"Calibration Level for {os.path.basename(file)} at {hz} Hz", value=0.0)
+        calibration_levels = calibration_editor([recording.name for recording in selected_recordings], distinct_freqs)
+
+    settings = replace(settings, units=units, return_units=return_units, time_scale=time_scale, multiply_y_factor=multiply_y_factor,
+                       calibration_levels=calibration_levels, threshold_cascade=threshold_cascade)
+    results_store = ResultsStore(current_model_version(inference.quantization)) if use_results_store else None
 
     # Create a plotly figure
     fig = go.Figure()
     
     if st.sidebar.button("Plot Waves at Single Frequency"):
-        if plot_time_warped:
-            fig_list = plot_waves_single_frequency(df, freq, y_min, y_max, plot_time_warped=True)
-        else:
-            fig_list = plot_waves_single_frequency(df, freq, y_min, y_max, plot_time_warped=False)
+        fig_list = cached_figures('single_frequency', plot_waves_single_frequency, freq, y_min, y_max, plot_time_warped=plot_time_warped)
         for i in range(len(fig_list)):
             st.plotly_chart(fig_list[i])
         
@@ -1110,12 +894,12 @@ if uploaded_files:
                 mime="application/pdf",
                 key=f'file{i}'
             )
-        display_metrics_table_all_db(selected_dfs, [freq], distinct_dbs, baseline_level)
+        display_metrics_table_all_db(selected_recordings, [freq], distinct_dbs, baseline_level)
 
     if st.sidebar.button("Plot Single Wave (Frequency, dB)"):
         fig = plot_waves_single_tuple(freq, db, y_min, y_max)
         st.plotly_chart(fig)
-        display_metrics_table_all_db(selected_dfs, [freq], [db], baseline_level)
+        display_metrics_table_all_db(selected_recordings, [freq], [db], baseline_level)
         # Create an in-memory buffer
         buffer = io.BytesIO()
 
@@ -1131,7 +915,7 @@ if uploaded_files:
         )
     
     if st.sidebar.button("Plot Stacked Waves at Single Frequency"):
-        fig_list = plot_waves_stacked(freq)
+        fig_list = cached_figures('stacked', plot_waves_stacked, freq)
         for i in range(len(fig_list)):
             st.plotly_chart(fig_list[i])
         
@@ -1155,7 +939,7 @@ if uploaded_files:
     #    st.plotly_chart(fig)
 
     if st.sidebar.button("Plot 3D Surface"):
-        fig_list = plot_3d_surface(df, freq, y_min, y_max)
+        fig_list = cached_figures('3d_surface', plot_3d_surface, freq, y_min, y_max)
         for i in range(len(fig_list)):
             st.plotly_chart(fig_list[i])
         
@@ -1174,7 +958,7 @@ if uploaded_files:
             )
 
     if st.sidebar.button("Plot I/O Curve"):
-        fig_list = plot_io_curve(df, [freq], distinct_dbs)
+        fig_list = cached_figures('io_curve', plot_io_curve, [freq])
         
         for i in range(len(fig_list)):
             st.plotly_chart(fig_list[i])
@@ -1193,11 +977,89 @@ if uploaded_files:
                 key=f'file{i}'
             )
     
+    with st.sidebar.expander("Cohort Groups"):
+        # Groups are remembered per file name; the editor's starting table only changes with the
+        # selection, so its row-position edits never carry over to other files
+        group_names = st.session_state.setdefault('cohort_group_names', {})
+        group_files = tuple(dict.fromkeys(recording.name for recording in selected_recordings))
+        if st.session_state.get('cohort_group_files') != group_files:
+            st.session_state['cohort_group_files'] = group_files
+            st.session_state['cohort_group_start'] = pd.DataFrame({'File': list(group_files),
+                                                                   'Group': [group_names.get(name, 'All') for name in group_files]})
+            st.session_state['cohort_group_editor'] = st.session_state.get('cohort_group_editor', 0) + 1
+        group_table = st.data_editor(st.session_state['cohort_group_start'], hide_index=True, disabled=['File'],
+                                     key=f"cohort_groups_{st.session_state['cohort_group_editor']}")
+    cohort_groups = dict(zip(group_table['File'], group_table['Group'].fillna('All').astype(str)))
+    group_names.update(cohort_groups)
+
+    if st.sidebar.button("Plot Cohort I/O Curve"):
+        fig = plot_cohort_io_curve(selected_recordings, distinct_freqs, cohort_groups)
+        st.plotly_chart(fig)
+
+        buffer = io.BytesIO()
+        fig.write_image(file=buffer, format="pdf")
+        st.download_button(
+            label="Download PDF",
+            data=buffer,
+            file_name="cohort_io_curve.pdf",
+            mime="application/pdf",
+            key='cohort_io_pdf'
+        )
+
+    if st.sidebar.button("Check float32 Accuracy"):
+        loaders = [reparse[id(recording)] for recording in selected_recordings if id(recording) in reparse]
+        if len(loaders) < len(selected_recordings):
+            st.write("Exported dataset recordings are left out: their original files aren't available to parse in float64.")
+        st.dataframe(dtype_accuracy_report(loaders, [freq], settings, inference), hide_index=True, use_container_width=True)
+
+    if st.sidebar.button("Check int8 Accuracy"):
+        report = quantization_accuracy_report(selected_recordings, distinct_freqs, settings, *quantization_engines())
+        matched, total = report['Onsets Match'].str.split('/', expand=True).astype(int).sum() if len(report) else (0, 0)
+        agreement = matched / total if total else np.nan
+        st.write(f"int8 peak finding agrees with float on {agreement:.0%} of Wave I onsets; thresholds always use the float model.")
+        st.dataframe(report, hide_index=True, use_container_width=True)
+
+    if st.sidebar.button("Check Pre-screen Agreement"):
+        report, agreement = cascade_agreement_report(selected_recordings, distinct_freqs, settings, inference)
+        st.write(f"Pre-screen agrees with CNN-only on {agreement:.0%} of thresholds.")
+        st.dataframe(report, hide_index=True, use_container_width=True)
+
+    uncertainty_passes = int(st.sidebar.number_input("Dropout Passes for Uncertainty", value=30, min_value=2))
+    if st.sidebar.button("Check Prediction Uncertainty"):
+        report = uncertainty_report(selected_recordings, distinct_freqs, settings, inference, uncertainty_passes)
+        failed = int((report['Threshold 95% CI'] == 'failed').sum())
+        if failed:
+            st.error(f"{failed} series could not be analysed (details in the server log); they are flagged for review.")
+        st.write(f"{int(report['Review'].sum())} of {len(report)} series flagged for review "
+                 f"(threshold CI of {REVIEW_THRESHOLD_CI_DB} dB or more, or Wave I onset SD of {REVIEW_ONSET_SD_MS} ms or more).")
+        st.dataframe(report, hide_index=True, use_container_width=True)
+
     if st.sidebar.button("Return All Thresholds"):
-        all_thresholds()
+        start_analysis_job('thresholds', "All Thresholds",
+                           partial(results_store.threshold_rows if results_store else threshold_rows,
+                                   freqs=distinct_freqs, settings=settings, engine=inference),
+                           THRESHOLD_COLUMNS)
     
     if st.sidebar.button("Return All Peak Analyses"):
-        display_metrics_table_all_db(selected_dfs, distinct_freqs, distinct_dbs, baseline_level)
+        start_analysis_job('peaks', "All Peak Analyses",
+                           partial(results_store.metrics_rows if results_store else metrics_rows,
+                                   freqs=distinct_freqs, db_levels=distinct_dbs, settings=settings, engine=inference),
+                           metrics_columns(settings))
+
+    if st.sidebar.button("Export Selected to Parquet"):
+        export_dataset(dataset_directory)
+        st.sidebar.download_button("Download Dataset", zip_directory(dataset_directory),
+                                   file_name=f"{os.path.basename(os.path.abspath(dataset_directory))}.zip", mime='application/zip')
+
+    show_analysis_job('thresholds')
+    show_analysis_job('peaks')
+
+    if watcher is not None:
+        watcher.configure(analyze=partial(analyze_recording, settings=settings, engine=inference, store=results_store),
+                          analyze_key=(settings, current_model_version(inference.quantization)))
+
+if watcher is not None:
+    show_folder_watcher(watcher)
     
     #if st.sidebar.button("Plot Waves with Gaussian Smoothing"):
     #    fig_gauss = plotting_waves_gauss(dfs, freq, db)
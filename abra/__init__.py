@@ -0,0 +1,23 @@
+"""ABR analysis without Streamlit.
+
+Every function takes the recording, the analysis ``Settings`` and, where a
+model is needed, an inference engine (``abra_inference.connect_inference``)
+explicitly, so calls from different sessions or threads never share state.
+The Streamlit app in ABRA_v1.0.0.py is one client of this package; Parquet
+interchange lives in ``abra.export``.
+"""
+from .calibration import CALIBRATION_COLUMNS, read_calibration_csv, resolve_calibration, calibration_table
+from .catalog import CATALOG_DB_PATH, ArfCatalog, scan_arf, catalog_series, load_series
+from .figures import FIGURE_CACHE_BYTES, FigureCache, figure_key
+from .io import RECORDING_EXTENSIONS, ARCHIVE_EXTENSIONS, arfread, arf_to_df, read_abr_csv, file_content_hash, load_recording, is_archive, archive_members, load_archive
+from .jobs import AnalysisJob, FolderWatcher
+from .peaks import peak_finding, wave_i_metrics, wave_i_metrics_table, wave_i_io_curve, cohort_wave_i_amplitudes, mean_and_sem
+from .preprocessing import interpolate_and_smooth, scale_waves, display_wave, prepare_wave, stacked_waves, lttb_indices, display_points
+from .recording import WAVE_DTYPE, DB_COLUMNS, Recording, wave_frame
+from .reports import cascade_agreement_report, dtype_accuracy_report, quantization_accuracy_report
+from .settings import Settings
+from .store import ANALYSIS_VERSION, RESULTS_DB_PATH, ResultsStore, model_version
+from .tables import THRESHOLD_COLUMNS, metrics_columns, threshold_rows, metrics_table, metrics_rows, analyze_recording
+from .thresholds import threshold_waves, calculate_hearing_threshold, calculate_unsupervised_threshold
+from .uncertainty import REVIEW_THRESHOLD_CI_DB, REVIEW_ONSET_SD_MS, dropout_samples, prediction_uncertainty, uncertainty_report
+from .warping import ALIGNMENT_MODES, alignment_quality, align_waves, align_waves_with_summary
@@ -0,0 +1,74 @@
+import pandas as pd
+
+from .io import open_source
+
+# Calibration levels for attenuation recordings as one long table of (file, frequency,
+# level) rows. Rows without a file give the default for their frequency, so a lab can
+# keep one CSV per speaker calibration and only list the files that differ:
+#
+#     File,Freq(Hz),Calibration Level (dB)
+#     ,8000,105
+#     ,16000,98
+#     mouse12.arf,16000,96
+
+CALIBRATION_COLUMNS = ['File', 'Freq(Hz)', 'Calibration Level (dB)']
+COLUMN_ALIASES = {
+    'File': ('file', 'file name', 'filename'),
+    'Freq(Hz)': ('freq(hz)', 'frequency (hz)', 'frequency', 'freq', 'hz'),
+    'Calibration Level (dB)': ('calibration level (db)', 'calibration level', 'calibration', 'level'),
+}
+
+def frequency_keys(values):
+    # Frequencies as recordings hold them: floats, or strings such as 'Click'
+    values = pd.Series(values, dtype=object)
+    numbers = pd.to_numeric(values, errors='coerce')
+    return numbers.astype(object).where(numbers.notna(), values.astype(str).str.strip())
+
+def read_calibration_csv(source):
+    """Reads a calibration CSV (path or bytes) into a CALIBRATION_COLUMNS table.
+
+    Column names are matched case-insensitively against COLUMN_ALIASES; the
+    file column is optional and empty file cells mean "every file".
+    """
+    with open_source(source) as f:
+        table = pd.read_csv(f, dtype=str, keep_default_na=False, skipinitialspace=True)
+    names = {column.strip().lower(): column for column in table.columns}
+    columns = {}
+    for canonical, aliases in COLUMN_ALIASES.items():
+        found = next((names[alias] for alias in aliases if alias in names), None)
+        if found is None and canonical != 'File':
+            raise ValueError(f"Calibration table needs a '{canonical}' column, found {list(table.columns)}")
+        columns[canonical] = table[found].str.strip() if found is not None else ''
+
+    levels = pd.to_numeric(columns['Calibration Level (dB)'], errors='coerce')
+    if levels.isna().any():
+        raise ValueError('Calibration table has empty or non-numeric levels')
+    return pd.DataFrame({'File': columns['File'],
+                         'Freq(Hz)': frequency_keys(columns['Freq(Hz)']).to_numpy(),
+                         'Calibration Level (dB)': levels.astype(float).to_numpy()}, columns=CALIBRATION_COLUMNS)
+
+def resolve_calibration(table, file_names, freqs, default=0.0):
+    """Calibration level of every (file, freq) as the {(file, freq): level} dict Settings takes.
+
+    A file's own row wins over its frequency's default, which wins over
+    default. Later rows win over earlier duplicates.
+    """
+    level = 'Calibration Level (dB)'
+    grid = pd.MultiIndex.from_product([list(dict.fromkeys(file_names)), list(freqs)], names=['File', 'Freq(Hz)']).to_frame(index=False)
+    if grid.empty:
+        return {}
+    grid['Freq(Hz)'] = grid['Freq(Hz)'].astype(object)
+    if table is None or table.empty:
+        return dict.fromkeys(zip(grid['File'], grid['Freq(Hz)']), float(default))
+
+    table = table.assign(**{'Freq(Hz)': table['Freq(Hz)'].astype(object)})
+    per_file = table[table['File'] != ''].drop_duplicates(['File', 'Freq(Hz)'], keep='last')
+    per_freq = table[table['File'] == ''].drop_duplicates('Freq(Hz)', keep='last').set_index('Freq(Hz)')[level]
+    levels = grid.merge(per_file, on=['File', 'Freq(Hz)'], how='left')[level]
+    levels = levels.fillna(grid['Freq(Hz)'].map(per_freq)).fillna(default).astype(float)
+    return dict(zip(zip(grid['File'], grid['Freq(Hz)']), levels))
+
+def calibration_table(calibration_levels):
+    # The {(file, freq): level} dict as a CALIBRATION_COLUMNS table, e.g. to save as CSV
+    rows = [(name, freq, level) for (name, freq), level in calibration_levels.items()]
+    return pd.DataFrame(rows, columns=CALIBRATION_COLUMNS)
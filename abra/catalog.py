@@ -0,0 +1,167 @@
+import datetime
+import hashlib
+import io
+import os
+import sqlite3
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+
+from .io import arf_to_df, get_str
+from .metrics import METRICS
+from .recording import WAVE_DTYPE, Recording
+
+# Header-only index of .arf files, for archives too large to parse before browsing.
+#
+# scan_arf reads the RecHead, each group header and each record header, jumping
+# between them with the grpseek/recseek offsets, and never reads the samples. An
+# ArfCatalog keeps those rows in SQLite, so a directory is only rescanned for files
+# whose size or modification time changed. load_series then reads the samples of
+# just the records a user picked into an ordinary Recording.
+
+CATALOG_DB_PATH = os.environ.get('ABRA_CATALOG_DB', 'abra_catalog.sqlite')
+
+REC_HEAD = struct.Struct('<3h200i2000i')
+# grpn, frecn, nrecs and the subject ID that start a group header, and the header sizes for RZ and RP files
+GROUP_START = struct.Struct('<3h16s')
+GROUP_HEADER_BYTES = {False: 626, True: 618}
+# recn, grpid, grp_t, newgrp, sgi, chan, rtype, npts, osdel, dur_ms, SampPer_us, artthresh, gain,
+# accouple, navgs, narts, beg_t, end_t, Var1..Var10; then 10 cursors of 36 bytes before the samples
+RECORD_HEADER = {False: struct.Struct('<hhqhhBcH5f3hqq10f'), True: struct.Struct('<hhIhhBch5f3hII10f')}
+CURSOR_BYTES = 36 * 10
+
+CATALOG_COLUMNS = ['File', 'Path', 'Subject', 'Group', 'Record', 'Chan', 'Var1', 'Var2',
+                   'npts', 'SampPer_us', 'navgs', 'narts', 'Offset']
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, rp INTEGER, scanned TEXT
+);
+CREATE TABLE IF NOT EXISTS records (
+    path TEXT, subject TEXT, grp INTEGER, rec INTEGER, chan INTEGER, var1 REAL, var2 REAL,
+    npts INTEGER, samp_per_us REAL, navgs INTEGER, narts INTEGER, data_offset INTEGER,
+    PRIMARY KEY (path, grp, rec)
+);
+"""
+
+def open_headers(source):
+    # Unbuffered for paths, so seeking past the samples really skips reading them
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    return open(source, 'rb', buffering=0)
+
+def scan_arf(source, rp=False):
+    """(subject, group, record, chan, Var1, Var2, npts, SampPer_us, navgs, narts, data offset) of every record.
+
+    source is a path or the file's bytes. Record headers are found through
+    recseek where it has an entry, otherwise right after the previous
+    record's samples, as arfread reads them.
+    """
+    record_header = RECORD_HEADER[rp]
+    rows = []
+    with open_headers(source) as fid:
+        _, ngrps, _, *seeks = REC_HEAD.unpack(fid.read(REC_HEAD.size))
+        grpseek, recseek = seeks[:200], seeks[200:]
+        k = 0
+        for x in range(ngrps):
+            fid.seek(grpseek[x])
+            grpn, _, nrecs, subject = GROUP_START.unpack(fid.read(GROUP_START.size))
+            position = grpseek[x] + GROUP_HEADER_BYTES[rp]
+            for i in range(nrecs):
+                if k < len(recseek) and recseek[k] > 0:
+                    position = recseek[k]
+                fid.seek(position)
+                header = record_header.unpack(fid.read(record_header.size))
+                chan, npts, samp_per_us, navgs, narts = header[5], header[7], header[10], header[14], header[15]
+                var1, var2 = header[18], header[19]
+                offset = position + record_header.size + CURSOR_BYTES
+                rows.append((get_str(subject), grpn, i, chan, var1, var2, npts, samp_per_us, navgs, narts, offset))
+                position = offset + 4 * npts
+                k += 1
+    return rows
+
+def catalog_series(catalog, click):
+    # The catalog with the 'Freq(Hz)' and 'dB' each record is analysed under, as arf_to_df assigns them
+    if click:
+        return catalog.assign(**{'Freq(Hz)': 'Click', 'dB': catalog['Var1']})
+    return catalog.assign(**{'Freq(Hz)': catalog['Var1'], 'dB': catalog['Var2']})
+
+def load_series(source, records, settings, name=None, wave_dtype=WAVE_DTYPE):
+    """Recording of only the given catalog rows of one .arf file, reading just their samples.
+
+    The content hash covers the samples and series read, so results stored
+    for one selection are never reused for another.
+    """
+    recs = []
+    digest = hashlib.sha256()
+    with open_headers(source) as fid:
+        for row in records.itertuples(index=False):
+            fid.seek(row.Offset)
+            payload = fid.read(4 * row.npts)
+            digest.update(struct.pack('<2f', row.Var1, row.Var2) + payload)
+            recs.append({'Var1': row.Var1, 'Var2': row.Var2, 'chan': row.Chan, 'data': np.frombuffer(payload, dtype=np.float32)})
+    if name is None:
+        name = os.path.basename(source)
+    df = arf_to_df({'groups': [{'recs': recs}]}, settings.click, settings.db_column, wave_dtype)
+    return Recording(name, df, digest.hexdigest())
+
+class ArfCatalog:
+    """SQLite index of the record headers of every .arf file under a directory.
+
+    Connections are opened per call, as in ResultsStore, so scans can run on
+    other threads than the one reading the catalog.
+    """
+    def __init__(self, path=CATALOG_DB_PATH):
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            conn.executescript(CATALOG_SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def scan(self, directory, rp=False, workers=None):
+        """Indexes new and changed .arf files under directory and returns its catalog.
+
+        Rows of files that have gone from the directory are removed.
+        """
+        directory = os.path.abspath(directory)
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(directory)
+                       for name in names if name.lower().endswith('.arf'))
+        with closing(self._connect()) as conn:
+            known = {path: (size, mtime_ns, bool(file_rp)) for path, size, mtime_ns, file_rp in
+                     conn.execute('SELECT path, size, mtime_ns, rp FROM files')}
+        stats = {path: os.stat(path) for path in paths}
+        changed = [path for path in paths if known.get(path) != (stats[path].st_size, stats[path].st_mtime_ns, rp)]
+        for path in paths:
+            METRICS.cache_lookup('arf_catalog', path not in changed)
+
+        with METRICS.time('catalog_scan'), ThreadPoolExecutor(max_workers=workers) as pool:
+            scanned = dict(zip(changed, pool.map(lambda path: scan_arf(path, rp), changed)))
+
+        prefix = os.path.join(directory, '')
+        gone = [path for path in known if path.startswith(prefix) and path not in stats]
+        with closing(self._connect()) as conn, conn:
+            for path in gone + changed:
+                conn.execute('DELETE FROM records WHERE path=?', (path,))
+                conn.execute('DELETE FROM files WHERE path=?', (path,))
+            for path, rows in scanned.items():
+                conn.executemany('INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [(path, *row) for row in rows])
+                conn.execute('INSERT INTO files VALUES (?, ?, ?, ?, ?)',
+                             (path, stats[path].st_size, stats[path].st_mtime_ns, int(rp), datetime.datetime.now().isoformat()))
+        return self.catalog(paths)
+
+    def catalog(self, paths):
+        # CATALOG_COLUMNS rows of the given files, in file and record order
+        with closing(self._connect()) as conn:
+            conn.execute('CREATE TEMP TABLE wanted (path TEXT PRIMARY KEY)')
+            conn.executemany('INSERT INTO wanted VALUES (?)', [(path,) for path in paths])
+            rows = conn.execute('SELECT r.path, subject, grp, rec, chan, var1, var2, npts, samp_per_us, navgs, narts, data_offset '
+                                'FROM records r JOIN wanted USING (path) ORDER BY r.path, grp, rec').fetchall()
+        catalog = pd.DataFrame(rows, columns=CATALOG_COLUMNS[1:])
+        catalog.insert(0, 'File', catalog['Path'].map(os.path.basename))
+        return catalog
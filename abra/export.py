@@ -0,0 +1,108 @@
+import io
+import os
+import zipfile
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from .metrics import METRICS
+from .recording import Recording, wave_frame
+
+# Parquet interchange format for ABRA recordings and results, readable from notebooks:
+#
+#     <root>/waves/file=<name>/freq=<Hz or Click>/*.parquet
+#         metadata columns (Level(dB) or PostAtten(dB), Chan, content_hash) and a
+#         fixed-size list column 'wave' holding the samples in their stored dtype
+#     <root>/thresholds/Filename=<name>/*.parquet
+#     <root>/metrics/File Name=<name>/*.parquet
+#
+# read_recordings turns the waves back into Recordings.
+
+WAVES = 'waves'
+# Partition values are always read back as strings, so a file called '55' stays '55'
+WAVE_PARTITIONING = ds.partitioning(pa.schema([('file', pa.string()), ('freq', pa.string())]), flavor='hive')
+
+def split_recording(df):
+    # (metadata frame, samples matrix) of a recording's data
+    samples = df.loc[:, '0':]
+    metadata = df[[column for column in df.columns if column not in samples.columns]]
+    return metadata, samples.to_numpy()
+
+def waves_table(recording):
+    """Arrow table of one recording, with the samples as a fixed-size list column.
+
+    The list values are built from the samples matrix directly, without a copy
+    when it is already C-contiguous.
+    """
+    df = recording.data
+    metadata, waves = split_recording(df)
+    waves = np.ascontiguousarray(waves)
+    values = pa.array(waves.reshape(-1))
+    table = pa.Table.from_pandas(metadata.drop(columns=['Freq(Hz)']), preserve_index=False)
+    table = table.append_column('wave', pa.FixedSizeListArray.from_arrays(values, waves.shape[1]))
+    table = table.append_column('content_hash', pa.array([recording.content_hash] * len(df), pa.string()))
+    table = table.append_column('file', pa.array([recording.name] * len(df), pa.string()))
+    return table.append_column('freq', pa.array(metadata['Freq(Hz)'].astype(str), pa.string()))
+
+def write_recordings(root, recordings):
+    # Replaces any earlier export of the same (file, freq) partitions
+    for recording in recordings:
+        with METRICS.time('export', table=WAVES):
+            pq.write_to_dataset(waves_table(recording), os.path.join(root, WAVES), partition_cols=['file', 'freq'],
+                                existing_data_behavior='delete_matching')
+
+def write_results(root, name, results, file_column):
+    # Frequencies are 'Click' for click recordings, so mixed columns are stored as text
+    results = results.astype({column: str for column in results.columns if results[column].dtype == object})
+    if len(results):
+        with METRICS.time('export', table=name):
+            pq.write_to_dataset(pa.Table.from_pandas(results, preserve_index=False), os.path.join(root, name),
+                                partition_cols=[file_column], existing_data_behavior='delete_matching')
+
+def parse_freq(value):
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+def read_recordings(root, files=None, freqs=None):
+    """Recordings written by write_recordings, as {file name: Recording}.
+
+    files and freqs restrict what is read to those partitions.
+    """
+    filters = []
+    if files is not None:
+        filters.append(('file', 'in', list(files)))
+    if freqs is not None:
+        filters.append(('freq', 'in', [str(freq) for freq in freqs]))
+    table = pq.read_table(os.path.join(root, WAVES), filters=filters or None, partitioning=WAVE_PARTITIONING)
+
+    recordings = {}
+    for name in pc.unique(table.column('file')).to_pylist():
+        part = table.filter(pc.equal(table.column('file'), name))
+        wave_column = part.column('wave').combine_chunks()
+        waves = wave_column.flatten().to_numpy(zero_copy_only=False).reshape(len(part), wave_column.type.list_size)
+        metadata = part.drop(['wave', 'file', 'freq', 'content_hash']).to_pandas()
+        metadata.insert(0, 'Freq(Hz)', [parse_freq(freq) for freq in part.column('freq').to_pylist()])
+        recordings[name] = Recording(name, wave_frame(metadata, waves), part.column('content_hash')[0].as_py())
+    return recordings
+
+def read_results(root, name):
+    path = os.path.join(root, name)
+    if not os.path.isdir(path):
+        return None
+    return pq.read_table(path).to_pandas()
+
+def zip_directory(root):
+    # In-memory zip of an export, for downloading from the app
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for directory, _, files in os.walk(root):
+            for file in files:
+                path = os.path.join(directory, file)
+                archive.write(path, os.path.relpath(path, root))
+    buffer.seek(0)
+    return buffer
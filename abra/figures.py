@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from .metrics import METRICS
+
+FIGURE_CACHE_BYTES = int(float(os.environ.get('ABRA_FIGURE_CACHE_MB', 256)) * 2**20)
+
+def figure_key(kind, recordings, settings, model_version, **style):
+    """Hash of everything a plot depends on.
+
+    The analysis behind it is identified like a ResultsStore key, by each
+    recording's content hash and settings fingerprint plus the model version,
+    and its name, which plot titles show; style holds the plot's own
+    parameters (frequency, y range, legend, ...).
+    """
+    analyses = [(recording.name, recording.content_hash, settings.fingerprint(recording.name)) for recording in recordings]
+    text = json.dumps([kind, analyses, model_version, sorted(style.items())], default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+class FigureCache:
+    """Serialized figures (lists of JSON strings), their messages and tables kept in least recently used order.
+
+    Entries are evicted oldest first once their total size exceeds max_bytes;
+    a single entry larger than that is not kept at all. Tables are kept as
+    DataFrames, which callers must not modify. Thread-safe, so one cache can
+    serve every session of a server process.
+    """
+    def __init__(self, max_bytes=FIGURE_CACHE_BYTES, name='figures'):
+        self.max_bytes = max_bytes
+        self.name = name
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        METRICS.set_gauge('abra_cache_entries', lambda: len(self._entries), cache=name)
+        METRICS.set_gauge('abra_cache_bytes', lambda: self.bytes, cache=name)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        # (figures, messages, tables) stored under key, or None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        METRICS.cache_lookup(self.name, entry is not None)
+        return None if entry is None else entry[:3]
+
+    def put(self, key, figures, messages=(), tables=()):
+        size = sum(len(text.encode()) for text in [*figures, *messages])
+        size += sum(int(table.memory_usage(deep=True).sum()) for table in tables)
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[3]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (list(figures), list(messages), list(tables), size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, _, _, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
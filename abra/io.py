@@ -0,0 +1,300 @@
+import hashlib
+import importlib.util
+import io
+import os
+import struct
+import csv
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .metrics import MEMORY_BUCKETS, METRICS
+from .recording import WAVE_DTYPE, Recording, wave_frame
+
+CSV_ENGINE = 'pyarrow' if importlib.util.find_spec('pyarrow') else 'c'
+
+CSV_METADATA_COLUMNS = ['Freq(Hz)', 'Level(dB)', 'PostAtten(dB)', 'Chan']
+CSV_CHUNK_BYTES = 256 * 2**20  # exports larger than this are read in chunks
+CSV_CHUNK_ROWS = 2000
+RECORDING_EXTENSIONS = ('.arf', '.csv')
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz')
+
+def open_source(source):
+    # Binary file object for a path, or for a file already read into memory
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    return open(source, 'rb')
+
+def source_size(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return len(source)
+    return os.path.getsize(source)
+
+def arfread(PATH, **kwargs):
+    # defaults
+    PLOT = kwargs.get('PLOT', False)
+    RP = kwargs.get('RP', False)
+    
+    isRZ = not RP
+    
+    data = {'RecHead': {}, 'groups': []}
+
+    # open file (a path, or the file's bytes)
+    with open_source(PATH) as fid:
+        # open RecHead data
+        data['RecHead']['ftype'] = struct.unpack('h', fid.read(2))[0]
+        data['RecHead']['ngrps'] = struct.unpack('h', fid.read(2))[0]
+        data['RecHead']['nrecs'] = struct.unpack('h', fid.read(2))[0]
+        data['RecHead']['grpseek'] = struct.unpack('200i', fid.read(4*200))
+        data['RecHead']['recseek'] = struct.unpack('2000i', fid.read(4*2000))
+        data['RecHead']['file_ptr'] = struct.unpack('i', fid.read(4))[0]
+
+        data['groups'] = []
+        bFirstPass = True
+        for x in range(data['RecHead']['ngrps']):
+            # jump to the group location in the file
+            fid.seek(data['RecHead']['grpseek'][x], 0)
+
+            # open the group
+            data['groups'].append({
+                'grpn': struct.unpack('h', fid.read(2))[0],
+                'frecn': struct.unpack('h', fid.read(2))[0],
+                'nrecs': struct.unpack('h', fid.read(2))[0],
+                'ID': get_str(fid.read(16)),
+                'ref1': get_str(fid.read(16)),
+                'ref2': get_str(fid.read(16)),
+                'memo': get_str(fid.read(50)),
+            })
+
+            # read temporary timestamp
+            if bFirstPass:
+                data['fileType'] = 'BioSigRZ' if isRZ else 'BioSigRP'
+                bFirstPass = False
+
+            if isRZ:
+                grp_t_format = 'q'
+                beg_t_format = 'q'
+                end_t_format = 'q'
+                read_size = 8
+            else:
+                grp_t_format = 'I'
+                beg_t_format = 'I'
+                end_t_format = 'I'
+                read_size = 4
+
+            data['groups'][x]['beg_t'] = struct.unpack(beg_t_format, fid.read(read_size))[0]
+            data['groups'][x]['end_t'] = struct.unpack(end_t_format, fid.read(read_size))[0]
+
+            data['groups'][x].update({
+                'sgfname1': get_str(fid.read(100)),
+                'sgfname2': get_str(fid.read(100)),
+                'VarName1': get_str(fid.read(15)),
+                'VarName2': get_str(fid.read(15)),
+                'VarName3': get_str(fid.read(15)),
+                'VarName4': get_str(fid.read(15)),
+                'VarName5': get_str(fid.read(15)),
+                'VarName6': get_str(fid.read(15)),
+                'VarName7': get_str(fid.read(15)),
+                'VarName8': get_str(fid.read(15)),
+                'VarName9': get_str(fid.read(15)),
+                'VarName10': get_str(fid.read(15)),
+                'VarUnit1': get_str(fid.read(5)),
+                'VarUnit2': get_str(fid.read(5)),
+                'VarUnit3': get_str(fid.read(5)),
+                'VarUnit4': get_str(fid.read(5)),
+                'VarUnit5': get_str(fid.read(5)),
+                'VarUnit6': get_str(fid.read(5)),
+                'VarUnit7': get_str(fid.read(5)),
+                'VarUnit8': get_str(fid.read(5)),
+                'VarUnit9': get_str(fid.read(5)),
+                'VarUnit10': get_str(fid.read(5)),
+                'SampPer_us': struct.unpack('f', fid.read(4))[0],
+                'cc_t': struct.unpack('i', fid.read(4))[0],
+                'version': struct.unpack('h', fid.read(2))[0],
+                'postproc': struct.unpack('i', fid.read(4))[0],
+                'dump': get_str(fid.read(92)),
+                'recs': [],
+            })
+
+            for i in range(data['groups'][x]['nrecs']):
+                record_data = {
+                        'recn': struct.unpack('h', fid.read(2))[0],
+                        'grpid': struct.unpack('h', fid.read(2))[0],
+                        'grp_t': struct.unpack(grp_t_format, fid.read(read_size))[0],
+                        #'grp_d': datetime.utcfromtimestamp(data['groups'][x]['recs'][i]['grp_t']/86400 + datetime(1970, 1, 1).timestamp()).strftime('%Y-%m-%d %H:%M:%S'),
+                        'newgrp': struct.unpack('h', fid.read(2))[0],
+                        'sgi': struct.unpack('h', fid.read(2))[0],
+                        'chan': struct.unpack('B', fid.read(1))[0],
+                        'rtype': get_str(fid.read(1)),
+                        'npts': struct.unpack('H' if isRZ else 'h', fid.read(2))[0],
+                        'osdel': struct.unpack('f', fid.read(4))[0],
+                        'dur_ms': struct.unpack('f', fid.read(4))[0],
+                        'SampPer_us': struct.unpack('f', fid.read(4))[0],
+                        'artthresh': struct.unpack('f', fid.read(4))[0],
+                        'gain': struct.unpack('f', fid.read(4))[0],
+                        'accouple': struct.unpack('h', fid.read(2))[0],
+                        'navgs': struct.unpack('h', fid.read(2))[0],
+                        'narts': struct.unpack('h', fid.read(2))[0],
+                        'beg_t': struct.unpack(beg_t_format, fid.read(read_size))[0],
+                        'end_t': struct.unpack(end_t_format, fid.read(read_size))[0],
+                        'Var1': struct.unpack('f', fid.read(4))[0],
+                        'Var2': struct.unpack('f', fid.read(4))[0],
+                        'Var3': struct.unpack('f', fid.read(4))[0],
+                        'Var4': struct.unpack('f', fid.read(4))[0],
+                        'Var5': struct.unpack('f', fid.read(4))[0],
+                        'Var6': struct.unpack('f', fid.read(4))[0],
+                        'Var7': struct.unpack('f', fid.read(4))[0],
+                        'Var8': struct.unpack('f', fid.read(4))[0],
+                        'Var9': struct.unpack('f', fid.read(4))[0],
+                        'Var10': struct.unpack('f', fid.read(4))[0],
+                        'data': [] #list(struct.unpack(f'{data["groups"][x]["recs"][i]["npts"]}f', fid.read(4*data['groups'][x]['recs'][i]['npts'])))
+                    }
+                
+                # skip all 10 cursors placeholders
+                fid.seek(36*10, 1)
+                record_data['data'] = np.frombuffer(fid.read(4*record_data['npts']), dtype=np.float32)
+
+                #record_data['grp_d'] = datetime.datetime.utcfromtimestamp(record_data['grp_t'] / 86400 + datetime.datetime(1970, 1, 1).timestamp()).strftime('%Y-%m-%d %H:%M:%S')
+
+                data['groups'][x]['recs'].append(record_data)
+
+            if PLOT:
+                import matplotlib.pyplot as plt
+
+                # determine reasonable spacing between plots
+                d = [x['data'] for x in data['groups'][x]['recs']]
+                plot_offset = max(max(map(abs, [item for sublist in d for item in sublist]))) * 1.2
+
+                plt.figure()
+
+                for i in range(data['groups'][x]['nrecs']):
+                    plt.plot([item - plot_offset * i for item in data['groups'][x]['recs'][i]['data']])
+                    plt.hold(True)
+
+                plt.title(f'Group {data["groups"][x]["grpn"]}')
+                plt.axis('off')
+                plt.show()
+
+    return data
+
+def get_str(data):
+    # return string up until null character only
+    ind = data.find(b'\x00')
+    if ind > 0:
+        data = data[:ind]
+    return data.decode('utf-8')
+
+def arf_to_df(data, click, db_column, wave_dtype=WAVE_DTYPE):
+    recs = [rec for group in data['groups'] for rec in group['recs']]
+    if not click:
+        freqs = [rec['Var1'] for rec in recs]
+        dbs = [rec['Var2'] for rec in recs]
+    else:
+        freqs = ['Click'] * len(recs)
+        dbs = [rec['Var1'] for rec in recs]
+
+    waves = np.full((len(recs), max((len(rec['data']) for rec in recs), default=0)), np.nan, dtype=wave_dtype)
+    for i, rec in enumerate(recs):
+        waves[i, :len(rec['data'])] = rec['data']
+    waves *= 1e6  # V to μV
+
+    return wave_frame(pd.DataFrame({'Freq(Hz)': freqs, db_column: dbs, 'Chan': [rec['chan'] for rec in recs]}), waves)
+
+def sniff_csv_header(lines):
+    # Returns (header row index, header fields) from the first lines of a CSV export
+    rows = list(csv.reader(lines))
+    for i, fields in enumerate(rows):
+        if 'Freq(Hz)' in fields:
+            return i, fields
+    # Exports without a recognisable header either start with it or with two title lines
+    if rows and len(rows[0]) > 1:
+        return 0, rows[0]
+    if len(rows) > 2 and len(rows[2]) > 1:
+        return 2, rows[2]
+    raise ValueError('unrecognised CSV export')
+
+def read_abr_csv(path, chunksize=None, wave_dtype=WAVE_DTYPE):
+    """Reads a BioSigRZ/BioSigRP CSV export in a single pass.
+
+    path can also be the export's bytes. Only the frequency/level columns and
+    the sample columns ('0', '1', ...) are parsed, the samples straight to
+    wave_dtype. Exports larger than CSV_CHUNK_BYTES are read CSV_CHUNK_ROWS
+    rows at a time.
+    """
+    with open_source(path) as f:
+        head = [f.readline().decode('utf-8', errors='replace') for _ in range(5)]
+    header_row, fields = sniff_csv_header(head)
+
+    sample_columns = [name for name in fields if name.isdigit()]
+    if not sample_columns:
+        with open_source(path) as f:
+            return pd.read_csv(f, skiprows=header_row)
+    metadata_columns = [name for name in CSV_METADATA_COLUMNS if name in fields]
+    dtype = {name: wave_dtype for name in sample_columns}
+
+    if chunksize is None and source_size(path) > CSV_CHUNK_BYTES:
+        chunksize = CSV_CHUNK_ROWS
+
+    read_kwargs = dict(usecols=metadata_columns + sample_columns, dtype=dtype)
+    with open_source(path) as f:
+        # Leave the file positioned at the header so both engines agree on blank title lines
+        for _ in range(header_row):
+            f.readline()
+        if chunksize is None:
+            df = pd.read_csv(f, engine=CSV_ENGINE, **read_kwargs)
+        else:
+            df = pd.concat(pd.read_csv(f, engine='c', chunksize=chunksize, **read_kwargs), ignore_index=True)
+    return df[metadata_columns + sample_columns]
+
+def file_content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def load_recording(file_name, file_bytes, settings, wave_dtype=WAVE_DTYPE):
+    # Parses an .arf or .csv recording from its bytes, with waves in wave_dtype
+    with METRICS.time('parse'):
+        if file_name.endswith(".arf"):
+            data = arfread(file_bytes, RP=settings.rp)
+            df = arf_to_df(data, settings.click, settings.db_column, wave_dtype)
+        elif file_name.endswith(".csv"):
+            df = read_abr_csv(file_bytes, wave_dtype=wave_dtype)
+        else:
+            raise ValueError(f'Not an .arf or .csv recording: {file_name}')
+    METRICS.observe('abra_recording_bytes', df.memory_usage(deep=True).sum(), MEMORY_BUCKETS)
+    return Recording(file_name, df, file_content_hash(file_bytes))
+
+def is_archive(file_name):
+    return file_name.lower().endswith(ARCHIVE_EXTENSIONS)
+
+def archive_members(file_name, data):
+    """Yields (member name, bytes) for every recording in a ZIP or tar archive held in memory.
+
+    Members are decompressed one at a time, in archive order; tar archives
+    are read as a stream. A corrupt or truncated archive raises ValueError,
+    like a recording load_recording cannot parse.
+    """
+    def wanted(name):
+        return name.lower().endswith(RECORDING_EXTENSIONS) and '__MACOSX' not in name
+
+    try:
+        if file_name.lower().endswith('.zip'):
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and wanted(info.filename):
+                        yield info.filename, archive.read(info)
+        else:
+            with tarfile.open(fileobj=io.BytesIO(data), mode='r|*') as archive:
+                for member in archive:
+                    if member.isfile() and wanted(member.name):
+                        yield member.name, archive.extractfile(member).read()
+    except (tarfile.TarError, zipfile.BadZipFile) as e:
+        raise ValueError(f'Not a readable ZIP or tar archive: {file_name} ({e})') from e
+
+def load_archive(file_name, data, settings, workers=None):
+    # Recordings in an archive as {member name: Recording}; members are parsed while the next ones decompress
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {member: pool.submit(load_recording, os.path.basename(member), member_bytes, settings)
+                   for member, member_bytes in archive_members(file_name, data)}
+    return {member: future.result() for member, future in futures.items()}
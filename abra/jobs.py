@@ -0,0 +1,267 @@
+import datetime
+import os
+import threading
+from contextlib import nullcontext
+
+import pandas as pd
+
+from .io import RECORDING_EXTENSIONS, file_content_hash
+from .metrics import METRICS
+
+class AnalysisJob:
+    """Runs a per-file analysis in a background thread.
+
+    ``task(recording)`` yields result rows; they are collected as they
+    finish so the table can be shown while the job is still running. ``slots``
+    is entered before the job starts, e.g. a semaphore limiting how many jobs
+    run at once.
+    """
+    def __init__(self, title, task, recordings, columns, slots=None):
+        self.title = title
+        self.task = task
+        self.files = list(recordings)
+        self.columns = columns
+        self.slots = slots if slots is not None else nullcontext()
+        self.rows = []
+        self.files_done = 0
+        self.current_file = None
+        self.status = 'pending'
+        self.waiting = False
+        self.error = None
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.status = 'running'
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    @property
+    def running(self):
+        return self.status == 'running'
+
+    @property
+    def progress(self):
+        if not self.files:
+            return 1.0
+        return self.files_done / len(self.files)
+
+    def results(self):
+        with self._lock:
+            return pd.DataFrame(list(self.rows), columns=self.columns)
+
+    def _run(self):
+        self.waiting = True
+        with self.slots:
+            self.waiting = False
+            self._analyze()
+
+    def _analyze(self):
+        try:
+            for recording in self.files:
+                # Also catches a job cancelled while it was still waiting for a slot
+                if self._cancel_event.is_set():
+                    self.status = 'cancelled'
+                    return
+                self.current_file = recording.name
+                with METRICS.time('analysis', source='job'), METRICS.track_memory('analysis_job'):
+                    for row in self.task(recording):
+                        with self._lock:
+                            self.rows.append(row)
+                        if self._cancel_event.is_set():
+                            break
+                if self._cancel_event.is_set():
+                    self.status = 'cancelled'
+                    return
+                self.files_done += 1
+            self.status = 'finished'
+        except Exception as e:
+            self.error = e
+            self.status = 'failed'
+        finally:
+            self.current_file = None
+
+class FolderWatcher:
+    """Polls a rig output directory and analyses new or modified recordings in the background.
+
+    A file is picked up once its size and mtime are unchanged across two polls
+    (so files still being written are skipped), and only re-analysed when its
+    content hash changes. ``load(file_name, file_bytes)`` returns a Recording
+    and ``analyze(recording)`` its (threshold rows, metric rows); the app sets
+    both on every script run so the watcher always uses the current settings.
+    Recordings are kept only for the load_key they were parsed under, so
+    they never hold the dB column of other settings, and results only for
+    the analyze_key they were computed under. Files deleted from the
+    directory are dropped along with their results.
+    """
+    def __init__(self, directory, interval=5.0, slots=None):
+        self.directory = directory
+        self.interval = interval
+        self.slots = slots if slots is not None else nullcontext()
+        self.load = None
+        self.load_key = None
+        self.analyze = None
+        self.analyze_key = None
+        self.recordings = {}
+        self.pending = []
+        self.threshold_rows = {}
+        self.metric_rows = {}
+        self.errors = {}
+        self.last_poll = None
+        self._stats = {}
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+
+    @property
+    def running(self):
+        return self._thread.is_alive() and not self._stop_event.is_set()
+
+    def configure(self, load=None, analyze=None, load_key=None, analyze_key=None):
+        """Sets the load and analyze callables.
+
+        load_key identifies the parsing settings load was made with. When it
+        changes, every recording loaded so far is read again and parsed with
+        the new load before this returns, then queued for analysis again.
+        analyze_key does the same for the analysis settings: when it changes,
+        the results so far are dropped and every recording queued again.
+        """
+        if analyze is not None:
+            with self._lock:
+                self.analyze = analyze
+                if analyze_key != self.analyze_key:
+                    self.analyze_key = analyze_key
+                    self.threshold_rows.clear()
+                    self.metric_rows.clear()
+                    self.pending.extend(path for path in self.recordings if path not in self.pending)
+        if load is None:
+            return
+        with self._lock:
+            self.load = load
+            stale = [] if load_key == self.load_key else list(self.recordings)
+            self.load_key = load_key
+            for path in stale:
+                del self.recordings[path]
+        for path in stale:
+            try:
+                with open(path, 'rb') as f:
+                    file_bytes = f.read()
+            except OSError as e:
+                self.errors[os.path.basename(path)] = e
+                continue
+            self._load(path, file_bytes)
+
+    def results(self, threshold_columns, metric_columns):
+        with self._lock:
+            thresholds = [row for rows in self.threshold_rows.values() for row in rows]
+            metrics = [row for rows in self.metric_rows.values() for row in rows]
+        return pd.DataFrame(thresholds, columns=threshold_columns), pd.DataFrame(metrics, columns=metric_columns)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self._poll()
+            except OSError as e:
+                self.errors[self.directory] = e
+            self._analyze_pending()
+            self._stop_event.wait(self.interval)
+
+    def _poll(self):
+        if self.load is None:
+            return
+        present = set()
+        for entry in sorted(os.scandir(self.directory), key=lambda entry: entry.name):
+            if not entry.is_file() or not entry.name.endswith(RECORDING_EXTENSIONS):
+                continue
+            present.add(entry.path)
+            stat = entry.stat()
+            key = (stat.st_size, stat.st_mtime_ns)
+            previous = self._stats.get(entry.path)
+            self._stats[entry.path] = key
+            if previous != key:
+                # New or still being written; wait for it to settle
+                continue
+            if self._hashes.get(entry.path, (None,))[0] == key:
+                continue
+
+            with open(entry.path, 'rb') as f:
+                file_bytes = f.read()
+            content_hash = file_content_hash(file_bytes)
+            if self._hashes.get(entry.path, (None, None))[1] != content_hash:
+                if not self._load(entry.path, file_bytes):
+                    # Parsed under settings that changed meanwhile; picked up again next poll
+                    continue
+            self._hashes[entry.path] = (key, content_hash)
+        self._forget([path for path in self._stats if path not in present])
+        self.last_poll = datetime.datetime.now()
+
+    def _forget(self, paths):
+        # Drops files that have gone from the directory, with their results
+        with self._lock:
+            for path in paths:
+                self._stats.pop(path, None)
+                self._hashes.pop(path, None)
+                self.recordings.pop(path, None)
+                self.threshold_rows.pop(path, None)
+                self.metric_rows.pop(path, None)
+                self.errors.pop(os.path.basename(path), None)
+                if path in self.pending:
+                    self.pending.remove(path)
+
+    def _load(self, path, file_bytes):
+        # Parses and queues path with the current load; False if load_key changed while it ran
+        name = os.path.basename(path)
+        with self._lock:
+            load, load_key = self.load, self.load_key
+        try:
+            recording = load(name, file_bytes)
+        except Exception as e:
+            self.errors[name] = e
+            return True
+        with self._lock:
+            if load_key != self.load_key:
+                return False
+            self.recordings[path] = recording
+            self.errors.pop(name, None)
+            if path not in self.pending:
+                self.pending.append(path)
+        return True
+
+    def _analyze_pending(self):
+        while self.pending and self.analyze is not None and not self._stop_event.is_set():
+            with self._lock:
+                if not self.pending:
+                    break
+                path = self.pending[0]
+                recording = self.recordings.get(path)
+                if recording is None:
+                    # Dropped when it could not be parsed again under new settings
+                    self.pending.remove(path)
+                    continue
+                analyze, analyze_key = self.analyze, self.analyze_key
+            try:
+                with self.slots, METRICS.time('analysis', source='watcher'), METRICS.track_memory('folder_watcher'):
+                    results = analyze(recording)
+            except Exception as e:
+                self.errors[os.path.basename(path)] = e
+                results = None
+            with self._lock:
+                if self.recordings.get(path) is not recording or self.analyze_key != analyze_key:
+                    # Parsed again, deleted or given new analysis settings while this ran; its
+                    # current state is queued (or gone) already
+                    continue
+                if results is not None:
+                    self.threshold_rows[path], self.metric_rows[path] = results
+                self.pending.remove(path)
@@ -0,0 +1,239 @@
+import json
+import os
+import threading
+import tracemalloc
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep
+
+# Process-wide runtime metrics in the Prometheus text format.
+#
+# Everything here describes the server process rather than one analysis, so unlike
+# the rest of the package it keeps state: the METRICS registry every stage reports
+# to. start_exporters() publishes it as configured by these environment variables:
+#
+#     ABRA_METRICS_FILE      rewrite this file every ABRA_METRICS_INTERVAL seconds
+#                            (default 15), e.g. for node_exporter's textfile collector
+#     ABRA_METRICS_PORT      serve the same text on http://localhost:<port>/metrics
+#     ABRA_METRICS_LOG       append every stage timing and memory peak as a JSON line
+#     ABRA_TRACEMALLOC       1 to trace allocations and record each analysis' peak
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+MEMORY_BUCKETS = tuple(2**20 * 4**i for i in range(9))  # 1 MiB to 64 GiB
+DESCRIPTIONS = {
+    'abra_stage_seconds': 'Time spent in each analysis stage',
+    'abra_analysis_peak_memory_bytes': 'Peak traced allocations during one analysis, above what was allocated when it started',
+    'abra_recording_bytes': 'Memory used by each loaded recording',
+    'abra_model_loads_total': 'Models loaded by this process',
+    'abra_cache_requests_total': 'Cache lookups by result',
+    'abra_cache_entries': 'Entries held by each cache',
+    'abra_cache_bytes': 'Approximate bytes held by each cache',
+    'abra_inference_batch_waves': 'Waves per model call made by the inference worker',
+    'abra_inference_fallbacks_total': 'Times an app process lost its inference worker and switched to in-process models',
+}
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+def label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms.
+
+    Series are identified by a name and keyword labels. A gauge's value may be
+    a callable, evaluated whenever the metrics are read.
+    """
+    def __init__(self):
+        self.log_path = None
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+        if self.log_path:
+            self._log({'metric': name, 'value': value, **labels})
+
+    @contextmanager
+    def time(self, stage, **labels):
+        # Records how long the block took under abra_stage_seconds{stage=...}
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('abra_stage_seconds', perf_counter() - start, stage=stage, **labels)
+
+    @contextmanager
+    def track_memory(self, operation):
+        """Records the peak of traced allocations while the block runs.
+
+        Only active when tracemalloc is tracing (ABRA_TRACEMALLOC=1). The peak is
+        process-wide, so analyses running at the same time count towards each
+        other's peaks.
+        """
+        if not tracemalloc.is_tracing():
+            yield
+            return
+        start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            peak = tracemalloc.get_traced_memory()[1]
+            self.observe('abra_analysis_peak_memory_bytes', max(peak - start, 0), MEMORY_BUCKETS, operation=operation)
+
+    def cache_lookup(self, cache, hit):
+        self.inc('abra_cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+    def _log(self, record):
+        line = json.dumps({'time': datetime.now().isoformat(), **record}, default=str)
+        with self._lock, open(self.log_path, 'a') as f:
+            f.write(line + '\n')
+
+    def _snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {key: (h.buckets, list(h.counts), h.count, h.sum) for key, h in self._histograms.items()}
+        for key, value in list(gauges.items()):
+            if callable(value):
+                try:
+                    gauges[key] = value()
+                except Exception:  # e.g. a cache file that was removed; left out until it is back
+                    del gauges[key]
+        return counters, gauges, histograms
+
+    def prometheus_text(self):
+        counters, gauges, histograms = self._snapshot()
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in DESCRIPTIONS:
+                    lines.append(f'# HELP {name} {DESCRIPTIONS[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append(f'{name}{label_text(labels)} {value}')
+        for (name, labels), value in sorted(gauges.items()):
+            header(name, 'gauge')
+            lines.append(f'{name}{label_text(labels)} {value}')
+        for (name, labels), (buckets, counts, count, total) in sorted(histograms.items()):
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{label_text(labels + (("le", f"{bound:g}"),))} {cumulative}')
+            lines.append(f'{name}_bucket{label_text(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_sum{label_text(labels)} {total}')
+            lines.append(f'{name}_count{label_text(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def stage_summary(self):
+        # (stage, count, mean ms, total s) rows of every timed stage, for display
+        _, _, histograms = self._snapshot()
+        rows = []
+        for (name, labels), (_, _, count, total) in sorted(histograms.items()):
+            if name == 'abra_stage_seconds' and count:
+                labels = dict(labels)
+                stage = labels.pop('stage')
+                if labels:
+                    stage += f" ({', '.join(str(value) for value in labels.values())})"
+                rows.append((stage, count, 1000 * total / count, total))
+        return rows
+
+    def cache_summary(self):
+        # (cache, hits, misses, hit rate) rows
+        counters, _, _ = self._snapshot()
+        lookups = {}
+        for (name, labels), value in counters.items():
+            if name == 'abra_cache_requests_total':
+                labels = dict(labels)
+                lookups.setdefault(labels['cache'], {'hit': 0, 'miss': 0})[labels['result']] += value
+        return [(cache, counts['hit'], counts['miss'], counts['hit'] / (counts['hit'] + counts['miss']))
+                for cache, counts in sorted(lookups.items())]
+
+METRICS = Metrics()
+
+def write_metrics_file(path, metrics=METRICS):
+    # Written to a temporary file first so collectors never read half a file
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w') as f:
+        f.write(metrics.prometheus_text())
+    os.replace(temporary, path)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/metrics'):
+            self.send_error(404)
+            return
+        body = METRICS.prometheus_text().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+_exporters_started = threading.Lock()
+
+def start_exporters(environ=os.environ):
+    """Starts the exporters configured in environ; later calls in the same process do nothing."""
+    if not _exporters_started.acquire(blocking=False):
+        return
+    if environ.get('ABRA_TRACEMALLOC') == '1' and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    METRICS.log_path = environ.get('ABRA_METRICS_LOG') or None
+
+    path = environ.get('ABRA_METRICS_FILE')
+    if path:
+        interval = float(environ.get('ABRA_METRICS_INTERVAL', 15))
+
+        def write_periodically():
+            while True:
+                try:
+                    write_metrics_file(path)
+                except OSError:
+                    pass
+                sleep(interval)
+
+        threading.Thread(target=write_periodically, daemon=True).start()
+
+    port = environ.get('ABRA_METRICS_PORT')
+    if port:
+        server = ThreadingHTTPServer(('localhost', int(port)), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
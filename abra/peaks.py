@@ -0,0 +1,201 @@
+import numpy as np
+import pandas as pd
+from scipy.ndimage import gaussian_filter1d
+from scipy.signal import find_peaks
+
+from .metrics import METRICS
+from .preprocessing import display_wave, interpolate_and_smooth, prepare_wave
+
+# engine is any object with predict_peaks(waves), like abra_inference.InProcessInference
+
+def predict_wave_i_onsets(waveforms, engine):
+    # Runs the peak finding CNN once over an (n, 244) batch of scaled waveforms
+    with METRICS.time('peak_inference'):
+        outputs = engine.predict_peaks(waveforms)
+    return np.round(outputs).astype(int)
+
+def peak_finding(wave, engine):
+    # Prepare waveform
+    waveform = interpolate_and_smooth(wave)
+    
+    # Get prediction from model
+    prediction = predict_wave_i_onsets([waveform], engine)[0]
+    return peaks_from_onset(wave, prediction)
+
+def peaks_from_onset(wave, prediction):
+    # Apply Gaussian smoothing
+    smoothed_waveform = gaussian_filter1d(wave, sigma=1.0)
+
+    # Find peaks and troughs
+    n = 18
+    t = 14
+    start_point = prediction - 6
+    smoothed_peaks, _ = find_peaks(smoothed_waveform[start_point:], distance=n)
+    smoothed_troughs, _ = find_peaks(-smoothed_waveform, distance=t)
+    sorted_indices = np.argsort(smoothed_waveform[smoothed_peaks+start_point])
+    highest_smoothed_peaks = np.sort(smoothed_peaks[sorted_indices[-5:]] + start_point)
+    relevant_troughs = np.array([])
+    for p in range(len(highest_smoothed_peaks)):
+        for t in smoothed_troughs:
+            if t > highest_smoothed_peaks[p]:
+                if p != 4:
+                    try:
+                        if t < highest_smoothed_peaks[p+1]:
+                            relevant_troughs = np.append(relevant_troughs, int(t))
+                            break
+                    except IndexError:
+                        pass
+                else:
+                    relevant_troughs = np.append(relevant_troughs, int(t))
+                    break
+    relevant_troughs = relevant_troughs.astype('i')
+    return highest_smoothed_peaks, relevant_troughs
+
+def wave_i_metrics(recording, freq, db, settings, engine):
+    # Returns (Wave I amplitude, latency, Peak1/Peak4 ratio) or None when no peaks are found
+    _, y_values, y_values_fpf = prepare_wave(recording, freq, db, settings)
+    if y_values is None:
+        return None
+    highest_peaks, relevant_troughs = peak_finding(y_values_fpf, engine)
+
+    if highest_peaks.size == 0:
+        return None
+
+    if settings.return_units == 'Nanovolts':
+        y_values *= 1000
+
+    first_peak_amplitude = y_values[highest_peaks[0]] - y_values[relevant_troughs[0]]
+    latency_to_first_peak = highest_peaks[0] * (10 / len(y_values))  # Assuming 10 ms duration for waveform
+
+    if len(highest_peaks) >= 4 and len(relevant_troughs) >= 4:
+        amplitude_ratio = (y_values[highest_peaks[0]] - y_values[relevant_troughs[0]]) / (
+                    y_values[highest_peaks[3]] - y_values[relevant_troughs[3]])
+    else:
+        amplitude_ratio = np.nan
+
+    return first_peak_amplitude, latency_to_first_peak, amplitude_ratio
+
+def index_matrix(index_lists, width=5):
+    # Ragged peak/trough index lists as an (n, width) matrix padded with -1, plus their lengths
+    matrix = np.full((len(index_lists), width), -1)
+    for row, indices in enumerate(index_lists):
+        matrix[row, :min(len(indices), width)] = indices[:width]
+    return matrix, np.array([len(indices) for indices in index_lists])
+
+def first_wave_positions(recording, settings, freqs=None):
+    # Row positions of the first wave of every (freq, dB) combination, optionally only for freqs
+    df = recording.data
+    first = ~df.duplicated(['Freq(Hz)', settings.db_column]).to_numpy()
+    if freqs is not None:
+        first &= df['Freq(Hz)'].isin(list(freqs)).to_numpy()
+    return np.flatnonzero(first)
+
+def prepared_waves(recording, positions, settings):
+    # Display and scaled 244-point waves of the given rows, each as one matrix
+    with METRICS.time('preprocess'):
+        prepared = [display_wave(row[~np.isnan(row)], settings) for row in recording.samples[positions]]
+    return np.stack([np.asarray(y) for _, y, _ in prepared]), np.stack([scaled for _, _, scaled in prepared])
+
+def wave_i_metrics_table(recording, settings, engine, freqs=None):
+    """Wave I amplitude, latency and Peak1/Peak4 ratio for every (freq, dB) a recording contains.
+
+    Only combinations present in the recording are visited, using their first
+    wave as prepare_wave does. The peak finding CNN runs once over all of them
+    and the metrics are taken from the batched peak/trough index matrices.
+    Waves without peaks are left out.
+    """
+    db_column = settings.db_column
+    columns = ['Freq(Hz)', db_column, 'amplitude', 'latency', 'ratio']
+
+    positions = first_wave_positions(recording, settings, freqs)
+    if positions.size == 0:
+        return pd.DataFrame(columns=columns)
+
+    y_values, scaled = prepared_waves(recording, positions, settings)
+
+    onsets = predict_wave_i_onsets(scaled, engine)
+    peaks, troughs = zip(*(peaks_from_onset(wave, onset) for wave, onset in zip(scaled, onsets)))
+    peaks, peak_counts = index_matrix(peaks)
+    troughs, trough_counts = index_matrix(troughs)
+
+    if settings.return_units == 'Nanovolts':
+        y_values *= 1000
+
+    rows = np.arange(len(positions))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        amplitude = y_values[rows, peaks[:, 0]] - y_values[rows, troughs[:, 0]]
+        amplitude_4 = y_values[rows, peaks[:, 3]] - y_values[rows, troughs[:, 3]]
+        ratio = np.where((peak_counts >= 4) & (trough_counts >= 4), amplitude / amplitude_4, np.nan)
+    amplitude = np.where(trough_counts > 0, amplitude, np.nan)
+    latency = peaks[:, 0] * (10 / y_values.shape[1])  # Assuming 10 ms duration for waveform
+
+    found = peak_counts > 0
+    table = recording.data.iloc[positions[found]][['Freq(Hz)', db_column]].reset_index(drop=True)
+    table['amplitude'] = amplitude[found]
+    table['latency'] = latency[found]
+    table['ratio'] = ratio[found]
+    return table
+
+def cohort_wave_i_amplitudes(recordings, freqs, settings, engine):
+    """Wave I amplitude matrices for a cohort, one per frequency.
+
+    All waves of all files are prepared first and the peak finding CNN runs
+    once over the whole batch. Returns ``{freq: (db_levels, masked array)}``
+    where the masked array is animals x dB levels and levels an animal was not
+    recorded at (or where no peak was found) are masked.
+    """
+    cells = []
+    scaled_waves = []
+    display_waves = []
+    for i, recording in enumerate(recordings):
+        for freq in freqs:
+            for db in recording.db_levels(settings.db_column, freq):
+                _, y_values, y_values_fpf = prepare_wave(recording, freq, db, settings)
+                if y_values is None:
+                    continue
+                cells.append((i, freq, settings.reported_db(recording.name, freq, db)))
+                scaled_waves.append(np.asarray(y_values_fpf))
+                display_waves.append(np.asarray(y_values))
+
+    amplitudes = {}
+    if cells:
+        onsets = predict_wave_i_onsets(np.stack(scaled_waves), engine)
+        for (i, freq, db), scaled, y_values, onset in zip(cells, scaled_waves, display_waves, onsets):
+            highest_peaks, relevant_troughs = peaks_from_onset(scaled, onset)
+            if highest_peaks.size > 0 and relevant_troughs.size > 0:
+                amplitude = y_values[highest_peaks[0]] - y_values[relevant_troughs[0]]
+                if settings.return_units == 'Nanovolts':
+                    amplitude *= 1000
+                amplitudes[(i, freq, db)] = amplitude
+
+    matrices = {}
+    for freq in freqs:
+        db_levels = np.array(sorted({db for (_, f, db) in cells if f == freq}))
+        values = np.zeros((len(recordings), len(db_levels)))
+        mask = np.ones((len(recordings), len(db_levels)), dtype=bool)
+        columns = {db: j for j, db in enumerate(db_levels)}
+        for (i, f, db), amplitude in amplitudes.items():
+            if f == freq:
+                values[i, columns[db]] = amplitude
+                mask[i, columns[db]] = False
+        matrices[freq] = (db_levels, np.ma.masked_array(values, mask=mask))
+    return matrices
+
+def wave_i_io_curve(recording, freq, settings, engine):
+    """Wave I input/output curve of one frequency: reported dB levels, ascending, and their Wave I amplitudes.
+
+    Taken from wave_i_metrics_table, so levels without a Wave I peak and
+    trough are left out.
+    """
+    table = wave_i_metrics_table(recording, settings, engine, freqs=[freq]).dropna(subset=['amplitude'])
+    db_levels = np.asarray(settings.reported_dbs(recording.name, table['Freq(Hz)'], table[settings.db_column]), dtype=float)
+    order = np.argsort(db_levels, kind='stable')
+    return db_levels[order], table['amplitude'].to_numpy(dtype=float)[order]
+
+def mean_and_sem(amplitudes):
+    # Column-wise mean and standard error over the unmasked animals
+    counts = amplitudes.count(axis=0)
+    mean = amplitudes.mean(axis=0)
+    sem = amplitudes.std(axis=0, ddof=1) / np.sqrt(counts)
+    sem = np.ma.masked_where(counts < 2, sem)
+    return mean, sem, counts
@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+from scipy.interpolate import CubicSpline
+
+from .metrics import METRICS
+
+def wave_dtype(wave):
+    # Waves keep the float type they were loaded with through every processing step
+    dtype = np.asarray(wave).dtype
+    return dtype if np.issubdtype(dtype, np.floating) else np.dtype(np.float64)
+
+def interpolate_and_smooth(final, target_length=244):
+    dtype = wave_dtype(final)
+    if len(final) > target_length:
+        new_points = np.linspace(0, len(final), target_length + 2)
+        interpolated_values = np.interp(new_points, np.arange(len(final)), final)
+        final = np.array(interpolated_values[:target_length], dtype=dtype)
+        final = pd.Series(final)
+    elif len(final) < target_length:
+        original_indices = np.arange(len(final))
+        target_indices = np.linspace(0, len(final) - 1, target_length)
+        cs = CubicSpline(original_indices, final)
+        final = cs(target_indices).astype(dtype, copy=False)
+    return final
+
+def scale_waves(waves):
+    # StandardScaler followed by MinMaxScaler over all values, done in place.
+    # Standardising first doesn't change a min-max scaling, so only the latter is applied.
+    low = np.min(waves)
+    span = np.max(waves) - low
+    waves -= low
+    waves /= span if span else 1
+    return waves
+
+def display_wave(final, settings):
+    # Time axis, display wave and scaled 244-point wave from one recorded wave's samples
+    target = int(244 * (settings.time_scale / 10))
+
+    y_values = interpolate_and_smooth(final, target)  # Original y-values for plotting
+    sampling_rate = len(y_values) / settings.time_scale
+
+    x_values = np.linspace(0, len(y_values) / sampling_rate, len(y_values))
+
+    if settings.units == 'Nanovolts':
+        y_values /= 1000
+
+    y_values *= settings.multiply_y_factor
+
+    # Copy so scaling doesn't touch the display values
+    y_values_fpf = np.array(interpolate_and_smooth(y_values[:244]))
+    y_values_fpf = scale_waves(y_values_fpf)
+
+    return x_values, y_values, y_values_fpf
+
+def prepare_wave(recording, freq, db, settings):
+    # Returns the time axis, display wave and the scaled 244-point wave the peak finder runs on
+    df = recording.data
+    khz = df[(df['Freq(Hz)'] == freq) & (df[settings.db_column] == db)]
+    if not khz.empty:
+        with METRICS.time('preprocess'):
+            index = khz.index.values[0]
+            final = df.loc[index, '0':].dropna()
+            final = pd.to_numeric(final, errors='coerce').dropna()
+            return display_wave(final, settings)
+    return None, None, None
+
+def stacked_waves(recording, freq, settings):
+    """Display waves of one frequency for a stacked plot, loudest first.
+
+    Returns the time axis and a list of (dB as recorded, dB as reported,
+    wave), using the last wave recorded at each level as threshold_waves
+    does. Waves are divided by the largest absolute value of the loudest one.
+    """
+    db_column = settings.db_column
+    df = recording.data[recording.data['Freq(Hz)'] == freq]
+    db_levels = sorted(df[db_column].unique(), reverse=settings.level)
+    reported = settings.reported_dbs(recording.name, [freq] * len(db_levels), db_levels)
+
+    x_values, stacked, max_value = None, [], None
+    for db, reported_db in zip(db_levels, reported):
+        final = pd.to_numeric(df.loc[df.index[df[db_column] == db][-1], '0':].dropna(), errors='coerce')
+        x_values, y_values, _ = display_wave(final, settings)
+        y_values = np.asarray(y_values)
+        if max_value is None:
+            max_value = np.max(np.abs(y_values))
+        stacked.append((db, reported_db, y_values / max_value))
+    return x_values, stacked
+
+def lttb_indices(y, n_out):
+    # Largest-Triangle-Three-Buckets: indices of n_out points that keep the visual shape of y
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    y = np.asarray(y, dtype=np.float64)
+    x = np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    selected = np.empty(n_out, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x, next_y = x[end:edges[i + 2]].mean(), y[end:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        area = np.abs((x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a]))
+        a = start + np.argmax(area)
+        selected[i + 1] = a
+    return selected
+
+def display_points(x_values, y_values, max_points, keep=()):
+    """Decimates a wave to at most max_points for plotting, always keeping the indices in keep (peaks and troughs).
+
+    Analysis keeps using the full-resolution wave; a max_points of 0 or None
+    keeps every point.
+    """
+    x_values = np.asarray(x_values)
+    y_values = np.asarray(y_values)
+    if not max_points or len(y_values) <= max_points:
+        return x_values, y_values
+    keep = np.asarray(keep, dtype=int)
+    indices = np.union1d(lttb_indices(y_values, max(max_points - len(keep), 3)), keep)
+    return x_values[indices], y_values[indices]
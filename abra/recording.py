@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# float32 halves the memory of every wave; set ABRA_WAVE_DTYPE=float64 for full precision
+WAVE_DTYPE = np.dtype(os.environ.get('ABRA_WAVE_DTYPE', 'float32'))
+
+# The two names a recording's dB column goes by, after Settings.level
+DB_COLUMNS = ('Level(dB)', 'PostAtten(dB)')
+
+def wave_frame(metadata, waves):
+    # Metadata columns followed by sample columns '0'..'n' backed by the waves matrix
+    samples = pd.DataFrame(waves, columns=[str(i) for i in range(waves.shape[1])], copy=False)
+    return pd.concat([metadata.reset_index(drop=True), samples], axis=1, copy=False)
+
+class Recording:
+    """One loaded ABR recording.
+
+    ``data`` has one row per wave: metadata columns ('Freq(Hz)', 'Level(dB)' or
+    'PostAtten(dB)', 'Chan') followed by the sample columns '0', '1', ...
+    ``name`` is the file name and ``content_hash`` the SHA-256 of the file's
+    bytes, used to key stored results.
+    """
+    def __init__(self, name, data, content_hash=None):
+        self.name = name
+        self.data = data
+        self.content_hash = content_hash
+
+    def __repr__(self):
+        return f'Recording({self.name!r}, {len(self.data)} waves)'
+
+    @property
+    def samples(self):
+        # (waves, samples) matrix, NaN-padded where a wave is shorter than the longest
+        return self.data.loc[:, '0':].to_numpy()
+
+    @property
+    def freqs(self):
+        return sorted(self.data['Freq(Hz)'].unique())
+
+    def db_levels(self, db_column, freq=None):
+        data = self.data if freq is None else self.data[self.data['Freq(Hz)'] == freq]
+        return sorted(data[db_column].unique())
+
+    def with_wave_dtype(self, dtype):
+        # Copy with the sample columns cast to dtype
+        sample_columns = self.data.loc[:, '0':].columns
+        return Recording(self.name, self.data.astype({column: dtype for column in sample_columns}), self.content_hash)
+
+    def with_db_column(self, db_column):
+        # Copy with its dB column named db_column, as arf_to_df names the same record values either way
+        if db_column in self.data.columns:
+            return self
+        stored = [column for column in DB_COLUMNS if column in self.data.columns]
+        if not stored:
+            return self
+        return Recording(self.name, self.data.rename(columns={stored[0]: db_column}), self.content_hash)
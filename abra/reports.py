@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+from .metrics import METRICS
+from .peaks import first_wave_positions, peak_finding, predict_wave_i_onsets, prepared_waves
+from .preprocessing import prepare_wave
+from .thresholds import calculate_hearing_threshold, cascade_predictions, threshold_from_predictions, threshold_waves
+
+def cascade_agreement_report(recordings, freqs, settings, engine):
+    """Thresholds from the pre-screen cascade next to CNN-only, with the share of CNN calls avoided."""
+    rows = []
+    for recording in recordings:
+        for freq in freqs:
+            try:
+                db_levels, waves = threshold_waves(recording, freq, settings)
+            except Exception:
+                continue
+            with METRICS.time('threshold_inference'):
+                prediction = engine.predict_thresholds(np.expand_dims(waves, axis=2))
+            cnn_only = threshold_from_predictions((prediction > 0.5).astype(int).flatten(), db_levels)
+            y_pred, cnn_calls = cascade_predictions(waves, engine)
+            rows.append({'File Name': recording.name,
+                         'Frequency (Hz)': freq,
+                         'CNN-only Threshold': cnn_only,
+                         'Cascade Threshold': threshold_from_predictions(y_pred, db_levels),
+                         'CNN Calls (Cascade)': f'{cnn_calls}/{len(waves)}'})
+    report = pd.DataFrame(rows, columns=['File Name', 'Frequency (Hz)', 'CNN-only Threshold', 'Cascade Threshold', 'CNN Calls (Cascade)'])
+    agreement = (report['CNN-only Threshold'] == report['Cascade Threshold']).mean() if len(report) else np.nan
+    return report, agreement
+
+def dtype_accuracy_report(loaders, freqs, settings, engine):
+    """Compares the float32 pipeline against float64, each parsing the files anew.
+
+    Each loader takes a wave_dtype and returns its recording parsed with the
+    waves in that dtype, e.g. partial(load_recording, name, file_bytes,
+    parse_settings), so reading and scaling the samples are compared too.
+    Reports the largest absolute wave deviation and whether peaks, troughs and
+    thresholds are identical for every (file, freq).
+    """
+    rows = []
+    for load in loaders:
+        recording32 = load(wave_dtype=np.float32)
+        recording64 = load(wave_dtype=np.float64)
+        recording = recording32
+        for freq in freqs:
+            db_levels = recording.db_levels(settings.db_column, freq)
+            if not db_levels:
+                continue
+            max_deviation = 0.0
+            peaks_match = 0
+            troughs_match = 0
+            for db in db_levels:
+                _, y32, scaled32 = prepare_wave(recording32, freq, db, settings)
+                _, y64, scaled64 = prepare_wave(recording64, freq, db, settings)
+                max_deviation = max(max_deviation, float(np.max(np.abs(np.asarray(y32, dtype=np.float64) - np.asarray(y64)))))
+                peaks32, troughs32 = peak_finding(scaled32, engine)
+                peaks64, troughs64 = peak_finding(scaled64, engine)
+                peaks_match += np.array_equal(peaks32, peaks64)
+                troughs_match += np.array_equal(troughs32, troughs64)
+            try:
+                thresholds = (calculate_hearing_threshold(recording32, freq, settings, engine),
+                              calculate_hearing_threshold(recording64, freq, settings, engine))
+            except Exception:
+                thresholds = (np.nan, np.nan)
+            rows.append({'File Name': recording.name,
+                         'Frequency (Hz)': freq,
+                         'Max Wave Deviation': max_deviation,
+                         'Peaks Match': f'{peaks_match}/{len(db_levels)}',
+                         'Troughs Match': f'{troughs_match}/{len(db_levels)}',
+                         'Threshold (float32)': thresholds[0],
+                         'Threshold (float64)': thresholds[1]})
+    return pd.DataFrame(rows)
+
+def quantization_accuracy_report(recordings, freqs, settings, engine, quantized_engine):
+    """Compares a quantized engine's Wave I onsets against the float engine's.
+
+    For every (file, freq) reports how many of the predicted Wave I onset
+    indices are identical, with the largest difference in samples.
+    """
+    rows = []
+    for recording in recordings:
+        for freq in freqs:
+            positions = first_wave_positions(recording, settings, [freq])
+            if positions.size == 0:
+                continue
+            _, scaled = prepared_waves(recording, positions, settings)
+            onsets = predict_wave_i_onsets(scaled, engine)
+            quantized_onsets = predict_wave_i_onsets(scaled, quantized_engine)
+            rows.append({'File Name': recording.name,
+                         'Frequency (Hz)': freq,
+                         'Onsets Match': f'{np.sum(onsets == quantized_onsets)}/{len(onsets)}',
+                         'Max Onset Difference': int(np.max(np.abs(onsets - quantized_onsets)))})
+    return pd.DataFrame(rows, columns=['File Name', 'Frequency (Hz)', 'Onsets Match', 'Max Onset Difference'])
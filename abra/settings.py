@@ -0,0 +1,60 @@
+import hashlib
+import json
+from dataclasses import asdict, dataclass, field
+
+import numpy as np
+import pandas as pd
+
+@dataclass(frozen=True)
+class Settings:
+    """Everything an analysis depends on besides the recording and the models.
+
+    level selects the dB column: 'Level(dB)' when True, 'PostAtten(dB)'
+    (attenuation) otherwise, in which case calibration_levels maps
+    (file name, frequency) to the calibration level attenuations are
+    subtracted from. units is what the data was recorded in and return_units
+    what amplitudes are reported in ('Microvolts' or 'Nanovolts'). click and
+    rp describe how .arf files are read.
+    """
+    level: bool = True
+    units: str = 'Microvolts'
+    return_units: str = 'Microvolts'
+    time_scale: float = 10.0
+    multiply_y_factor: float = 1.0
+    calibration_levels: dict = field(default_factory=dict)
+    threshold_cascade: bool = False
+    click: bool = False
+    rp: bool = False
+
+    @property
+    def db_column(self):
+        return 'Level(dB)' if self.level else 'PostAtten(dB)'
+
+    @property
+    def amplitude_unit(self):
+        return 'nV' if self.return_units == 'Nanovolts' else 'μV'
+
+    def calibration_level(self, file_name, freq):
+        return self.calibration_levels[(file_name, freq)]
+
+    def reported_db(self, file_name, freq, db):
+        # dB as shown to the user: the level itself, or the calibrated level for an attenuation
+        if self.level:
+            return db
+        return self.calibration_level(file_name, freq) - db
+
+    def reported_dbs(self, file_name, freqs, dbs):
+        # reported_db over arrays of one file's frequencies and dB values, looking each frequency up once
+        dbs = np.asarray(dbs)
+        if self.level:
+            return dbs
+        freqs = pd.Series(freqs)
+        levels = {freq: self.calibration_level(file_name, freq) for freq in freqs.unique()}
+        return freqs.map(levels).to_numpy(dtype=float) - dbs
+
+    def fingerprint(self, file_name):
+        # Short hash of the settings that affect one file's results
+        settings = {name: value for name, value in asdict(self).items() if name not in ('calibration_levels', 'rp')}
+        if not self.level:
+            settings['calibration'] = sorted((str(hz), value) for (name, hz), value in self.calibration_levels.items() if name == file_name)
+        return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()[:16]
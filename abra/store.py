@@ -0,0 +1,160 @@
+import datetime
+import hashlib
+import os
+import sqlite3
+from contextlib import closing
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from .metrics import METRICS
+from .peaks import wave_i_metrics_table
+from .recording import WAVE_DTYPE
+from .tables import THRESHOLD_COLUMNS, metrics_columns, threshold_rows
+
+RESULTS_DB_PATH = os.environ.get('ABRA_RESULTS_DB', 'abra_results.sqlite')
+# Part of every stored result's key: bump whenever preprocessing, peak finding or
+# threshold logic changes what an analysis returns, so older results are recomputed
+ANALYSIS_VERSION = 1
+
+RESULTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    file_hash TEXT, model_version TEXT, settings_hash TEXT, kind TEXT, file_name TEXT, created TEXT,
+    PRIMARY KEY (file_hash, model_version, settings_hash, kind)
+);
+CREATE TABLE IF NOT EXISTS thresholds (
+    file_hash TEXT, model_version TEXT, settings_hash TEXT, freq, threshold REAL,
+    PRIMARY KEY (file_hash, model_version, settings_hash, freq)
+);
+CREATE TABLE IF NOT EXISTS wave_metrics (
+    file_hash TEXT, model_version TEXT, settings_hash TEXT, freq, db,
+    amplitude REAL, latency REAL, amplitude_ratio REAL,
+    PRIMARY KEY (file_hash, model_version, settings_hash, freq, db)
+);
+"""
+
+def model_version(paths, quantization='float', wave_dtype=WAVE_DTYPE):
+    # Stored results are only reused while every model file, how the models are run, the
+    # analysis code and the dtype waves are analysed in (ABRA_WAVE_DTYPE) are unchanged
+    digest = hashlib.sha256(f'analysis {ANALYSIS_VERSION} {np.dtype(wave_dtype).name}'.encode())
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    if quantization != 'float':
+        digest.update(quantization.encode())
+    return digest.hexdigest()[:16]
+
+def sql_value(value):
+    # Freq/dB are numpy or python numbers, or 'Click'; store them in one comparable form
+    if isinstance(value, str):
+        return value
+    return float(value)
+
+def sql_float(value):
+    return None if pd.isna(value) else float(value)
+
+def nan_if_none(value):
+    return np.nan if value is None else value
+
+class ResultsStore:
+    """SQLite store of thresholds and Wave I metrics.
+
+    Rows are keyed by (file content hash, model version, settings hash), so an
+    unchanged recording analysed with the same models and settings is never
+    recomputed. Connections are opened per call so jobs on other threads can
+    use the same store.
+    """
+    def __init__(self, model_version, path=RESULTS_DB_PATH):
+        self.model_version = model_version
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            conn.executescript(RESULTS_SCHEMA)
+        METRICS.set_gauge('abra_cache_bytes', partial(os.path.getsize, path), cache='results_store')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def key(self, recording, settings):
+        return (recording.content_hash, self.model_version, settings.fingerprint(recording.name))
+
+    def has(self, key, kind):
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT 1 FROM analyses WHERE file_hash=? AND model_version=? AND settings_hash=? AND kind=?',
+                               (*key, kind)).fetchone()
+        return row is not None
+
+    def _mark(self, conn, key, kind, file_name):
+        conn.execute('INSERT OR REPLACE INTO analyses VALUES (?, ?, ?, ?, ?, ?)',
+                     (*key, kind, file_name, datetime.datetime.now().isoformat()))
+
+    def thresholds(self, key):
+        if not self.has(key, 'thresholds'):
+            return None
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT freq, threshold FROM thresholds WHERE file_hash=? AND model_version=? AND settings_hash=?',
+                                key).fetchall()
+        return {freq: nan_if_none(threshold) for freq, threshold in rows}
+
+    def put_thresholds(self, key, file_name, thresholds):
+        with closing(self._connect()) as conn, conn:
+            conn.executemany('INSERT OR REPLACE INTO thresholds VALUES (?, ?, ?, ?, ?)',
+                             [(*key, freq, sql_float(threshold)) for freq, threshold in thresholds.items()])
+            self._mark(conn, key, 'thresholds', file_name)
+
+    def wave_metrics(self, key):
+        if not self.has(key, 'wave_metrics'):
+            return None
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT freq, db, amplitude, latency, amplitude_ratio FROM wave_metrics '
+                                'WHERE file_hash=? AND model_version=? AND settings_hash=?', key).fetchall()
+        return {(freq, db): tuple(nan_if_none(v) for v in values) for freq, db, *values in rows}
+
+    def put_wave_metrics(self, key, file_name, metrics):
+        with closing(self._connect()) as conn, conn:
+            conn.executemany('INSERT OR REPLACE INTO wave_metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             [(*key, freq, db, *map(sql_float, values)) for (freq, db), values in metrics.items()])
+            self._mark(conn, key, 'wave_metrics', file_name)
+
+    def all_thresholds(self, recording, settings, engine):
+        # {freq: threshold} for every frequency of a recording, computed once per key
+        key = self.key(recording, settings)
+        thresholds = self.thresholds(key)
+        METRICS.cache_lookup('results_store_thresholds', thresholds is not None)
+        if thresholds is None:
+            rows = threshold_rows(recording, recording.freqs, settings, engine)
+            thresholds = {sql_value(row['Frequency']): row['Threshold'] for row in rows}
+            # threshold_rows gives NaN where the analysis failed (e.g. a lost inference worker);
+            # those are retried on the next call rather than stored for good
+            if not any(pd.isna(threshold) for threshold in thresholds.values()):
+                self.put_thresholds(key, recording.name, thresholds)
+        return thresholds
+
+    def threshold_rows(self, recording, freqs, settings, engine):
+        # Same rows as tables.threshold_rows, computing only recordings the store hasn't seen
+        thresholds = self.all_thresholds(recording, settings, engine)
+        for hz in freqs:
+            yield dict(zip(THRESHOLD_COLUMNS, [recording.name, hz, thresholds.get(sql_value(hz), np.nan)]))
+
+    def metrics_rows(self, recording, freqs, db_levels, settings, engine):
+        # Same rows as tables.metrics_rows, computing only recordings the store hasn't seen
+        key = self.key(recording, settings)
+        thresholds = self.all_thresholds(recording, settings, engine)
+
+        metrics = self.wave_metrics(key)
+        METRICS.cache_lookup('results_store_metrics', metrics is not None)
+        if metrics is None:
+            table = wave_i_metrics_table(recording, settings, engine)
+            metrics = {(sql_value(freq), sql_value(db)): values
+                       for freq, db, *values in table.itertuples(index=False)}
+            self.put_wave_metrics(key, recording.name, metrics)
+
+        columns = metrics_columns(settings)
+        for freq in freqs:
+            threshold = thresholds.get(sql_value(freq), np.nan)
+            for db in db_levels:
+                values = metrics.get((sql_value(freq), sql_value(db)))
+                if values is not None:
+                    yield dict(zip(columns, [recording.name, freq, settings.reported_db(recording.name, freq, db), *values, threshold]))
@@ -0,0 +1,65 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from .peaks import wave_i_metrics_table
+from .thresholds import calculate_hearing_threshold
+
+THRESHOLD_COLUMNS = ['Filename', 'Frequency', 'Threshold']
+
+logger = logging.getLogger(__name__)
+
+def metrics_columns(settings):
+    return ['File Name', 'Frequency (Hz)', 'dB Level', f'Wave I amplitude (P1-T1) ({settings.amplitude_unit})',
+            'Latency to First Peak (ms)', 'Amplitude Ratio (Peak1/Peak4)', 'Estimated Threshold']
+
+def threshold_rows(recording, freqs, settings, engine):
+    for hz in freqs:
+        thresh = np.nan
+        try:
+            thresh = calculate_hearing_threshold(recording, hz, settings, engine)
+        except Exception:
+            logger.exception('Threshold failed for %s at %s Hz', recording.name, hz)
+        yield dict(zip(THRESHOLD_COLUMNS, [recording.name, hz, thresh]))
+
+def metrics_table(recording, freqs, db_levels, settings, engine):
+    # The metrics_columns() table of one recording, ordered by freqs then dB
+    db_column = settings.db_column
+    table = wave_i_metrics_table(recording, settings, engine, freqs)
+    table = table[table[db_column].isin(list(db_levels))]
+
+    thresholds = {}
+    for freq in table['Freq(Hz)'].unique():
+        try:
+            thresholds[freq] = calculate_hearing_threshold(recording, freq, settings, engine)
+        except Exception:
+            logger.exception('Threshold failed for %s at %s Hz', recording.name, freq)
+            thresholds[freq] = np.nan
+
+    order = {freq: i for i, freq in enumerate(freqs)}
+    table = table.assign(order=table['Freq(Hz)'].map(order)).sort_values(['order', db_column], kind='stable')
+    return pd.DataFrame(dict(zip(metrics_columns(settings), [
+        recording.name,
+        table['Freq(Hz)'].to_numpy(),
+        settings.reported_dbs(recording.name, table['Freq(Hz)'].to_numpy(), table[db_column].to_numpy()),
+        table['amplitude'].to_numpy(),
+        table['latency'].to_numpy(),
+        table['ratio'].to_numpy(),
+        table['Freq(Hz)'].map(thresholds).to_numpy(),
+    ])))
+
+def metrics_rows(recording, freqs, db_levels, settings, engine):
+    # Yields the rows of metrics_table one frequency at a time, so background jobs can show and cancel them per frequency
+    for freq in freqs:
+        yield from metrics_table(recording, [freq], db_levels, settings, engine).to_dict('records')
+
+def analyze_recording(recording, settings, engine, store=None):
+    # Thresholds and Wave I metrics for every (freq, dB) a recording contains, as two lists of rows
+    freqs = recording.freqs
+    db_levels = recording.db_levels(settings.db_column)
+    if store is not None:
+        return (list(store.threshold_rows(recording, freqs, settings, engine)),
+                list(store.metrics_rows(recording, freqs, db_levels, settings, engine)))
+    return (list(threshold_rows(recording, freqs, settings, engine)),
+            list(metrics_rows(recording, freqs, db_levels, settings, engine)))
@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+
+from .metrics import METRICS
+from .preprocessing import interpolate_and_smooth, scale_waves, wave_dtype
+
+# engine is any object with predict_thresholds(waves), like abra_inference.InProcessInference
+
+# Threshold pre-screen: samples of the Wave I-V window and the cut-offs for "clearly above/below"
+SCREEN_WINDOW = slice(0, 146)
+SCREEN_ABOVE_CORRELATION = 0.8
+SCREEN_BELOW_CORRELATION = 0.2
+SCREEN_BELOW_ENERGY_RATIO = 0.5
+
+def threshold_waves(recording, freq, settings, multiply_y_factor=1):
+    # Scaled 244-point waves of one frequency series, loudest first, with their dB values
+    db_column = settings.db_column
+
+    # Filter DataFrame to include only data for the specified frequency
+    df_filtered = recording.data[recording.data['Freq(Hz)'] == freq]
+
+    # Get unique dB levels for the filtered DataFrame
+    db_levels = sorted(df_filtered[db_column].unique(), reverse=True) if db_column == 'Level(dB)' else sorted(df_filtered[db_column].unique())
+    waves = []
+
+    with METRICS.time('preprocess'):
+        for db in db_levels:
+            khz = df_filtered[df_filtered[db_column] == np.abs(db)]
+            if not khz.empty:
+                index = khz.index.values[-1]
+                final = df_filtered.loc[index, '0':].dropna()
+                final = pd.to_numeric(final, errors='coerce')
+                final = np.array(final, dtype=wave_dtype(final))
+                final = interpolate_and_smooth(final[:244])
+                final *= multiply_y_factor
+
+                if settings.units == 'Nanovolts':
+                    final /= 1000
+
+                waves.append(final)
+        
+        waves = scale_waves(np.array(waves))
+
+    if db_column == 'PostAtten(dB)':
+        db_levels = np.array(db_levels)
+        calibration_level = np.full(len(db_levels), settings.calibration_level(recording.name, freq))
+        db_levels = calibration_level - db_levels
+
+    return db_levels, waves
+
+def threshold_from_predictions(y_pred, db_levels):
+    # Lowest level heard before two consecutive levels the model says are below threshold
+    lowest_db = db_levels[0]
+    previous_prediction = None
+
+    for p, d in zip(y_pred, db_levels):
+        if p == 0:
+            if previous_prediction == 0:
+                break
+            previous_prediction = p
+        else:
+            lowest_db = d
+            previous_prediction = p
+
+    return lowest_db
+
+def screen_levels(waves):
+    """Cheap classification of each level of a series, loudest first.
+
+    Levels whose Wave I-V window correlates strongly with the loudest response
+    are clearly above threshold (1). Levels that neither correlate with it nor
+    carry much of its energy are clearly below (0). Everything else is
+    ambiguous (-1) and needs the CNN.
+    """
+    window = waves[:, SCREEN_WINDOW]
+    centered = window - window.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(centered, axis=1)
+    correlation = centered @ centered[0] / np.maximum(norms * norms[0], 1e-12)
+    energy_ratio = norms / max(norms[0], 1e-12)
+
+    classes = np.full(len(waves), -1)
+    classes[correlation >= SCREEN_ABOVE_CORRELATION] = 1
+    classes[(correlation <= SCREEN_BELOW_CORRELATION) & (energy_ratio <= SCREEN_BELOW_ENERGY_RATIO)] = 0
+    return classes
+
+def cascade_predictions(waves, engine):
+    # Screen every level, then run the CNN once on the ambiguous levels the threshold walk can still reach
+    y_pred = screen_levels(waves)
+    below = np.flatnonzero((y_pred[:-1] == 0) & (y_pred[1:] == 0))
+    reachable = np.arange(len(y_pred)) < (below[0] if below.size else len(y_pred))
+    ambiguous = np.flatnonzero((y_pred == -1) & reachable)
+    if ambiguous.size:
+        with METRICS.time('threshold_inference'):
+            prediction = engine.predict_thresholds(np.expand_dims(waves[ambiguous], axis=2))
+        y_pred[ambiguous] = (prediction > 0.5).astype(int).flatten()
+    return y_pred, ambiguous.size
+
+def calculate_hearing_threshold(recording, freq, settings, engine, multiply_y_factor=1, cascade=None):
+    if cascade is None:
+        cascade = settings.threshold_cascade
+
+    db_levels, waves = threshold_waves(recording, freq, settings, multiply_y_factor)
+
+    # Perform prediction
+    if cascade:
+        y_pred, _ = cascade_predictions(waves, engine)
+    else:
+        with METRICS.time('threshold_inference'):
+            prediction = engine.predict_thresholds(np.expand_dims(waves, axis=2))
+        y_pred = (prediction > 0.5).astype(int).flatten()
+
+    return threshold_from_predictions(y_pred, db_levels)
+
+def calculate_unsupervised_threshold(recording, freq, settings):
+    """Threshold without the CNN: the lowest level whose wave DBSCAN leaves out of every cluster.
+
+    The waves of the frequency series (the last one per level) are projected
+    on their first two functional principal components, and DBSCAN's eps is
+    the knee of the nearest-neighbour distances. Returns the reported dB.
+    """
+    from kneed import KneeLocator
+    from skfda import FDataGrid
+    from skfda.preprocessing.dim_reduction import FPCA
+    from sklearn.cluster import DBSCAN
+    from sklearn.neighbors import NearestNeighbors
+
+    db_column = settings.db_column
+    df = recording.data[recording.data['Freq(Hz)'] == freq]
+    db_values = sorted(df[db_column].unique())
+    waves = []
+    for db in db_values:
+        final = pd.to_numeric(df.loc[df.index[df[db_column] == db][-1], '0':].dropna(), errors='coerce')
+        if len(final) > 244:
+            # Resampled over 245 points rather than interpolate_and_smooth's 246, as this method always was
+            final = np.interp(np.linspace(0, len(final), 245), np.arange(len(final)), final)[:244]
+        final = np.array(interpolate_and_smooth(final), dtype=np.float64)
+        final *= settings.multiply_y_factor
+        if settings.units == 'Nanovolts':
+            final /= 1000
+        waves.append(final)
+
+    with METRICS.time('unsupervised_threshold'):
+        projection = FPCA(n_components=2).fit_transform(FDataGrid(np.array(waves)))[:, :2]
+        distances, _ = NearestNeighbors(n_neighbors=2).fit(projection).kneighbors(projection)
+        distances = np.sort(distances, axis=0)[:, 1]
+        knee = KneeLocator(range(len(distances)), distances, curve='convex', direction='increasing').knee
+        clusters = DBSCAN(eps=distances[knee]).fit_predict(projection)
+
+    outliers = np.asarray(db_values)[clusters == -1]
+    if outliers.size == 0:
+        return np.nan
+    return np.min(settings.reported_dbs(recording.name, [freq] * len(outliers), outliers))
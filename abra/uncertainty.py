@@ -0,0 +1,71 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from .metrics import METRICS
+from .peaks import first_wave_positions, prepared_waves
+from .thresholds import calculate_hearing_threshold, threshold_from_predictions, threshold_waves
+
+logger = logging.getLogger(__name__)
+
+# engine needs predict_thresholds_dropout and predict_peaks_dropout, which give one
+# Monte Carlo dropout sample per input row
+
+def dropout_samples(predict, waves, passes):
+    # passes stochastic outputs per wave from one call on the stacked batch, as a (passes, n) array
+    waves = np.asarray(waves, dtype=np.float32)
+    with METRICS.time('dropout_inference'):
+        outputs = predict(np.concatenate([waves] * passes))
+    return np.asarray(outputs).reshape(passes, len(waves))
+
+def prediction_uncertainty(recording, freq, settings, engine, passes):
+    """Monte Carlo dropout spread of the threshold and the Wave I onsets of one frequency series.
+
+    Each CNN runs once, on the series' waves stacked passes times with dropout
+    left on. Returns the 95% interval of the per-pass thresholds and the
+    per-level standard deviation of the predicted onset in ms.
+    """
+    db_levels, waves = threshold_waves(recording, freq, settings)
+    probabilities = dropout_samples(engine.predict_thresholds_dropout, np.expand_dims(waves, axis=2), passes)
+    thresholds = [threshold_from_predictions((p > 0.5).astype(int), db_levels) for p in probabilities]
+    low, high = np.percentile(thresholds, [2.5, 97.5], method='nearest')
+
+    _, scaled = prepared_waves(recording, first_wave_positions(recording, settings, [freq]), settings)
+    onsets = dropout_samples(engine.predict_peaks_dropout, scaled, passes)
+    onset_sd = onsets.std(axis=0) * (10 / 244)  # 244 samples over 10 ms, as for latencies
+    return low, high, onset_sd
+
+# Series whose threshold interval or onset spread reach these are flagged for review
+REVIEW_THRESHOLD_CI_DB = 10
+REVIEW_ONSET_SD_MS = 0.1
+
+def uncertainty_report(recordings, freqs, settings, engine, passes):
+    # A series whose analysis fails is logged and kept with NaN values, flagged for review
+    rows = []
+    for recording in recordings:
+        for freq in freqs:
+            if not (recording.data['Freq(Hz)'] == freq).any():
+                continue
+            try:
+                threshold = calculate_hearing_threshold(recording, freq, settings, engine)
+                low, high, onset_sd = prediction_uncertainty(recording, freq, settings, engine, passes)
+            except Exception:
+                logger.exception('Uncertainty failed for %s at %s Hz', recording.name, freq)
+                rows.append({'File Name': recording.name,
+                             'Frequency (Hz)': freq,
+                             'Threshold': np.nan,
+                             'Threshold 95% CI': 'failed',
+                             'Median Wave I Onset SD (ms)': np.nan,
+                             'Max Wave I Onset SD (ms)': np.nan,
+                             'Review': True})
+                continue
+            rows.append({'File Name': recording.name,
+                         'Frequency (Hz)': freq,
+                         'Threshold': threshold,
+                         'Threshold 95% CI': f'{low:g} to {high:g}',
+                         'Median Wave I Onset SD (ms)': np.median(onset_sd),
+                         'Max Wave I Onset SD (ms)': onset_sd.max(),
+                         'Review': high - low >= REVIEW_THRESHOLD_CI_DB or onset_sd.max() >= REVIEW_ONSET_SD_MS})
+    return pd.DataFrame(rows, columns=['File Name', 'Frequency (Hz)', 'Threshold', 'Threshold 95% CI',
+                                       'Median Wave I Onset SD (ms)', 'Max Wave I Onset SD (ms)', 'Review'])
@@ -0,0 +1,99 @@
+from time import perf_counter
+
+import numpy as np
+
+from .metrics import METRICS
+
+ALIGNMENT_MODES = ['Fast preview (shift)', 'Fast preview (shift + warp)', 'Full SRSF']
+
+def standardize_rows(waves):
+    centered = waves - waves.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(centered, axis=1, keepdims=True)
+    return centered / np.where(norms > 0, norms, 1)
+
+def alignment_quality(waves):
+    # Mean correlation of each wave with the mean wave shape; 1 when all waves line up exactly
+    standardized = standardize_rows(np.asarray(waves, dtype=np.float64))
+    template = standardize_rows(standardized.mean(axis=0, keepdims=True))[0]
+    return float((standardized @ template).mean())
+
+def shift_align(waves, max_shift=None, passes=2):
+    """Shifts every row of waves onto their mean shape by FFT cross-correlation.
+
+    All rows are aligned at once; max_shift (samples) defaults to a quarter of
+    the wave. Returns the shifted waves (edges padded with the end samples) and
+    the shift of each row.
+    """
+    n, m = waves.shape
+    max_shift = m // 4 if max_shift is None else max_shift
+    size = 2 * m
+    lags = np.r_[0:m, -m:0]
+    allowed = np.abs(lags) <= max_shift
+    aligned = waves
+    shifts = np.zeros(n, dtype=int)
+    for _ in range(passes):
+        template = standardize_rows(aligned).mean(axis=0)
+        spectrum = np.fft.rfft(standardize_rows(waves), size, axis=1) * np.conj(np.fft.rfft(template, size))
+        correlation = np.fft.irfft(spectrum, size, axis=1)
+        shifts = lags[np.where(allowed, correlation, -np.inf).argmax(axis=1)]
+        aligned = np.take_along_axis(waves, np.clip(np.arange(m) + shifts[:, None], 0, m - 1), axis=1)
+    return aligned, shifts
+
+def sample_rows(waves, positions):
+    # Linear interpolation of each row of waves at its own (fractional) sample positions
+    m = waves.shape[1]
+    positions = np.clip(positions, 0, m - 1)
+    left = np.minimum(np.floor(positions).astype(int), m - 2)
+    weight = positions - left
+    return np.take_along_axis(waves, left, axis=1) * (1 - weight) + np.take_along_axis(waves, left + 1, axis=1) * weight
+
+def piecewise_linear_warp(waves, knots=3, steps=9, sweeps=2):
+    """Low-order time warp: moves knots interior knots of a piecewise-linear time axis per row.
+
+    The knots are fitted by coordinate descent over a grid of offsets, for all
+    rows at once, against the mean shape of the rows. Offsets stay within a
+    third of the knot spacing so the warp is always monotonic.
+    """
+    n, m = waves.shape
+    grid = np.linspace(0, m - 1, knots + 2)
+    candidates = np.linspace(-1, 1, steps) * (grid[1] - grid[0]) / 3
+    segment = np.clip(np.searchsorted(grid, np.arange(m), side='right') - 1, 0, knots)
+    fraction = (np.arange(m) - grid[segment]) / (grid[segment + 1] - grid[segment])
+
+    def warped(offsets):
+        moved = grid + offsets
+        return sample_rows(waves, moved[:, segment] * (1 - fraction) + moved[:, segment + 1] * fraction)
+
+    template = standardize_rows(waves).mean(axis=0)
+    offsets = np.zeros((n, knots + 2))
+    for _ in range(sweeps):
+        for k in range(1, knots + 1):
+            scores = np.empty((steps, n))
+            for c, candidate in enumerate(candidates):
+                trial = offsets.copy()
+                trial[:, k] = candidate
+                scores[c] = standardize_rows(warped(trial)) @ template
+            offsets[:, k] = candidates[scores.argmax(axis=0)]
+    return warped(offsets)
+
+def align_waves(waves, time, mode, cores=-1):
+    # Aligns the waves of one frequency (one row per dB level); cores is the SRSF worker count
+    with METRICS.time('warping', mode=mode):
+        if mode == 'Full SRSF':
+            import fdasrsf as fs
+
+            obj = fs.fdawarp(waves.T, time)
+            obj.srsf_align(parallel=True, cores=cores)
+            return obj.fn.T
+        aligned, _ = shift_align(waves)
+        if mode == 'Fast preview (shift + warp)':
+            aligned = piecewise_linear_warp(aligned)
+        return aligned
+
+def align_waves_with_summary(waves, time, mode, cores=-1):
+    # Aligned waves and a one-line summary of how well they line up before and after
+    start = perf_counter()
+    aligned = align_waves(waves, time, mode, cores)
+    elapsed = perf_counter() - start
+    summary = f'{mode}: correlation with mean shape {alignment_quality(waves):.3f} → {alignment_quality(aligned):.3f} ({elapsed * 1000:.0f} ms)'
+    return aligned, summary
@@ -0,0 +1,360 @@
+import argparse
+import ipaddress
+import os
+import queue
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from abra_runtime import configure_tensorflow, configure_torch
+from abra.metrics import METRICS, start_exporters
+
+import numpy as np
+import tensorflow as tf
+import torch
+import torch.nn as nn
+from tensorflow.keras.layers import Dropout
+from tensorflow.keras.models import load_model
+
+configure_torch(torch)
+configure_tensorflow(tf)
+
+# Model loading and inference for ABRA, shared by the app and the inference worker.
+# Run `python abra_inference.py` to start a worker that owns both models and batches
+# requests from every connected session; point the app at it with ABRA_INFERENCE_WORKER.
+
+THRESHOLD_MODEL_PATH = 'models/abr_cnn_aug_norm_std.keras'
+PEAK_MODEL_PATH = './models/waveI_cnn_model1.pth'
+DEFAULT_ADDRESS = 'localhost:8765'
+# The worker unpickles what clients send, so anyone holding the key can run code on it.
+# Outside loopback addresses the key has to come from ABRA_INFERENCE_AUTHKEY or from the
+# file named by ABRA_INFERENCE_AUTHKEY_FILE; the well-known LOOPBACK_AUTHKEY is only
+# accepted on localhost.
+LOOPBACK_AUTHKEY = b'abra'
+BATCH_BUCKETS = (1, 4, 16, 64, 128, 256, 512, 1024)
+# After losing its worker, how long a client runs the models in-process before trying the worker again
+WORKER_RETRY_SECONDS = 30.0
+# 'float' runs the models as trained; 'int8' runs a quantized copy of the peak finding model (see quantize_peak_model)
+QUANTIZATION_MODES = ('float', 'int8')
+QUANTIZATION = os.environ.get('ABRA_QUANTIZATION', 'float')
+
+# Define the CNN model
+class CNN(nn.Module):
+    def __init__(self, dropout_prob=0.1):
+        super(CNN, self).__init__()
+        self.conv1 = nn.Conv1d(in_channels=1, out_channels=16, kernel_size=3, stride=1, padding=1)
+        self.pool = nn.MaxPool1d(kernel_size=2, stride=2, padding=0)
+        self.conv2 = nn.Conv1d(in_channels=16, out_channels=32, kernel_size=3, stride=1, padding=1)
+        self.fc1 = nn.Linear(32 * 61, 128)
+        self.fc2 = nn.Linear(128, 1)
+        self.dropout = nn.Dropout(dropout_prob)
+        self.batch_norm1 = nn.BatchNorm1d(16)
+        self.batch_norm2 = nn.BatchNorm1d(32)
+
+    def forward(self, x, mc_dropout=False):
+        # mc_dropout keeps dropout on in eval mode without switching the shared model to training
+        dropout = lambda x: nn.functional.dropout(x, self.dropout.p, training=self.training or mc_dropout)
+        x = self.pool(nn.functional.relu(self.batch_norm1(self.conv1(x))))
+        x = dropout(x)
+        x = self.pool(nn.functional.relu(self.batch_norm2(self.conv2(x))))
+        x = dropout(x)
+        x = x.view(-1, 32 * 61)
+        x = nn.functional.relu(self.fc1(x))
+        x = dropout(x)
+        x = self.fc2(x)
+        return x
+
+def load_peak_model(path=PEAK_MODEL_PATH):
+    METRICS.inc('abra_model_loads_total', model='peak')
+    with METRICS.time('model_load', model='peak'):
+        peak_finding_model = CNN()
+        peak_finding_model.load_state_dict(torch.load(path))
+        peak_finding_model.eval()
+    return peak_finding_model
+
+def load_threshold_model(path=THRESHOLD_MODEL_PATH):
+    METRICS.inc('abra_model_loads_total', model='threshold')
+    with METRICS.time('model_load', model='threshold'):
+        thresholding_model = load_model(path)
+    thresholding_model.steps_per_execution = 1
+    return thresholding_model
+
+def quantize_peak_model(model):
+    """int8 copy of the peak finding CNN with dynamically quantized linear layers.
+
+    fc1 (1952x128) holds most of the multiply-adds; its weights are stored
+    as int8 and activations are quantized per batch, so no calibration is
+    needed. The convolutions stay float32.
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+def is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def inference_authkey(address, environ=os.environ):
+    """The worker key for address: ABRA_INFERENCE_AUTHKEY, else the contents of ABRA_INFERENCE_AUTHKEY_FILE.
+
+    Without either, only loopback addresses are allowed, with LOOPBACK_AUTHKEY.
+    """
+    if environ.get('ABRA_INFERENCE_AUTHKEY'):
+        return environ['ABRA_INFERENCE_AUTHKEY'].encode()
+    if environ.get('ABRA_INFERENCE_AUTHKEY_FILE'):
+        with open(environ['ABRA_INFERENCE_AUTHKEY_FILE'], 'rb') as f:
+            key = f.read().strip()
+        if not key:
+            raise ValueError(f"{environ['ABRA_INFERENCE_AUTHKEY_FILE']} is empty")
+        return key
+    if is_loopback(parse_address(address)[0]):
+        return LOOPBACK_AUTHKEY
+    raise ValueError(f'The inference worker at {address} is not on a loopback address; '
+                     'set ABRA_INFERENCE_AUTHKEY or ABRA_INFERENCE_AUTHKEY_FILE to a secret key')
+
+class InProcessInference:
+    """Both models loaded in this process.
+
+    ``predict_peaks`` takes an (n, 244) batch of scaled waves and returns the
+    raw Wave I onset output per wave; ``predict_thresholds`` takes an
+    (n, 244, 1) batch and returns the probability that each wave is above
+    threshold. The ``_dropout`` variants do the same with dropout left on, so
+    every row gets an independent Monte Carlo sample.
+
+    With ``quantization='int8'`` the peak predictions run on a quantized copy
+    of the peak finding model. Thresholds always come from the float model:
+    an int8 conversion of it changed too many thresholds to be worth its
+    speed.
+    """
+    def __init__(self, peak_model_path=PEAK_MODEL_PATH, threshold_model_path=THRESHOLD_MODEL_PATH, quantization=QUANTIZATION):
+        if quantization not in QUANTIZATION_MODES:
+            raise ValueError(f'Unknown quantization {quantization!r}, expected one of {QUANTIZATION_MODES}')
+        self.quantization = quantization
+        self.description = 'in-process' if quantization == 'float' else f'in-process, {quantization}'
+        self.peak_model = load_peak_model(peak_model_path)
+        self.threshold_model = load_threshold_model(threshold_model_path)
+        if quantization == 'int8':
+            self.peak_model = quantize_peak_model(self.peak_model)
+        self._threshold_lock = threading.Lock()
+
+    def predict_peaks(self, waves):
+        waves = torch.from_numpy(np.asarray(waves, dtype=np.float32)).unsqueeze(1)
+        with torch.no_grad():
+            outputs = self.peak_model(waves)
+        return outputs.numpy()[:, 0]
+
+    def predict_thresholds(self, waves):
+        waves = np.asarray(waves, dtype=np.float32)
+        with self._threshold_lock:
+            prediction = self.threshold_model.predict(waves, verbose=0)
+        return prediction.flatten()
+
+    def predict_peaks_dropout(self, waves):
+        waves = torch.from_numpy(np.asarray(waves, dtype=np.float32)).unsqueeze(1)
+        with torch.no_grad():
+            outputs = self.peak_model(waves, mc_dropout=True)
+        return outputs.numpy()[:, 0]
+
+    def predict_thresholds_dropout(self, waves):
+        # Layer by layer so only the dropout layers run in training mode, not batch normalization
+        x = np.asarray(waves, dtype=np.float32)
+        with self._threshold_lock:
+            for layer in self.threshold_model.layers:
+                x = layer(x, training=isinstance(layer, Dropout))
+        return np.asarray(x).flatten()
+
+class MicroBatcher:
+    """Combines concurrent requests into one model call.
+
+    The first request waits at most ``max_delay`` seconds for others to join
+    its batch; the batch is run early once it holds ``max_batch`` waves.
+    """
+    def __init__(self, run, max_batch=256, max_delay=0.005):
+        self.run = run
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def submit(self, waves):
+        request = {'waves': waves, 'done': threading.Event(), 'result': None, 'error': None}
+        self._queue.put(request)
+        request['done'].wait()
+        if request['error'] is not None:
+            raise request['error']
+        return request['result']
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0]['waves'])
+            deadline = time.monotonic() + self.max_delay
+            while size < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request['waves'])
+
+            METRICS.observe('abra_inference_batch_waves', size, BATCH_BUCKETS)
+            try:
+                outputs = self.run(np.concatenate([request['waves'] for request in batch]))
+                splits = np.cumsum([len(request['waves']) for request in batch])[:-1]
+                for request, result in zip(batch, np.split(outputs, splits)):
+                    request['result'] = result
+            except Exception as e:
+                for request in batch:
+                    request['error'] = e
+            for request in batch:
+                request['done'].set()
+
+class InferenceClient:
+    """Sends wave batches to a running inference worker.
+
+    Each thread gets its own connection so requests from background jobs and
+    sessions can be batched together by the worker. A broken connection, e.g.
+    after the worker restarted, is dropped and the request retried once on a
+    new one; if that fails too, requests run on in-process models (loaded on
+    first use) for WORKER_RETRY_SECONDS before the worker is tried again.
+    """
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None):
+        self.address = parse_address(address)
+        self.authkey = authkey if authkey is not None else inference_authkey(address)
+        self.address_text = address
+        self.quantization = None
+        self._local = threading.local()
+        self._fallback = None
+        self._fallback_lock = threading.Lock()
+        self._retry_worker_at = 0.0
+
+    @property
+    def description(self):
+        if time.monotonic() < self._retry_worker_at:
+            return f'in-process, worker at {self.address_text} unreachable'
+        if self.quantization in (None, 'float'):
+            return f'worker at {self.address_text}'
+        return f'worker at {self.address_text}, {self.quantization}'
+
+    def _send(self, kind, waves):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = Client(self.address, authkey=self.authkey)
+        try:
+            conn.send((kind, waves))
+            return conn.recv()
+        except (OSError, EOFError):
+            # Never reused: a connection to a worker that went away stays broken
+            self._local.conn = None
+            conn.close()
+            raise
+
+    def _in_process(self, kind, waves):
+        with self._fallback_lock:
+            if self._fallback is None:
+                self._fallback = InProcessInference(quantization=self.quantization or QUANTIZATION)
+        return getattr(self._fallback, f'predict_{kind}')(waves)
+
+    def _call(self, kind, waves):
+        if time.monotonic() < self._retry_worker_at:
+            return self._in_process(kind, waves)
+        try:
+            try:
+                status, result = self._send(kind, waves)
+            except (OSError, EOFError):
+                status, result = self._send(kind, waves)
+        except (OSError, EOFError, AuthenticationError):
+            METRICS.inc('abra_inference_fallbacks_total')
+            self._retry_worker_at = time.monotonic() + WORKER_RETRY_SECONDS
+            return self._in_process(kind, waves)
+        if status == 'error':
+            raise RuntimeError(f'Inference worker failed: {result}')
+        return result
+
+    def ping(self):
+        # Also learns which models the worker runs. Raises instead of falling back, so connect_inference can tell there is no worker
+        _, self.quantization = self._send('ping', None)
+        return self.quantization
+
+    def predict_peaks(self, waves):
+        return self._call('peaks', np.asarray(waves, dtype=np.float32))
+
+    def predict_thresholds(self, waves):
+        return self._call('thresholds', np.asarray(waves, dtype=np.float32))
+
+    def predict_peaks_dropout(self, waves):
+        return self._call('peaks_dropout', np.asarray(waves, dtype=np.float32))
+
+    def predict_thresholds_dropout(self, waves):
+        return self._call('thresholds_dropout', np.asarray(waves, dtype=np.float32))
+
+def connect_inference(address=None, authkey=None):
+    # A client for the worker at address, or the models in this process when there is no worker.
+    # A missing key for a non-loopback worker is a configuration error rather than "no worker".
+    if address:
+        try:
+            client = InferenceClient(address, authkey)
+            client.ping()
+            return client
+        except (OSError, AuthenticationError):
+            pass
+    return InProcessInference()
+
+def handle_connection(conn, batchers, quantization):
+    with conn:
+        while True:
+            try:
+                kind, waves = conn.recv()
+            except EOFError:
+                return
+            try:
+                if kind == 'ping':
+                    conn.send(('ok', quantization))
+                else:
+                    conn.send(('ok', batchers[kind].submit(waves)))
+            except Exception as e:
+                conn.send(('error', repr(e)))
+
+def serve(address=DEFAULT_ADDRESS, authkey=None, max_batch=256, max_delay=0.005, quantization=QUANTIZATION):
+    if authkey is None:
+        authkey = inference_authkey(address)
+    start_exporters()
+    engine = InProcessInference(quantization=quantization)
+    batchers = {'peaks': MicroBatcher(engine.predict_peaks, max_batch, max_delay),
+                'thresholds': MicroBatcher(engine.predict_thresholds, max_batch, max_delay),
+                'peaks_dropout': MicroBatcher(engine.predict_peaks_dropout, max_batch, max_delay),
+                'thresholds_dropout': MicroBatcher(engine.predict_thresholds_dropout, max_batch, max_delay)}
+    with Listener(parse_address(address), authkey=authkey) as listener:
+        print(f'ABRA inference worker ({quantization}) listening on {address}')
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, AuthenticationError):
+                continue
+            threading.Thread(target=handle_connection, args=(conn, batchers, quantization), daemon=True).start()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Shared ABRA inference worker')
+    parser.add_argument('--address', default=DEFAULT_ADDRESS, help='host:port to listen on')
+    parser.add_argument('--authkey-file', help='file holding the key clients must present (default: ABRA_INFERENCE_AUTHKEY '
+                                               'or ABRA_INFERENCE_AUTHKEY_FILE; required unless --address is a loopback address)')
+    parser.add_argument('--max-batch', type=int, default=256, help='largest number of waves run in one batch')
+    parser.add_argument('--max-delay-ms', type=float, default=5.0, help='how long a request waits for others to batch with')
+    parser.add_argument('--quantization', choices=QUANTIZATION_MODES, default=QUANTIZATION, help='run the models as trained or int8-quantized')
+    args = parser.parse_args()
+    environ = {'ABRA_INFERENCE_AUTHKEY_FILE': args.authkey_file} if args.authkey_file else os.environ
+    try:
+        authkey = inference_authkey(args.address, environ)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    serve(args.address, authkey, args.max_batch, args.max_delay_ms / 1000, args.quantization)
@@ -0,0 +1,84 @@
+import json
+import os
+import sys
+import threading
+
+# Per-process CPU thread budget for ABRA.
+#
+# Every Streamlit session runs in the same server process, so these limits are
+# shared by all of them. They come from a JSON file named by ABRA_RUNTIME_CONFIG,
+# overridden by the environment variables in RUNTIME_VARIABLES. Import this module
+# before numpy, torch or TensorFlow: the BLAS/OpenMP limits are read when those
+# libraries load.
+
+RUNTIME_VARIABLES = {
+    # setting: environment variable
+    'threads': 'ABRA_THREADS',
+    'torch_threads': 'ABRA_TORCH_THREADS',
+    'tf_intra_op_threads': 'ABRA_TF_INTRA_OP_THREADS',
+    'tf_inter_op_threads': 'ABRA_TF_INTER_OP_THREADS',
+    'warp_workers': 'ABRA_WARP_WORKERS',
+    'analysis_workers': 'ABRA_ANALYSIS_WORKERS',
+}
+NATIVE_THREAD_VARIABLES = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+def load_runtime_settings(environ=os.environ):
+    settings = {}
+    path = environ.get('ABRA_RUNTIME_CONFIG')
+    if path:
+        with open(path) as f:
+            settings.update(json.load(f))
+    for name, variable in RUNTIME_VARIABLES.items():
+        if environ.get(variable):
+            settings[name] = int(environ[variable])
+
+    # Everything not set explicitly is sized from the overall budget
+    threads = settings.setdefault('threads', os.cpu_count() or 1)
+    settings.setdefault('torch_threads', threads)
+    settings.setdefault('tf_intra_op_threads', threads)
+    settings.setdefault('tf_inter_op_threads', min(2, threads))
+    settings.setdefault('warp_workers', threads)
+    settings.setdefault('analysis_workers', max(1, min(2, threads)))
+    return settings
+
+RUNTIME = load_runtime_settings()
+
+for variable in NATIVE_THREAD_VARIABLES:
+    os.environ.setdefault(variable, str(RUNTIME['threads']))
+
+# Background analyses (jobs and the folder watcher) wait for one of these before running
+analysis_slots = threading.BoundedSemaphore(RUNTIME['analysis_workers'])
+
+def configure_torch(torch):
+    torch.set_num_threads(RUNTIME['torch_threads'])
+    try:  # torch's inter-op pool gets the same size as TensorFlow's
+        torch.set_num_interop_threads(RUNTIME['tf_inter_op_threads'])
+    except RuntimeError:  # already set, or torch has started parallel work
+        pass
+
+def configure_tensorflow(tf):
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(RUNTIME['tf_intra_op_threads'])
+        tf.config.threading.set_inter_op_parallelism_threads(RUNTIME['tf_inter_op_threads'])
+    except RuntimeError:  # the TensorFlow runtime was initialised before this was called
+        pass
+
+def runtime_report():
+    """Configured and effective thread settings, as (setting, configured, effective) rows.
+
+    Effective values are read back from the libraries this process has loaded.
+    """
+    torch = sys.modules.get('torch')
+    tf = sys.modules.get('tensorflow')
+    effective = {
+        'threads': RUNTIME['threads'],
+        'torch_threads': torch.get_num_threads() if torch else None,
+        'tf_intra_op_threads': tf.config.threading.get_intra_op_parallelism_threads() if tf else None,
+        'tf_inter_op_threads': tf.config.threading.get_inter_op_parallelism_threads() if tf else None,
+        'warp_workers': RUNTIME['warp_workers'],
+        'analysis_workers': RUNTIME['analysis_workers'],
+    }
+    rows = [(name, RUNTIME[name], effective[name]) for name in RUNTIME_VARIABLES]
+    rows += [(variable, None, os.environ.get(variable)) for variable in NATIVE_THREAD_VARIABLES]
+    rows.append(('cpu_count', None, os.cpu_count()))
+    return rows
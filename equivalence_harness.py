@@ -0,0 +1,408 @@
+import argparse
+import ast
+import glob
+import json
+import os
+import struct
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.interpolate import CubicSpline
+from scipy.ndimage import gaussian_filter1d
+from scipy.signal import find_peaks
+from sklearn.preprocessing import StandardScaler, MinMaxScaler
+
+from abra import (WAVE_DTYPE, Recording, Settings, arf_to_df, arfread, calculate_hearing_threshold, peak_finding,
+                  prepare_wave, read_abr_csv, wave_i_metrics, wave_i_metrics_table)
+from abra.peaks import first_wave_positions, predict_wave_i_onsets, prepared_waves
+
+# Numerical-equivalence harness for ABRA's fast paths.
+#
+# Runs the baseline app's own functions (compiled out of ABRA_v1.0.0.py as it was at
+# BASELINE_COMMIT) next to the abra package's current ones on the bundled ABR_files and
+# synthetic recordings, and reports the largest wave deviations, exact-match rates for
+# peak/trough indices and thresholds, and candidate/reference timing ratios. Exits
+# non-zero when a comparison is outside its tolerance, so it can gate merges in CI:
+#
+#     python equivalence_harness.py --report equivalence.json
+#
+# --freeze writes the baseline's outputs on the bundled files to FIXTURES_DIR, which
+# tests/test_equivalence.py checks the package against without needing git history.
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_FILES = os.path.join(ROOT, 'ABR_files', '*')
+FIXTURES_DIR = os.path.join(ROOT, 'tests', 'fixtures', 'equivalence')
+SETTINGS = Settings()
+
+# The last commit before any fast path, and what is taken from its script
+BASELINE_COMMIT = '985da68771ef8dde2266860ccd123cec4f950329'
+BASELINE_SCRIPT = 'ABRA_v1.0.0.py'
+BASELINE_DEFINITIONS = ['CNN', 'get_str', 'arfread', 'interpolate_and_smooth', 'calculate_and_plot_wave',
+                        'calculate_hearing_threshold', 'peak_finding']
+BASELINE_PEAK_MODEL = os.path.join(ROOT, 'models', 'waveI_cnn_model1.pth')
+# abra_inference.THRESHOLD_MODEL_PATH, without importing torch along with it
+THRESHOLD_MODEL_PATH = 'models/abr_cnn_aug_norm_std.keras'
+
+def baseline_source(commit=BASELINE_COMMIT, script=BASELINE_SCRIPT):
+    return subprocess.run(['git', 'show', f'{commit}:{script}'], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+
+def load_model(path):
+    # The baseline loads the threshold model by its relative path on every call
+    from tensorflow.keras.models import load_model
+    return load_model(os.path.join(ROOT, path))
+
+class ThresholdEngine:
+    """The threshold model alone, predicting as InProcessInference does.
+
+    Threshold comparisons only need TensorFlow, so they can run where torch,
+    and with it abra_inference, is not installed.
+    """
+    def __init__(self, path=THRESHOLD_MODEL_PATH):
+        self.model = load_model(path)
+
+    def predict_thresholds(self, waves):
+        return self.model.predict(np.asarray(waves, dtype=np.float32), verbose=0).flatten()
+
+class Baseline:
+    """BASELINE_DEFINITIONS of the baseline script, run on their own.
+
+    The script itself is a Streamlit app and cannot be imported, so its
+    function and class definitions are compiled out of it and executed with
+    the globals they read (level, units, time_scale, ...) taken from settings.
+    The peak model is loaded as the baseline loaded it, and only when torch is
+    installed; peak_finding is unavailable otherwise.
+    """
+    def __init__(self, settings=SETTINGS, source=None):
+        tree = ast.parse(source or baseline_source())
+        try:
+            import torch
+        except ImportError:
+            torch = None
+        wanted = [name for name in BASELINE_DEFINITIONS if torch is not None or name != 'CNN']
+        definitions = [node for node in tree.body if isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name in wanted]
+        code = compile(ast.Module(body=definitions, type_ignores=[]), BASELINE_SCRIPT, 'exec')
+        script_globals = {
+            'np': np, 'pd': pd, 'struct': struct, 'CubicSpline': CubicSpline, 'StandardScaler': StandardScaler,
+            'MinMaxScaler': MinMaxScaler, 'gaussian_filter1d': gaussian_filter1d, 'find_peaks': find_peaks,
+            'load_model': load_model, 'torch': torch, 'nn': torch and torch.nn,
+            'level': settings.level, 'units': settings.units, 'time_scale': settings.time_scale,
+            'multiply_y_factor': settings.multiply_y_factor, 'calibration_levels': settings.calibration_levels,
+        }
+        self.namespace = dict(script_globals)
+        exec(code, self.namespace)
+        self.has_peak_model = torch is not None
+        if self.has_peak_model:
+            peak_model = self.namespace['CNN']()
+            peak_model.load_state_dict(torch.load(BASELINE_PEAK_MODEL))
+            peak_model.eval()
+            self.namespace['peak_finding_model'] = peak_model
+
+        # calculate_and_plot_wave hands its scaled wave straight to peak_finding; a copy of
+        # the definitions whose peak_finding returns its input gives that wave back
+        self._waves = dict(script_globals)
+        exec(code, self._waves)
+        self._waves['peak_finding'] = lambda wave: (np.asarray(wave, dtype=np.float64), None)
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['namespace'][name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def recording(self, path, click, rp=False):
+        # DataFrame as the baseline app built it; that code sits in the script body, not a function
+        if path.endswith('.arf'):
+            rows = []
+            for group in self.arfread(path, RP=rp)['groups']:
+                for rec in group['recs']:
+                    freq, db = ('Click', rec['Var1']) if click else (rec['Var1'], rec['Var2'])
+                    rows.append({'Freq(Hz)': freq, 'Level(dB)': db, **{f'{i}': v*1e6 for i, v in enumerate(rec['data'])}})
+            df = pd.DataFrame(rows)
+        elif pd.read_csv(path).shape[1] > 1:
+            df = pd.read_csv(path)
+        else:
+            df = pd.read_csv(path, skiprows=2)
+        df.name = os.path.basename(path)
+        return df
+
+    def wave(self, df, freq, db):
+        # (display wave, scaled 244-point wave) of calculate_and_plot_wave
+        _, y_values, scaled, _ = self._waves['calculate_and_plot_wave'](df, freq, db, None)
+        return np.asarray(y_values, dtype=np.float64), scaled
+
+    def threshold(self, df, freq):
+        return self.calculate_hearing_threshold(df, freq)
+
+# Inputs
+
+def synthetic_recording(seed, freqs=(8000.0, 16000.0), db_levels=range(0, 95, 5), npts=244, time_scale=10.0):
+    """ABR-like recording: five Gaussian waves whose amplitude grows and latency shrinks with level, plus noise."""
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, time_scale, npts)
+    threshold = rng.uniform(20, 50)
+    rows = []
+    for freq in freqs:
+        for db in db_levels:
+            gain = max(db - threshold, 0) / 40
+            latency_shift = 0.4 * (1 - db / 90)
+            wave = sum(a * gain * np.exp(-0.5 * ((t - (c + latency_shift)) / 0.15) ** 2)
+                       for a, c in [(1.0, 1.4), (-0.4, 2.0), (0.6, 2.6), (0.7, 3.6), (0.3, 4.8)])
+            wave = wave + rng.normal(0, 0.03, npts)
+            rows.append({'Freq(Hz)': freq, 'Level(dB)': float(db), **{f'{i}': v for i, v in enumerate(wave)}})
+    df = pd.DataFrame(rows)
+    df.name = f'synthetic_{seed}'
+    return df
+
+def is_click(path):
+    return 'click' in os.path.basename(path).lower()
+
+def candidate_recording(path):
+    if path.endswith('.arf'):
+        data = arf_to_df(arfread(path), is_click(path), 'Level(dB)')
+    else:
+        data = read_abr_csv(path)
+    return Recording(os.path.basename(path), data)
+
+def recordings(baseline, paths, n_synthetic):
+    # (name, candidate Recording, reference DataFrame) for every input
+    for path in paths:
+        candidate = candidate_recording(path)
+        yield candidate.name, candidate, baseline.recording(path, is_click(path))
+    for seed in range(n_synthetic):
+        reference = synthetic_recording(seed)
+        yield reference.name, Recording(reference.name, reference).with_wave_dtype(WAVE_DTYPE), reference
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+# Comparisons
+
+def compare_arfread(baseline, paths):
+    deviation, reference_time, candidate_time, headers_match = 0.0, 0.0, 0.0, True
+    for path in paths:
+        reference, t_ref = timed(baseline.arfread, path)
+        candidate, t_cand = timed(arfread, path)
+        reference_time += t_ref
+        candidate_time += t_cand
+        for ref_group, cand_group in zip(reference['groups'], candidate['groups']):
+            for ref_rec, cand_rec in zip(ref_group['recs'], cand_group['recs']):
+                deviation = max(deviation, float(np.max(np.abs(np.asarray(ref_rec['data']) - np.asarray(cand_rec['data'], dtype=np.float64)))))
+                headers_match &= all(ref_rec[k] == cand_rec[k] for k in ref_rec if k != 'data')
+    return {'max_abs_deviation': deviation, 'match_rate': float(headers_match), 'reference_s': reference_time, 'candidate_s': candidate_time}
+
+def compare_waves(baseline, engine, inputs):
+    # interpolate_and_smooth and scaling on every wave, then peak finding on the results
+    rows = {name: {'max_abs_deviation': 0.0, 'matches': 0, 'total': 0, 'reference_s': 0.0, 'candidate_s': 0.0}
+            for name in ['interpolate_and_smooth', 'scaling', 'peak_finding (peaks)', 'peak_finding (troughs)']}
+    for _, candidate, reference in inputs:
+        for freq in reference['Freq(Hz)'].unique():
+            for db in reference[reference['Freq(Hz)'] == freq]['Level(dB)'].unique():
+                (ref_y, ref_scaled), t_ref = timed(baseline.wave, reference, freq, db)
+                (_, cand_y, cand_scaled), t_cand = timed(prepare_wave, candidate, freq, db, SETTINGS)
+                for name, ref, cand in [('interpolate_and_smooth', ref_y, cand_y), ('scaling', ref_scaled, cand_scaled)]:
+                    row = rows[name]
+                    deviation = float(np.max(np.abs(ref - np.asarray(cand, dtype=np.float64))))
+                    row['max_abs_deviation'] = max(row['max_abs_deviation'], deviation)
+                    row['total'] += 1
+                    row['matches'] += deviation <= TOLERANCES[name][0]
+                    row['reference_s'] += t_ref
+                    row['candidate_s'] += t_cand
+
+                if not baseline.has_peak_model:
+                    continue
+                (ref_peaks, ref_troughs), t_ref = timed(baseline.peak_finding, ref_scaled)
+                (cand_peaks, cand_troughs), t_cand = timed(peak_finding, cand_scaled, engine)
+                for name, ref, cand in [('peak_finding (peaks)', ref_peaks, cand_peaks), ('peak_finding (troughs)', ref_troughs, cand_troughs)]:
+                    row = rows[name]
+                    row['matches'] += np.array_equal(ref, cand)
+                    row['total'] += 1
+                    row['reference_s'] += t_ref
+                    row['candidate_s'] += t_cand
+    results = {}
+    for name, row in rows.items():
+        total = row.pop('total')
+        matches = row.pop('matches')
+        if total:
+            results[name] = {**row, 'match_rate': matches / total}
+    return results
+
+def compare_thresholds(baseline, engine, inputs):
+    matches, total, deviation, reference_time, candidate_time = 0, 0, 0.0, 0.0, 0.0
+    for _, candidate, reference in inputs:
+        for freq in reference['Freq(Hz)'].unique():
+            ref, t_ref = timed(baseline.threshold, reference, freq)
+            cand, t_cand = timed(calculate_hearing_threshold, candidate, freq, SETTINGS, engine)
+            matches += ref == cand
+            total += 1
+            deviation = max(deviation, abs(float(ref) - float(cand)))
+            reference_time += t_ref
+            candidate_time += t_cand
+    return {'calculate_hearing_threshold': {'max_abs_deviation': deviation, 'match_rate': matches / total if total else 1.0,
+                                            'reference_s': reference_time, 'candidate_s': candidate_time}}
+
+def compare_metrics_table(engine, inputs):
+    # The batched metrics table against wave_i_metrics run one (freq, dB) at a time
+    deviation, matches, total, reference_time, candidate_time = 0.0, 0, 0, 0.0, 0.0
+    for _, candidate, _ in inputs:
+        table, t_cand = timed(wave_i_metrics_table, candidate, SETTINGS, engine)
+        candidate_time += t_cand
+        computed = {(freq, db): np.array(values, dtype=np.float64) for freq, db, *values in table.itertuples(index=False)}
+        for freq in candidate.freqs:
+            for db in candidate.db_levels('Level(dB)', freq):
+                try:
+                    ref, t_ref = timed(wave_i_metrics, candidate, freq, db, SETTINGS, engine)
+                except IndexError:  # peaks without a trough
+                    ref, t_ref = (np.nan, np.nan, np.nan), 0.0
+                reference_time += t_ref
+                total += 1
+                cand = computed.get((freq, db))
+                if ref is None or cand is None:
+                    matches += ref is None and cand is None
+                    continue
+                ref = np.array(ref, dtype=np.float64)
+                both = ~(np.isnan(ref) | np.isnan(cand))
+                if np.array_equal(np.isnan(ref), np.isnan(cand)):
+                    difference = float(np.max(np.abs(ref[both] - cand[both]), initial=0.0))
+                    deviation = max(deviation, difference)
+                    matches += difference <= TOLERANCES['wave_i_metrics_table'][0]
+    return {'wave_i_metrics_table': {'max_abs_deviation': deviation, 'match_rate': matches / total if total else 1.0,
+                                     'reference_s': reference_time, 'candidate_s': candidate_time}}
+
+def compare_quantization(engine, quantized_engine, inputs):
+    # Wave I onset indices of the quantized peak model against the float one; timings are float vs quantized
+    row = {'max_abs_deviation': 0.0, 'matches': 0, 'total': 0, 'reference_s': 0.0, 'candidate_s': 0.0}
+    for _, candidate, _ in inputs:
+        for freq in candidate.freqs:
+            _, scaled = prepared_waves(candidate, first_wave_positions(candidate, SETTINGS, [freq]), SETTINGS)
+            ref, t_ref = timed(predict_wave_i_onsets, scaled, engine)
+            cand, t_cand = timed(predict_wave_i_onsets, scaled, quantized_engine)
+            row['max_abs_deviation'] = max(row['max_abs_deviation'], float(np.max(np.abs(ref - cand))))
+            row['matches'] += int(np.sum(ref == cand))
+            row['total'] += len(ref)
+            row['reference_s'] += t_ref
+            row['candidate_s'] += t_cand
+    total = row.pop('total')
+    matches = row.pop('matches')
+    return {'quantized Wave I onsets': {**row, 'match_rate': matches / total}} if total else {}
+
+# Frozen baseline outputs
+
+def freq_key(freq):
+    # Frequencies as fixture keys: 'Click', or the float's repr
+    return freq if isinstance(freq, str) else repr(float(freq))
+
+def fixture_path(path, directory=FIXTURES_DIR):
+    return os.path.join(directory, os.path.basename(path) + '.npz')
+
+def padded(indices, width=5):
+    # Peak/trough indices as a fixed-width row, -1 past the last one
+    row = np.full(width, -1, dtype=np.int64)
+    row[:len(indices)] = indices
+    return row
+
+def freeze(paths, directory=FIXTURES_DIR, baseline=None):
+    """Writes the baseline's outputs on each file to fixture_path(path, directory).
+
+    Each .npz holds the raw samples and Var1..Var10 of every .arf record, the
+    display and scaled wave of every (freq, dB), its peaks and troughs, and
+    each frequency's threshold. Needs torch, for the baseline's peak model.
+    """
+    baseline = baseline or Baseline()
+    if not baseline.has_peak_model:
+        raise RuntimeError('Freezing fixtures needs torch, to run the baseline peak model')
+    os.makedirs(directory, exist_ok=True)
+    for path in paths:
+        arrays = {}
+        if path.endswith('.arf'):
+            recs = [rec for group in baseline.arfread(path)['groups'] for rec in group['recs']]
+            arrays['arf_samples'] = np.concatenate([np.asarray(rec['data'], dtype=np.float32) for rec in recs])
+            arrays['arf_npts'] = np.array([rec['npts'] for rec in recs])
+            arrays['arf_vars'] = np.array([[rec[f'Var{v}'] for v in range(1, 11)] for rec in recs], dtype=np.float32)
+
+        df = baseline.recording(path, is_click(path))
+        keys, display, scaled = [], [], []
+        for freq in df['Freq(Hz)'].unique():
+            for db in df[df['Freq(Hz)'] == freq]['Level(dB)'].unique():
+                y_values, wave = baseline.wave(df, freq, db)
+                keys.append((freq_key(freq), float(db)))
+                display.append(y_values)
+                scaled.append(wave)
+        arrays['wave_freqs'] = np.array([freq for freq, _ in keys])
+        arrays['wave_dbs'] = np.array([db for _, db in keys])
+        # float32 halves the fixtures and rounds far below the wave tolerances
+        arrays['display'] = np.array(display, dtype=np.float32)
+        arrays['scaled'] = np.array(scaled, dtype=np.float32)
+        found = [baseline.peak_finding(wave) for wave in scaled]
+        arrays['peaks'] = np.array([padded(peaks) for peaks, _ in found])
+        arrays['troughs'] = np.array([padded(troughs) for _, troughs in found])
+
+        freqs = df['Freq(Hz)'].unique()
+        arrays['threshold_freqs'] = np.array([freq_key(freq) for freq in freqs])
+        arrays['thresholds'] = np.array([baseline.threshold(df, freq) for freq in freqs], dtype=np.float64)
+        np.savez_compressed(fixture_path(path, directory), **arrays)
+
+TOLERANCES = {
+    # name: (largest allowed absolute deviation, smallest allowed match rate)
+    'arfread': (1e-6, 1.0),
+    'interpolate_and_smooth': (1e-4, 1.0),
+    'scaling': (1e-4, 1.0),
+    'peak_finding (peaks)': (np.inf, 0.99),
+    'peak_finding (troughs)': (np.inf, 0.99),
+    'calculate_hearing_threshold': (0.0, 1.0),
+    'wave_i_metrics_table': (1e-4, 0.99),
+    # Held to the same match rate as the baseline peaks
+    'quantized Wave I onsets': (2.0, 0.99),
+}
+
+def run(paths, n_synthetic=4, engine=None, quantization='float'):
+    """Runs every comparison and returns the report as a DataFrame, one row per function.
+
+    With quantization other than 'float', the quantized peak finding model
+    is also compared against the float one.
+    """
+    from abra_inference import InProcessInference
+
+    engine = engine or InProcessInference(quantization='float')
+    baseline = Baseline()
+    inputs = list(recordings(baseline, paths, n_synthetic))
+    results = {'arfread': compare_arfread(baseline, [p for p in paths if p.endswith('.arf')])}
+    results.update(compare_waves(baseline, engine, inputs))
+    results.update(compare_thresholds(baseline, engine, inputs))
+    results.update(compare_metrics_table(engine, inputs))
+    if quantization != 'float':
+        results.update(compare_quantization(engine, InProcessInference(quantization=quantization), inputs))
+
+    report = pd.DataFrame.from_dict(results, orient='index')
+    report['timing_ratio'] = report['candidate_s'] / report['reference_s']
+    report['max_allowed_deviation'] = [TOLERANCES[name][0] for name in report.index]
+    report['min_match_rate'] = [TOLERANCES[name][1] for name in report.index]
+    report['passed'] = (report['max_abs_deviation'] <= report['max_allowed_deviation']) & (report['match_rate'] >= report['min_match_rate'])
+    return report
+
+if __name__ == '__main__':
+    from abra_inference import QUANTIZATION_MODES
+
+    parser = argparse.ArgumentParser(description='Compare ABRA fast paths against the baseline implementations')
+    parser.add_argument('files', nargs='*', help='ARF/CSV recordings (default: the bundled ABR_files)')
+    parser.add_argument('--synthetic', type=int, default=4, help='number of synthetic recordings to add')
+    parser.add_argument('--quantization', choices=QUANTIZATION_MODES, default='float', help='also compare this quantized peak finding model against the float one')
+    parser.add_argument('--report', help='write the report as JSON to this path')
+    parser.add_argument('--freeze', nargs='?', const=FIXTURES_DIR, metavar='DIR',
+                        help=f'write the baseline outputs on the files as test fixtures instead (default: {FIXTURES_DIR})')
+    args = parser.parse_args()
+
+    paths = sorted(args.files or glob.glob(DEFAULT_FILES))
+    if args.freeze:
+        freeze(paths, args.freeze)
+        sys.exit(0)
+    report = run(paths, args.synthetic, quantization=args.quantization)
+    print(report.to_string())
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report.to_dict(orient='index'), f, indent=2, default=float)
+    sys.exit(0 if report['passed'].all() else 1)
@@ -0,0 +1,420 @@
+import argparse
+import glob
+import itertools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+import requests
+from google.protobuf.message import DecodeError
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from websockets.sync.client import connect
+
+# Concurrent-session load test for the ABRA app.
+#
+# Starts the app with `streamlit run` and drives it over Streamlit's own websocket
+# protocol, one connection per simulated user, so every session runs in the one server
+# process and shares its models, caches and thread pools exactly like browser sessions.
+# Each session uploads the bundled ABR_files, changes a few settings and presses the
+# heavy buttons; the latency of every script run is recorded per number of concurrent
+# sessions, together with throughput and the server's resident memory. Plots are
+# pressed twice per iteration with a y range no other press used, so the first press
+# builds the figures (a figure cache miss) and the second is served from the cache
+# (a hit); the two are reported separately. Compare releases with --report and --baseline:
+#
+#     python load_test.py --sessions 1 2 4 8 --report load_v1.json
+#     python load_test.py --sessions 1 2 4 8 --baseline load_v1.json
+#
+# The websocket messages are Streamlit's own, internal protocol, which can change
+# between releases; a Session raises ProtocolError when the app's replies don't
+# look as expected rather than measuring something else.
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ABRA_v1.0.0.py')
+DEFAULT_FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ABR_files', '*')
+ACTIONS = ['startup', 'upload', 'settings', 'Plot Waves at Single Frequency', 'Plot 3D Surface', 'Return All Thresholds']
+PLOTS = ['Plot Waves at Single Frequency', 'Plot 3D Surface']
+# Y-axis maxima no two plot presses share, so each first press misses the figure cache; sessions
+# take them from one counter, behind a lock as they run on threads
+Y_MAXIMA = itertools.count()
+Y_MAXIMA_LOCK = threading.Lock()
+MIME_TYPES = {'.csv': 'text/csv', '.arf': 'application/octet-stream'}
+
+def resident_memory(pid):
+    # Resident set size of a process in bytes, or None where /proc isn't available
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+class ProtocolError(RuntimeError):
+    """The app's websocket replies don't match what this test was written against."""
+    def __init__(self, message):
+        super().__init__(f'{message} (streamlit {streamlit_version()}; load_test.py drives its internal websocket protocol)')
+
+def next_y_max():
+    with Y_MAXIMA_LOCK:
+        return 5.0 + next(Y_MAXIMA) / 1000
+
+def streamlit_version():
+    from importlib.metadata import version
+    return version('streamlit')
+
+def start_server(port, timeout=120):
+    """Runs the app headless on port and waits until it is healthy."""
+    server = subprocess.Popen([sys.executable, '-m', 'streamlit', 'run', APP_PATH,
+                               '--server.headless', 'true', '--server.port', str(port),
+                               '--server.fileWatcherType', 'none', '--server.enableXsrfProtection', 'false',
+                               '--browser.gatherUsageStats', 'false'],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f'http://localhost:{port}/_stcore/health', timeout=1).ok:
+                return server
+        except requests.ConnectionError:
+            pass
+        if server.poll() is not None:
+            break
+        time.sleep(0.5)
+    server.kill()
+    raise RuntimeError(f'The app did not start on port {port}')
+
+class Session:
+    """One browser tab: a websocket to the app and the widget values it would send.
+
+    Widgets are addressed by label, as shown in the sidebar. rerun() sends the
+    current values (plus any button press) and reads until the script run has
+    finished, returning the exception messages the page showed. Fragments
+    polling on a timer are rerun by wait_for_fragments(), as the browser would.
+    """
+    def __init__(self, url, timeout):
+        address = urlparse(url)
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.widgets = {}
+        self.states = {}
+        self.auto_reruns = {}
+        self.session_id = None
+        self._file_urls = None
+        self._socket = connect(f'ws://{address.netloc}{address.path.rstrip("/")}/_stcore/stream',
+                               subprotocols=['streamlit'], max_size=None, open_timeout=timeout)
+
+    def close(self):
+        self._socket.close()
+
+    def widget_state(self, label):
+        if label not in self.widgets:
+            raise ProtocolError(f'No widget labelled {label!r} on the page')
+        widget_id = self.widgets[label].id
+        if widget_id not in self.states:
+            self.states[widget_id] = BackMsg().rerun_script.widget_states.widgets.add()
+            self.states[widget_id].id = widget_id
+        return self.states[widget_id]
+
+    def check(self, label, value=True):
+        self.widget_state(label).bool_value = value
+
+    def select(self, label, option):
+        self.widget_state(label).string_value = str(option)
+
+    def number(self, label, value):
+        self.widget_state(label).double_value = float(value)
+
+    def upload(self, label, files):
+        # Asks the server where to put each file, uploads them, then sets the uploader's value
+        msg = BackMsg()
+        msg.file_urls_request.request_id = 'upload'
+        msg.file_urls_request.session_id = self.session_id
+        msg.file_urls_request.file_names.extend(name for name, _, _ in files)
+        self._socket.send(msg.SerializeToString())
+        while self._file_urls is None:
+            self._handle(self._receive())
+        file_urls, self._file_urls = self._file_urls, None
+
+        state = self.widget_state(label)
+        state.file_uploader_state_value.Clear()
+        for (name, data, mime), urls in zip(files, file_urls):
+            response = requests.put(f'{self.url}{urls.upload_url}', files={'file': (name, data, mime)}, timeout=self.timeout)
+            response.raise_for_status()
+            info = state.file_uploader_state_value.uploaded_file_info.add()
+            info.name = name
+            info.size = len(data)
+            info.file_id = urls.file_id
+            info.file_urls.CopyFrom(urls)
+
+    def rerun(self, press=None, fragment_id=None):
+        msg = BackMsg()
+        client_state = msg.rerun_script
+        client_state.widget_states.widgets.extend(self.states.values())
+        if press is not None:
+            if press not in self.widgets:
+                raise ProtocolError(f'No button labelled {press!r} on the page')
+            button = client_state.widget_states.widgets.add()
+            button.id = self.widgets[press].id
+            button.trigger_value = True
+        if fragment_id is not None:
+            client_state.fragment_id = fragment_id
+            client_state.is_auto_rerun = True
+        self._socket.send(msg.SerializeToString())
+
+        errors = []
+        while True:
+            forward = self._receive()
+            if forward.WhichOneof('type') == 'script_finished':
+                if self.session_id is None:
+                    raise ProtocolError('The script finished without a new_session message')
+                if forward.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    return errors
+            else:
+                errors.extend(self._handle(forward))
+
+    def wait_for_fragments(self, timeout):
+        # Reruns polling fragments (e.g. a running analysis job) until none are left
+        deadline = time.monotonic() + timeout
+        errors = []
+        while self.auto_reruns:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'Fragments still polling after {timeout} s')
+            fragment_id, interval = next(iter(self.auto_reruns.items()))
+            time.sleep(interval)
+            errors.extend(self.rerun(fragment_id=fragment_id))
+        return errors
+
+    def _receive(self):
+        forward = ForwardMsg()
+        try:
+            forward.ParseFromString(self._socket.recv(timeout=self.timeout))
+        except DecodeError as e:
+            raise ProtocolError(f'Unreadable ForwardMsg: {e}') from None
+        return forward
+
+    def _handle(self, forward):
+        # Records widgets, polling fragments and upload URLs; returns the exceptions shown
+        kind = forward.WhichOneof('type')
+        if kind == 'new_session':
+            self.session_id = forward.new_session.initialize.session_id
+            if not forward.new_session.fragment_ids_this_run:
+                self.auto_reruns = {}
+        elif kind == 'auto_rerun':
+            self.auto_reruns[forward.auto_rerun.fragment_id] = forward.auto_rerun.interval
+        elif kind == 'stop_auto_rerun':
+            for fragment_id in forward.stop_auto_rerun.fragment_ids:
+                self.auto_reruns.pop(fragment_id, None)
+        elif kind == 'file_urls_response':
+            self._file_urls = list(forward.file_urls_response.file_urls)
+        elif kind == 'delta' and forward.delta.WhichOneof('type') == 'new_element':
+            element = forward.delta.new_element
+            element_kind = element.WhichOneof('type')
+            if element_kind == 'exception' and not element.exception.is_warning:
+                return [element.exception.message]
+            if element_kind in ('button', 'checkbox', 'selectbox', 'radio', 'file_uploader', 'number_input'):
+                widget = getattr(element, element_kind)
+                self.widgets[widget.label] = widget
+        return []
+
+def uploads(paths):
+    files = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            files.append((os.path.basename(path), f.read(), MIME_TYPES.get(os.path.splitext(path)[1], 'application/octet-stream')))
+    return files
+
+def run_session(url, files, freq, iterations, timeout, record):
+    """One user: upload, pick freq and other settings, then press each analysis button iterations times.
+
+    record(action, cache, seconds, error) is called after every step, with
+    cache 'miss' or 'hit' for plots and '-' otherwise. Each plot is pressed
+    with a new y range (a miss) and then again unchanged (a hit). "Return All
+    Thresholds" only starts a background job, so its latency runs until the
+    job has finished and its results are shown. Connecting is part of
+    'startup', so a session that cannot connect records a failed startup.
+    """
+    def timed(action, step, cache='-'):
+        start = time.perf_counter()
+        try:
+            errors = step()
+            error = errors[0] if errors else None
+        except ProtocolError:
+            raise
+        except Exception as e:
+            error = repr(e)
+        record(action, cache, time.perf_counter() - start, error)
+        return error is None
+
+    session = None
+
+    def startup():
+        nonlocal session
+        session = Session(url, timeout)
+        return session.rerun()
+
+    try:
+        if not timed('startup', startup):
+            return
+
+        def upload():
+            session.select('Click or Tone? (for .arf files)', 'Tone')
+            session.upload('Choose a file', files)
+            return session.rerun()
+
+        if not timed('upload', upload):
+            return
+
+        def change_settings():
+            for name, _, _ in files:
+                session.check(name)
+            errors = session.rerun()
+            session.select('Select Frequency (Hz)', freq)
+            session.check('Plot Time Warped Curves')
+            session.select('Time Warp Alignment', 'Fast preview (shift + warp)')
+            session.check('Show Legend', False)
+            # Measure the analyses themselves rather than the results store
+            session.check('Reuse Stored Results for Unchanged Files', False)
+            return errors + session.rerun()
+
+        if not timed('settings', change_settings):
+            return
+
+        for _ in range(iterations):
+            for plot in PLOTS:
+                def miss():
+                    session.number('Y-axis Maximum', next_y_max())
+                    return session.rerun(press=plot)
+
+                timed(plot, miss, 'miss')
+                timed(plot, lambda: session.rerun(press=plot), 'hit')
+            timed('Return All Thresholds',
+                  lambda: session.rerun(press='Return All Thresholds') + session.wait_for_fragments(timeout))
+    finally:
+        if session is not None:
+            session.close()
+
+def run_level(url, sessions, files, freq, iterations, timeout):
+    """Runs sessions users at once; returns their (action, cache, seconds, error) records and the wall time."""
+    records = []
+    lock = threading.Lock()
+
+    def record(action, cache, seconds, error):
+        with lock:
+            records.append((action, cache, seconds, error))
+
+    barrier = threading.Barrier(sessions)
+
+    failures = []
+
+    def user():
+        barrier.wait()
+        try:
+            run_session(url, files, freq, iterations, timeout, record)
+        except ProtocolError as e:
+            failures.append(e)
+        except Exception as e:
+            # Steps record their own errors; this is anything between them, which still ends the session
+            record('session', '-', 0.0, repr(e))
+
+    threads = [threading.Thread(target=user, daemon=True) for _ in range(sessions)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise failures[0]
+    return records, time.perf_counter() - start
+
+def summarize(sessions, records, wall_time, idle_memory, memory):
+    rows = []
+    frame = pd.DataFrame(records, columns=['action', 'cache', 'seconds', 'error'])
+    # A 'session' row only appears when a session broke off outside its steps
+    actions = ACTIONS + (['session'] if (frame['action'] == 'session').any() else [])
+    for action in actions:
+        for cache in (['miss', 'hit'] if action in PLOTS else ['-']):
+            runs = frame[(frame['action'] == action) & (frame['cache'] == cache)]
+            rows.append(summary_row(sessions, action, cache, runs, wall_time, idle_memory, memory))
+    return rows
+
+def summary_row(sessions, action, cache, runs, wall_time, idle_memory, memory):
+    ok = runs[runs['error'].isna()]['seconds'].to_numpy()
+    return {
+        'sessions': sessions,
+        'action': action,
+        'cache': cache,
+        'runs': len(runs),
+        'errors': int(runs['error'].notna().sum()),
+        'p50_s': np.percentile(ok, 50) if ok.size else np.nan,
+        'p90_s': np.percentile(ok, 90) if ok.size else np.nan,
+        'p95_s': np.percentile(ok, 95) if ok.size else np.nan,
+        'p99_s': np.percentile(ok, 99) if ok.size else np.nan,
+        'max_s': ok.max() if ok.size else np.nan,
+        'throughput_per_s': len(runs) / wall_time,
+        'rss_mb': memory / 2**20 if memory else np.nan,
+        'rss_per_session_mb': (memory - idle_memory) / sessions / 2**20 if memory and idle_memory else np.nan,
+    }
+
+def run(session_counts, paths, freq=24000.0, iterations=2, timeout=600, port=8599):
+    """Starts the app, runs every session count in turn and returns the report, one row per (sessions, action).
+
+    One session runs before measuring so the models are loaded; resident
+    memory per session is counted from what the server held after it.
+    """
+    files = uploads(paths)
+    url = f'http://localhost:{port}'
+    server = start_server(port)
+    try:
+        run_level(url, 1, files, freq, 0, timeout)
+        idle_memory = resident_memory(server.pid)
+        rows = []
+        errors = []
+        for sessions in session_counts:
+            records, wall_time = run_level(url, sessions, files, freq, iterations, timeout)
+            memory = resident_memory(server.pid)
+            rows.extend(summarize(sessions, records, wall_time, idle_memory, memory))
+            errors.extend((sessions, action, error) for action, _, _, error in records if error)
+            print(f'{sessions} sessions: {len(records)} runs in {wall_time:.1f} s, server RSS {(memory or 0) / 2**20:.0f} MB', file=sys.stderr)
+    finally:
+        server.terminate()
+        server.wait()
+    return pd.DataFrame(rows), errors
+
+def compare(report, baseline):
+    # p95 latency and throughput relative to an earlier report, matched on (sessions, action, cache)
+    baseline = baseline.set_index(['sessions', 'action', 'cache'])
+    report = report.set_index(['sessions', 'action', 'cache'])
+    report['p95_vs_baseline'] = report['p95_s'] / baseline['p95_s'].reindex(report.index)
+    report['throughput_vs_baseline'] = report['throughput_per_s'] / baseline['throughput_per_s'].reindex(report.index)
+    return report.reset_index()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load-test the ABRA app with concurrent sessions')
+    parser.add_argument('files', nargs='*', help='ARF/CSV tone recordings every session uploads (default: the bundled tone ABR_files)')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 2, 4, 8], help='numbers of concurrent sessions to test')
+    parser.add_argument('--freq', type=float, default=24000.0, help='frequency to plot, present in every uploaded file (default: 24 kHz)')
+    parser.add_argument('--iterations', type=int, default=2, help='times each session presses every analysis button')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds one step may take')
+    parser.add_argument('--port', type=int, default=8599, help='port the app is started on')
+    parser.add_argument('--report', help='write the report as JSON to this path')
+    parser.add_argument('--baseline', help='earlier JSON report to compare p95 latency and throughput against')
+    args = parser.parse_args()
+
+    # Sessions read .arf files as tone recordings, and the app can't plot clicks and tones together
+    paths = sorted(args.files or [path for path in glob.glob(DEFAULT_FILES) if 'click' not in os.path.basename(path).lower()])
+    report, errors = run(args.sessions, paths, args.freq, args.iterations, args.timeout, args.port)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report = compare(report, pd.DataFrame(json.load(f)['report']))
+    print(report.to_string(index=False))
+    for sessions, action, error in errors[:10]:
+        print(f'{sessions} sessions, {action}: {error}', file=sys.stderr)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'files': [os.path.basename(path) for path in paths], 'sessions': args.sessions,
+                       'iterations': args.iterations, 'report': report.to_dict(orient='records')},
+                      f, indent=2, default=float)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The harness and abra_inference live at the repository root, next to the abra package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,90 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+
+from abra import arfread, calculate_hearing_threshold, peak_finding, prepare_wave
+from equivalence_harness import (DEFAULT_FILES, SETTINGS, TOLERANCES, ThresholdEngine, candidate_recording, fixture_path,
+                                 freq_key, padded)
+
+# The abra package against the baseline app's outputs frozen in tests/fixtures/equivalence,
+# with the harness's tolerances. After a deliberate change to those outputs, refreeze with
+#
+#     python equivalence_harness.py --freeze
+
+PATHS = sorted(glob.glob(DEFAULT_FILES))
+ARF_PATHS = [path for path in PATHS if path.endswith('.arf')]
+
+@pytest.fixture(scope='module')
+def engine():
+    pytest.importorskip('torch')
+    from abra_inference import InProcessInference
+    return InProcessInference(quantization='float')
+
+@pytest.fixture(scope='module')
+def threshold_engine():
+    # Thresholds only need the TensorFlow model, so they are checked without torch too
+    return ThresholdEngine()
+
+def frozen(path):
+    return np.load(fixture_path(path))
+
+def assert_within(name, deviations):
+    # Every deviation under the tolerance for name, at least its match rate of them exact enough
+    max_deviation, min_match_rate = TOLERANCES[name]
+    deviations = np.asarray(deviations, dtype=np.float64)
+    assert deviations.size
+    assert np.max(deviations) <= max_deviation, f'{name}: largest deviation {np.max(deviations)}'
+    assert np.mean(deviations <= max_deviation) >= min_match_rate
+
+def assert_match_rate(name, matches):
+    assert np.mean(matches) >= TOLERANCES[name][1], f'{name}: {np.sum(matches)} of {len(matches)} match'
+
+def frozen_waves(path):
+    # (candidate Recording, [(freq, dB)], fixture) with the fixture's frequency keys mapped to the candidate's
+    recording = candidate_recording(path)
+    fixture = frozen(path)
+    freqs = {freq_key(freq): freq for freq in recording.freqs}
+    keys = [(freqs[freq], db) for freq, db in zip(fixture['wave_freqs'], fixture['wave_dbs'])]
+    return recording, keys, fixture
+
+@pytest.mark.parametrize('path', ARF_PATHS, ids=os.path.basename)
+def test_arfread(path):
+    fixture = frozen(path)
+    recs = [rec for group in arfread(path)['groups'] for rec in group['recs']]
+    assert [rec['npts'] for rec in recs] == fixture['arf_npts'].tolist()
+    np.testing.assert_array_equal(np.array([[rec[f'Var{v}'] for v in range(1, 11)] for rec in recs], dtype=np.float32), fixture['arf_vars'])
+    samples = np.concatenate([np.asarray(rec['data'], dtype=np.float64) for rec in recs])
+    assert_within('arfread', np.abs(samples - fixture['arf_samples']))
+
+@pytest.mark.parametrize('path', PATHS, ids=os.path.basename)
+def test_waves(path):
+    recording, keys, fixture = frozen_waves(path)
+    display, scaled = [], []
+    for (freq, db), ref_y, ref_scaled in zip(keys, fixture['display'], fixture['scaled']):
+        _, y_values, wave = prepare_wave(recording, freq, db, SETTINGS)
+        display.append(np.max(np.abs(np.asarray(y_values, dtype=np.float64) - ref_y)))
+        scaled.append(np.max(np.abs(np.asarray(wave, dtype=np.float64) - ref_scaled)))
+    assert_within('interpolate_and_smooth', display)
+    assert_within('scaling', scaled)
+
+@pytest.mark.parametrize('path', PATHS, ids=os.path.basename)
+def test_peak_finding(path, engine):
+    recording, keys, fixture = frozen_waves(path)
+    peaks, troughs = [], []
+    for (freq, db), ref_peaks, ref_troughs in zip(keys, fixture['peaks'], fixture['troughs']):
+        _, _, wave = prepare_wave(recording, freq, db, SETTINGS)
+        found_peaks, found_troughs = peak_finding(wave, engine)
+        peaks.append(np.array_equal(padded(found_peaks), ref_peaks))
+        troughs.append(np.array_equal(padded(found_troughs), ref_troughs))
+    assert_match_rate('peak_finding (peaks)', peaks)
+    assert_match_rate('peak_finding (troughs)', troughs)
+
+@pytest.mark.parametrize('path', PATHS, ids=os.path.basename)
+def test_thresholds(path, threshold_engine):
+    recording = candidate_recording(path)
+    fixture = frozen(path)
+    freqs = {freq_key(freq): freq for freq in recording.freqs}
+    thresholds = [calculate_hearing_threshold(recording, freqs[freq], SETTINGS, threshold_engine) for freq in fixture['threshold_freqs']]
+    assert_within('calculate_hearing_threshold', np.abs(np.array(thresholds, dtype=np.float64) - fixture['thresholds']))
@@ -0,0 +1,48 @@
+import time
+
+import pytest
+
+from abra import FolderWatcher
+
+def wait_until(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.02)
+
+def load(name, file_bytes):
+    return name, file_bytes
+
+def analyze_with(label):
+    def analyze(recording):
+        name, _ = recording
+        return [(name, label)], []
+    return analyze
+
+@pytest.fixture
+def watcher(tmp_path):
+    watcher = FolderWatcher(str(tmp_path), interval=0.02)
+    watcher.configure(load=load, load_key='parse', analyze=analyze_with('first'), analyze_key='first')
+    yield watcher.start()
+    watcher.stop()
+
+def thresholds(watcher):
+    return sorted(map(tuple, watcher.results(['name', 'label'], [])[0].to_numpy().tolist()))
+
+def test_deleted_files_are_dropped(watcher, tmp_path):
+    (tmp_path / 'a.csv').write_bytes(b'a')
+    (tmp_path / 'b.csv').write_bytes(b'b')
+    wait_until(lambda: thresholds(watcher) == [('a.csv', 'first'), ('b.csv', 'first')])
+    (tmp_path / 'a.csv').unlink()
+    wait_until(lambda: thresholds(watcher) == [('b.csv', 'first')])
+    assert [path.endswith('b.csv') for path in watcher.recordings] == [True]
+
+def test_new_analysis_settings_requeue_every_recording(watcher, tmp_path):
+    (tmp_path / 'a.csv').write_bytes(b'a')
+    wait_until(lambda: thresholds(watcher) == [('a.csv', 'first')])
+    watcher.configure(analyze=analyze_with('second'), analyze_key='second')
+    wait_until(lambda: thresholds(watcher) == [('a.csv', 'second')])
+    # The same settings again leave the results alone
+    watcher.configure(analyze=analyze_with('third'), analyze_key='second')
+    time.sleep(0.2)
+    assert thresholds(watcher) == [('a.csv', 'second')]
@@ -0,0 +1,26 @@
+import os
+
+import numpy as np
+import pytest
+
+from abra import ResultsStore, Settings, load_recording
+from equivalence_harness import ROOT, ThresholdEngine
+
+class LostWorker:
+    def predict_thresholds(self, waves):
+        raise EOFError('inference worker went away')
+
+@pytest.fixture
+def recording():
+    with open(os.path.join(ROOT, 'ABR_files', '55.csv'), 'rb') as f:
+        return load_recording('55.csv', f.read(), Settings())
+
+def test_failed_thresholds_are_not_stored(recording, tmp_path):
+    store = ResultsStore('test', path=str(tmp_path / 'results.sqlite'))
+    key = store.key(recording, Settings())
+    rows = list(store.threshold_rows(recording, recording.freqs, Settings(), LostWorker()))
+    assert all(np.isnan(row['Threshold']) for row in rows)
+    assert store.thresholds(key) is None
+
+    rows = list(store.threshold_rows(recording, recording.freqs, Settings(), ThresholdEngine()))
+    assert store.thresholds(key) == {float(row['Frequency']): row['Threshold'] for row in rows}